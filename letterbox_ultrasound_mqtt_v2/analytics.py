@@ -0,0 +1,331 @@
+# Vectorized history analytics (rolling statistics, sensor noise, battery drain).
+#
+# NumPy is optional: without it the server runs as before, /api/stats answers
+# with an error and batches are converted with plain Python.
+
+import weakref
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Speed of sound is 343.2 m/s or 0.3432 mm/microsecond
+SOUND_SPEED_MM_PER_US = 0.3432
+
+# Below this batch size the NumPy call overhead is larger than the Python loop
+VECTORIZE_MIN_BATCH = 32
+
+
+def numpy_available():
+    return np is not None
+
+
+# Distances in mm for many duration triplets at once (list of lists in, list of lists out)
+def durations_to_distances(durations_list):
+    if np is None or len(durations_list) < VECTORIZE_MIN_BATCH:
+        return [[(duration * SOUND_SPEED_MM_PER_US) / 2 if duration > 0 else 0 for duration in durations]
+                for durations in durations_list]
+    lengths = {len(durations) for durations in durations_list}
+    if len(lengths) != 1:
+        # Ragged input (old payloads); convert row by row
+        return [durations_to_distances([durations])[0] for durations in durations_list]
+    durations = np.asarray(durations_list, dtype=np.float64)
+    distances = np.where(durations > 0, durations * (SOUND_SPEED_MM_PER_US / 2), 0.0)
+    return distances.tolist()
+
+
+# Rolling mean and standard deviation over window samples, using cumulative
+# sums. Only evaluated at the given end positions (default: everywhere).
+def rolling_mean_std(values, window, positions=None):
+    count = len(values)
+    if count < window or window < 1:
+        return np.empty(0), np.empty(0)
+    # Center the values first to keep the sum of squares numerically stable
+    offset = values.mean()
+    centered = values - offset
+    cumsum = np.empty(count + 1)
+    cumsum[0] = 0.0
+    np.cumsum(centered, out=cumsum[1:])
+    cumsum_sq = np.empty(count + 1)
+    cumsum_sq[0] = 0.0
+    np.cumsum(centered * centered, out=cumsum_sq[1:])
+    ends = np.arange(window, count + 1) if positions is None else positions + 1
+    mean = (cumsum[ends] - cumsum[ends - window]) / window
+    variance = np.maximum((cumsum_sq[ends] - cumsum_sq[ends - window]) / window - mean * mean, 0.0)
+    return mean + offset, np.sqrt(variance)
+
+
+# Largest difference (us) between the durations of a triplet for which 9 * its variance still fits in int32
+_INT32_SPREAD_LIMIT = 18918
+
+# Below this 9 * variance the spreads are counted (np.bincount) instead of kept one by one
+COUNTED_VARIANCE_LIMIT = 1 << 16
+
+
+# 9 * variance of the triplets whose durations are all > 0, in exact integer math from the
+# differences x and y to the first measurement: 2 * (x * x + y * y - x * y). Sensor noise
+# keeps them small, so int32 is enough unless a reading is way off.
+def triplet_scaled_variance(d0, d1, d2):
+    if len(d0) and min(d0.min(), d1.min(), d2.min()) <= 0:
+        valid = (d0 > 0) & (d1 > 0) & (d2 > 0)
+        d0, d1, d2 = d0[valid], d1[valid], d2[valid]
+    x = d1 - d0
+    y = d2 - d0
+    if len(x) and max(x.max(), y.max(), -x.min(), -y.min()) >= _INT32_SPREAD_LIMIT:
+        x, y = x.astype(np.int64), y.astype(np.int64)
+    xy = x * y
+    x *= x
+    y *= y
+    x += y
+    x -= xy
+    x += x
+    return x
+
+
+class _SpreadStats:
+    """Distribution of the spread (standard deviation) of the triplets, merged span by span.
+
+    Values from triplet_scaled_variance() below COUNTED_VARIANCE_LIMIT are
+    only kept as distinct values with their counts; the rare larger ones are
+    kept as they are. So the percentiles stay exact without keeping every
+    reading.
+    """
+
+    __slots__ = ("values", "counts", "large")
+
+    def __init__(self):
+        self.values = []
+        self.counts = []
+        self.large = []
+
+    def add(self, scaled_variance):
+        if len(scaled_variance) and scaled_variance.max() >= COUNTED_VARIANCE_LIMIT:
+            outliers = scaled_variance >= COUNTED_VARIANCE_LIMIT
+            self.large.append(scaled_variance[outliers])
+            scaled_variance = scaled_variance[~outliers]
+        counts = np.bincount(scaled_variance)
+        values = np.flatnonzero(counts)
+        self.values.append(values)
+        self.counts.append(counts[values])
+
+    def merge(self, other):
+        self.values += other.values
+        self.counts += other.counts
+        self.large += other.large
+
+    def stats(self):
+        """Mean, median, 95th percentile and maximum in mm; percentiles interpolate linearly, as np.percentile."""
+        large = np.sort(np.concatenate(self.large)) if self.large else np.zeros(0, dtype=np.int64)
+        values = np.concatenate(self.values) if self.values else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(self.counts) if self.counts else np.zeros(0, dtype=np.int64)
+        order = np.argsort(values, kind="stable")
+        values, counts = values[order], counts[order]
+        counted = int(counts.sum())
+        count = counted + len(large)
+        if not count:
+            return {"mean": None, "median": None, "p95": None, "max": None}
+        cumulative = np.cumsum(counts)
+
+        # Spread at a rank of all values in sorted order
+        def spread_at(rank):
+            return np.sqrt(values[np.searchsorted(cumulative, rank, side="right")] if rank < counted
+                           else large[rank - counted])
+
+        p50, p95 = (spread_at(int(position)) + (spread_at(min(int(position) + 1, count - 1)) - spread_at(int(position)))
+                    * (position - int(position)) for position in (q / 100 * (count - 1) for q in (50, 95)))
+        mean = (np.dot(np.sqrt(values), counts) + np.sqrt(large).sum()) / count
+        largest = large[-1] if len(large) else values[-1]
+        scale = SOUND_SPEED_MM_PER_US / 2 / 3
+        return {"mean": float(mean * scale), "median": float(p50 * scale), "p95": float(p95 * scale),
+                "max": float(np.sqrt(largest) * scale)}
+
+
+class _DrainRate:
+    """Drain rate per hour of a monotonically growing counter, merged span by span.
+
+    Drops (device restarts reset estimatedUsedCapacity to 0) are ignored
+    instead of counted as negative usage, and so are readings without time
+    in between.
+    """
+
+    __slots__ = ("seconds", "change")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.change = 0.0
+
+    def add(self, ts, values, intervals):
+        """Add the changes between consecutive readings (intervals: np.diff(ts))."""
+        deltas = np.diff(values)
+        if intervals.min() > 0 and deltas.min() >= 0:
+            # Usual case: nothing to leave out, the sums telescope
+            self.seconds += ts[-1] - ts[0]
+            self.change += values[-1] - values[0]
+            return
+        # Dot products with the mask are much faster than indexing with it
+        weights = ((deltas >= 0) & (intervals > 0)).astype(np.float64)
+        self.seconds += np.dot(intervals, weights)
+        self.change += np.dot(deltas, weights)
+
+    def add_step(self, interval, delta):
+        if interval > 0 and delta >= 0:
+            self.seconds += interval
+            self.change += delta
+
+    def merge(self, other):
+        self.seconds += other.seconds
+        self.change += other.change
+
+    def rate(self):
+        return float(self.change / (self.seconds / 3600.0)) if self.seconds > 0 else None
+
+
+class _Summary:
+    """Statistics of consecutive history entries; summaries of adjacent spans merge in order."""
+
+    __slots__ = ("count", "mean", "squares", "min", "max", "first", "last", "noise", "used", "battery_drop")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = self.squares = 0.0
+        self.min, self.max = float("inf"), float("-inf")
+        self.first = self.last = None  # (ts, battery, used capacity)
+        self.noise = _SpreadStats()
+        self.used = _DrainRate()
+        self.battery_drop = _DrainRate()
+
+    @classmethod
+    def of(cls, history, start, stop):
+        """Summary of the history entries [start, stop)."""
+        ts, distance, battery, used_capacity = (_column(history, name, start, stop, np.float64)
+                                                for name in ("ts", "avg_distance", "battery", "used_capacity"))
+        summary = cls()
+        summary.count = len(ts)
+        summary.mean = distance.mean()
+        centered = distance - summary.mean
+        summary.squares = np.dot(centered, centered)
+        summary.min, summary.max = distance.min(), distance.max()
+        summary.first = (ts[0], battery[0], used_capacity[0])
+        summary.last = (ts[-1], battery[-1], used_capacity[-1])
+        summary.noise.add(triplet_scaled_variance(*(_column(history, name, start, stop, np.int32)
+                                                    for name in ("d0", "d1", "d2"))))
+        if len(ts) > 1:
+            intervals = np.diff(ts)
+            summary.used.add(ts, used_capacity, intervals)
+            summary.battery_drop.add(ts, -battery, intervals)
+        return summary
+
+    def merge(self, other):
+        """Add the summary of the entries right after these (other is not changed)."""
+        if self.count:
+            # The step from the last entry here to the first one of other
+            interval = other.first[0] - self.last[0]
+            self.used.add_step(interval, other.first[2] - self.last[2])
+            self.battery_drop.add_step(interval, self.last[1] - other.first[1])
+            # Combined mean and sum of squared deviations (Chan et al.)
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.squares += other.squares + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+            self.count = count
+        else:
+            self.count, self.mean, self.squares, self.first = other.count, other.mean, other.squares, other.first
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.last = other.last
+        self.noise.merge(other.noise)
+        self.used.merge(other.used)
+        self.battery_drop.merge(other.battery_drop)
+
+
+# Summaries of whole history chunks. Their entries never change, so each chunk is
+# summed up once; entries are dropped together with the chunk.
+_chunk_summaries = weakref.WeakKeyDictionary()
+
+
+# Evenly spaced indices in [first, last] for the response series
+def _thin_positions(first, last, points):
+    if last - first + 1 <= points:
+        return np.arange(first, last + 1)
+    return np.linspace(first, last, points).astype(np.int64)
+
+
+# One column of history entries [start, stop) as an array; a range inside one full chunk is not copied
+def _column(history, name, start, stop, dtype):
+    parts = [np.frombuffer(part, dtype=dtype) for part in history.column_parts(name, start, stop)]
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def history_stats(history, start, stop, window=30, points=500):
+    """Statistics over the history entries [start, stop) of a HistoryBuffer.
+
+    The entries are summed up chunk by chunk (see HistoryView.spans()); whole
+    chunks are only summed up once, so repeated calls mostly merge cached
+    summaries.
+    """
+    start, stop = max(start, 0), min(stop, len(history))
+    count = max(stop - start, 0)
+    result = {"count": count}
+    if not count:
+        return result
+
+    # The rolling series is only evaluated where it is returned. Usually the windows
+    # cover less than the whole timeframe and are taken span by span; otherwise
+    # they come from cumulative sums over all distances.
+    positions = _thin_positions(window - 1, count - 1, points) + start
+    rolling_ts = np.empty(len(positions))
+    per_window = len(positions) * window < count
+    windows = np.empty((len(positions), window)) if per_window else None
+    distances = []
+    before = np.zeros(0)  # The window - 1 distances before the current span
+    total = _Summary()
+    for first, last, chunk in history.spans(start, stop):
+        summary = _chunk_summaries.get(chunk) if chunk is not None else None
+        if summary is None:
+            summary = _Summary.of(history, first, last)
+            if chunk is not None:
+                _chunk_summaries[chunk] = summary
+        total.merge(summary)
+
+        distance = _column(history, "avg_distance", first, last, np.float64)
+        low, high = np.searchsorted(positions, (first, last))
+        if high > low:
+            indices = positions[low:high] - first
+            rolling_ts[low:high] = _column(history, "ts", first, last, np.float64)[indices]
+            if per_window:
+                if indices[0] < window - 1:
+                    # The first windows start in the spans before
+                    distance, indices = np.concatenate((before, distance)), indices + len(before)
+                windows[low:high] = distance[indices[:, None] - np.arange(window)]
+        if per_window and window > 1:
+            before = (distance if len(distance) >= window - 1 else np.concatenate((before, distance)))[1 - window:]
+        elif not per_window:
+            distances.append(distance)
+
+    if per_window:
+        rolling_mean, rolling_std = windows.mean(axis=1), windows.std(axis=1)
+    else:
+        rolling_mean, rolling_std = rolling_mean_std(np.concatenate(distances), window, positions - start)
+    result.update({
+        "from": float(total.first[0]),
+        "to": float(total.last[0]),
+        "avg_distance": {
+            "mean": float(total.mean),
+            "std": float(np.sqrt(total.squares / count)),
+            "min": float(total.min),
+            "max": float(total.max)
+        },
+        "rolling": {
+            "window": window,
+            "ts": rolling_ts.tolist() if len(rolling_mean) else [],
+            "mean": rolling_mean.tolist(),
+            "std": rolling_std.tolist()
+        },
+        "noise": total.noise.stats(),
+        "battery": {
+            "usedCapacityPerHour": total.used.rate(),
+            "percentageDropPerHour": total.battery_drop.rate(),
+            "latestPercentage": float(total.last[1])
+        }
+    })
+    return result
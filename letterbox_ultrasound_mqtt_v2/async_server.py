@@ -0,0 +1,314 @@
+# Single-process server on one asyncio event loop.
+#
+# Usage:
+#   pip install -e "..[async]"   (uvicorn and aiomqtt, see pyproject.toml)
+#   sudo python async_server.py --port 80
+#
+# The MQTT client (aiomqtt), the ingest queues, notification delivery, the
+# data and rollup file writers and the HTTP API are driven by tasks on the
+# event loop of an ASGI server, instead of a thread each. The Server-Sent
+# Events streams are served here, so an idle client only costs a queue and a
+# suspended task. All other routes go to the Flask app of
+# raspberry_pi_mqtt_server_v2.py, so they answer exactly as in the other
+# modes. Everything that touches the SD card runs in the loop's default
+# executor, so a slow write never stalls the streams: the ingest batches
+# (history appends and their fsync), the Flask requests (clearing the
+# history writes the log and the archive index), the file writes and the
+# webhook and push requests. The history loading at startup and the
+# compaction of the history log keep their background threads.
+#
+# So only the streams are really served on the loop: every other request
+# still takes an executor thread for as long as its handler runs. The
+# executor has EXECUTOR_WORKERS threads; beyond that, requests, ingest
+# batches and file writes wait for a free thread (in arrival order) instead
+# of starting more threads.
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ["LETTERBOX_ROLE"] = "async"
+import raspberry_pi_mqtt_server_v2 as server  # noqa: E402
+from event_stream import format_sse  # noqa: E402
+from notifications import MqttSink  # noqa: E402
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+logger = logging.getLogger("letterbox_server.async")
+
+MQTT_RECONNECT_MAX = 60  # Longest wait in seconds between connection attempts
+EXECUTOR_WORKERS = 8  # Threads for Flask requests, ingest batches, file writes and webhooks together
+DEVICE_STREAM_PATH = re.compile(r"^/api/devices/([^/]+)/stream$")
+
+# The parts of a paho message that on_message() uses
+_Message = namedtuple("_Message", "topic payload")
+_PublishInfo = namedtuple("_PublishInfo", "rc")
+
+
+class LoopPublisher:
+    """Stands in for the paho client of the MQTT notification sink.
+
+    publish() is called on the event loop by the sink; it schedules the
+    publish on the connected aiomqtt client and fails like paho while
+    there is no connection.
+    """
+
+    def __init__(self):
+        self.client = None
+        self._pending = set()
+
+    def publish(self, topic, payload):
+        if self.client is None:
+            return _PublishInfo(4)  # paho's MQTT_ERR_NO_CONN
+        task = asyncio.get_running_loop().create_task(self.client.publish(topic, payload))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return _PublishInfo(0)
+
+
+publisher = LoopPublisher()
+for sink in server.notification_dispatcher.sinks:
+    if isinstance(sink, MqttSink):
+        sink.client = publisher
+
+
+# Receive readings and hand them to the ingest queues; reconnects with backoff
+async def run_mqtt(ingest_wakeup):
+    delay = 1
+    while True:
+        connected = False
+        try:
+            async with aiomqtt.Client(server.MQTT_BROKER, server.MQTT_PORT, keepalive=60) as client:
+                connected = True
+                delay = 1
+                server.mqtt_connects.inc()
+                await client.subscribe([(server.MQTT_DATA_TOPIC, 0), (server.MQTT_DEVICE_DATA_TOPIC, 0)])
+                publisher.client = client
+                logger.info(f"Connected to MQTT broker at {server.MQTT_BROKER}:{server.MQTT_PORT}")
+                async for message in client.messages:
+                    server.on_message(None, None, _Message(message.topic.value, message.payload))
+                    ingest_wakeup.set()
+        except aiomqtt.MqttError as e:
+            if connected:
+                server.mqtt_disconnects.inc()
+            logger.error(f"MQTT connection to {server.MQTT_BROKER}:{server.MQTT_PORT} failed ({e}), retrying in {delay}s")
+        finally:
+            publisher.client = None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MQTT_RECONNECT_MAX)
+
+
+# Log a background task that ended with an error; it is not awaited until shutdown
+def report_crash(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Task {task.get_name()} stopped: {task.exception()!r}")
+
+
+tasks = []
+
+
+async def startup():
+    loop = asyncio.get_running_loop()
+    # Used by every run_in_executor(None, ...); asyncio would otherwise pick the size from the CPU count
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="letterbox-executor"))
+    ingest_wakeup = asyncio.Event()
+    # Stopped in this order at shutdown: no new readings, process the queued ones,
+    # deliver their notifications, then write the files
+    if aiomqtt is not None:
+        tasks.append(loop.create_task(run_mqtt(ingest_wakeup), name="mqtt"))
+    else:
+        logger.error("aiomqtt is not installed (pip install -e \"..[async]\"), serving the web interface without MQTT")
+    tasks.append(loop.create_task(server.ingest_pool.run_async(ingest_wakeup), name="ingest"))
+    tasks.append(loop.create_task(server.notification_dispatcher.run_async(), name="notifications"))
+    tasks.append(loop.create_task(server.data_writer.run_async(), name="data-writer"))
+    tasks.append(loop.create_task(server.rollup_writer.run_async(), name="rollup-writer"))
+    for task in tasks:
+        task.add_done_callback(report_crash)
+    logger.info("Async server started")
+
+
+async def shutdown():
+    for task in tasks:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    tasks.clear()
+    server.data_writer.stop()
+    server.rollup_writer.stop()
+    server.history_store.close()
+    logger.info("Async server stopped")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# Route and device of an SSE request (device None for the fleet stream), or (None, None)
+# for every other request, including streams of unknown devices (Flask answers 404)
+def stream_target(scope):
+    if scope["method"] != "GET":
+        return None, None
+    path = scope["path"]
+    if path == "/api/stream":
+        return path, server.default_device
+    if path == "/api/devices/stream":
+        return path, None
+    match = DEVICE_STREAM_PATH.match(path)
+    if match:
+        device = server.devices.get(match.group(1))
+        if device is not None:
+            return "/api/devices/<device_id>/stream", device
+    return None, None
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+# Same events as stream_response() of the Flask app, without a thread per client
+async def stream(receive, send, route, device):
+    loop = asyncio.get_running_loop()
+    server.http_responses.inc(route, "200")
+    client = server.event_broadcaster.subscribe(device.device_id if device else None, loop=loop)
+    disconnected = loop.create_task(wait_for_disconnect(receive))
+    try:
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no")
+        ]})
+        first = "retry: 5000\n\n"
+        if device is not None:
+            # Start with the current state so the client doesn't need an extra request
+            first += format_sse("data", json.dumps(device.data))
+        await send({"type": "http.response.body", "body": first.encode(), "more_body": True})
+        while True:
+            message = loop.create_task(client.get(server.STREAM_HEARTBEAT_INTERVAL))
+            await asyncio.wait((message, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if not message.done():
+                message.cancel()
+                return
+            try:
+                text = message.result()
+            except queue.Empty:
+                text = ": keepalive\n\n"
+            await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+    finally:
+        server.event_broadcaster.unsubscribe(client)
+        disconnected.cancel()
+
+
+# WSGI environ of an ASGI HTTP request (PEP 3333)
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+# Answer a request with the Flask app, in the default executor: some handlers
+# read the archive or the database, or write files. Waits for a free thread
+# while EXECUTOR_WORKERS of them are busy.
+async def call_flask(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    def respond():
+        result = server.app(wsgi_environ(scope, body), start_response)
+        try:
+            return b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    content = await asyncio.get_running_loop().run_in_executor(None, respond)
+    await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+    await send({"type": "http.response.body", "body": content})
+
+
+async def app(scope, receive, send):
+    """ASGI application: the letterbox server on the event loop of the ASGI server."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    route, device = stream_target(scope)
+    if route is not None:
+        await stream(receive, send, route, device)
+    else:
+        await call_flask(scope, receive, send)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the letterbox server on one asyncio event loop")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=80, help="HTTP port")
+    args = parser.parse_args()
+    if uvicorn is None:
+        sys.exit("async_server.py needs uvicorn and aiomqtt: pip install -e \"..[async]\"")
+    uvicorn.run(app, host=args.host, port=args.port, log_config=None, lifespan="on")
+
+
+if __name__ == "__main__":
+    main()
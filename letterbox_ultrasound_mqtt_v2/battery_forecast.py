@@ -0,0 +1,173 @@
+# Online battery runtime forecast of one letterbox.
+#
+# The firmware reports estimatedUsedCapacity, a counter in mAh that grows while
+# the box runs and starts again at 0 after a restart. Every reading updates two
+# estimates of its growth rate (the drain rate) in constant time, from the
+# previous reading and a few floats of state:
+#
+# - an exponentially weighted moving average of the rate between consecutive
+#   readings, with a time-based half-life. It is divided by the sum of its
+#   weights, so the first readings do not pull it towards their noise for hours.
+# - a recursive least-squares fit used = a + b * hours with exponential
+#   forgetting at the same half-life. The time origin moves to each new reading,
+#   so a is the fitted used capacity now and b the drain rate, and the numbers
+#   stay small however long the box runs. The residual variance times the
+#   slope entry of the covariance gives the standard error of b.
+#
+# Time to empty is the remaining capacity divided by the fitted rate; the
+# bounds use the rate plus and minus z standard errors.
+
+import math
+from collections import namedtuple
+
+# A drop of the counter by more than this (mAh) is a restart or a new battery
+RESET_TOLERANCE = 0.5
+
+# Initial covariance of the fit: the first reading pins a, the slope is unknown
+_INITIAL_COV = (1.0, 0.0, 1e6)
+
+# Everything estimate() needs, replaced as a whole on every update so readers
+# in other threads never see half an update
+ForecastState = namedtuple("ForecastState", "ts used rate rate_error smoothed_rate samples hours")
+
+
+class BatteryForecaster:
+    """Drain rate and time-to-empty of one letterbox, updated per reading in O(1).
+
+    last_seq is the sequence number of the newest history entry folded in, so
+    replaying the history log on top of a saved forecast skips what it already
+    contains (as for Rollups).
+    """
+
+    __slots__ = ("half_life", "z", "min_samples", "min_hours", "last_seq", "latest",
+                 "_ts", "_used", "_samples", "_hours", "_fit", "_cov", "_residual", "_rate_sum", "_rate_weight")
+
+    def __init__(self, half_life_hours=6.0, z=1.96, min_samples=6, min_hours=0.1):
+        self.half_life = half_life_hours
+        self.z = z
+        self.min_samples = min_samples
+        self.min_hours = min_hours
+        self.last_seq = 0
+        self._ts = None
+        self._used = 0.0
+        # Weighted sum of the rates and of their weights, kept across restarts of the counter
+        self._rate_sum = 0.0
+        self._rate_weight = 0.0
+        self._restart(None, 0.0)
+
+    # Start a new discharge at this reading
+    def _restart(self, ts, used):
+        self._ts = ts
+        self._used = used
+        self._samples = 0 if ts is None else 1
+        self._hours = 0.0
+        self._fit = (used, self._rate_sum / self._rate_weight if self._rate_weight else 0.0)
+        self._cov = _INITIAL_COV
+        self._residual = 0.0
+        self._publish()
+
+    def update(self, seq, ts, used):
+        """Fold in the used capacity (mAh) of the reading at ts (ignored if seq was already folded in)."""
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        if self._ts is None or used < self._used - RESET_TOLERANCE:
+            self._restart(ts, used)
+            return
+        hours = (ts - self._ts) / 3600.0
+        if hours <= 0:
+            return
+        decay = 0.5 ** (hours / self.half_life)  # Weight left for the older readings
+        if decay < 1e-9:
+            # After a gap of some 30 half-lives the older readings carry no weight; start over
+            self._rate_sum = self._rate_weight = 0.0
+            self._restart(ts, used)
+            return
+        weight = 1.0 - decay
+
+        # Moving average of the rate since the previous reading
+        self._rate_sum = decay * self._rate_sum + weight * (used - self._used) / hours
+        self._rate_weight = decay * self._rate_weight + weight
+
+        # Move the origin of the fit to this reading, forget, then correct with the new value
+        a, b = self._fit
+        p00, p01, p11 = self._cov
+        a += b * hours
+        p00 = (p00 + 2 * hours * p01 + hours * hours * p11) / decay
+        p01 = (p01 + hours * p11) / decay
+        p11 = p11 / decay
+        error = used - a
+        gain = 1.0 + p00
+        a += p00 / gain * error
+        b += p01 / gain * error
+        self._fit = (a, b)
+        self._cov = (p00 - p00 * p00 / gain, p01 - p00 * p01 / gain, p11 - p01 * p01 / gain)
+        self._residual = decay * self._residual + weight * error * error
+
+        self._ts = ts
+        self._used = used
+        self._samples += 1
+        self._hours += hours
+        self._publish()
+
+    def _publish(self):
+        ready = self._samples >= self.min_samples and self._hours >= self.min_hours
+        a, b = self._fit
+        self.latest = ForecastState(
+            self._ts, a if self._ts is not None else None,
+            b if ready else None,
+            math.sqrt(max(self._residual * self._cov[2], 0.0)) if ready else None,
+            self._rate_sum / self._rate_weight if self._rate_weight else None, self._samples, self._hours
+        )
+
+    def estimate(self, capacity):
+        """Drain rate and hours to empty with confidence bounds, for a battery of capacity mAh."""
+        state = self.latest
+        result = {
+            "updated": state.ts,
+            "samples": state.samples,
+            "usedCapacity": state.used,
+            "drainRate": state.rate,
+            "drainRateError": state.rate_error,
+            "smoothedDrainRate": state.smoothed_rate,
+            "hoursToEmpty": None,
+            "hoursToEmptyLow": None,
+            "hoursToEmptyHigh": None,
+            "emptyAt": None
+        }
+        if state.rate is None or not capacity or state.rate <= 0:
+            # Not enough readings yet, or not draining (e.g. on USB power)
+            return result
+        remaining = max(capacity - state.used, 0.0)
+        hours = remaining / state.rate
+        fastest = state.rate + self.z * state.rate_error
+        slowest = state.rate - self.z * state.rate_error
+        result.update({
+            "remainingCapacity": remaining,
+            "hoursToEmpty": hours,
+            "hoursToEmptyLow": remaining / fastest,
+            # None: the drain rate may be close to zero, no upper bound
+            "hoursToEmptyHigh": remaining / slowest if slowest > 0 else None,
+            "emptyAt": state.ts + hours * 3600.0
+        })
+        return result
+
+    def to_dict(self):
+        return {
+            "lastSeq": self.last_seq, "ts": self._ts, "used": self._used, "samples": self._samples,
+            "hours": self._hours, "fit": list(self._fit), "cov": list(self._cov), "residual": self._residual,
+            "rateSum": self._rate_sum, "rateWeight": self._rate_weight
+        }
+
+    def load_dict(self, saved):
+        self.last_seq = int(saved.get("lastSeq", 0))
+        self._ts = saved.get("ts")
+        self._used = float(saved.get("used", 0.0))
+        self._samples = int(saved.get("samples", 0))
+        self._hours = float(saved.get("hours", 0.0))
+        self._fit = tuple(saved.get("fit", (self._used, 0.0)))
+        self._cov = tuple(saved.get("cov", _INITIAL_COV))
+        self._residual = float(saved.get("residual", 0.0))
+        self._rate_sum = float(saved.get("rateSum", 0.0))
+        self._rate_weight = float(saved.get("rateWeight", 0.0))
+        self._publish()
@@ -0,0 +1,466 @@
+# End-to-end load test of the letterbox server with a simulated ESP32 fleet.
+#
+# Every simulated letterbox publishes the same JSON payload (or with --binary,
+# the binary one) as publishData() in letterbox_ultrasound_mqtt_v2.ino and now
+# and then gets a letter put in or taken out. The benchmark measures ingest
+# throughput, the latency from the publish of a level change to its NewLetter
+# notification, and the response times of /api/history, and writes them to a
+# JSON report. With --startup-history it first writes a history log of that many
+# readings and also measures the startup: the time until the first reading is
+# processed and until all history is loaded.
+#
+# Usage:
+#   python benchmark.py --devices 100 --interval 1 --duration 30
+#   python benchmark.py --binary                       (binary payload format)
+#   python benchmark.py --startup-history 1000000      (cold start with a long history)
+#   python benchmark.py --broker localhost:1883        (through a running Mosquitto)
+#   python benchmark.py --baseline old_report.json     (exit code 1 on regressions)
+#
+# The server runs in this process from a scratch copy of this directory, so the
+# benchmark never touches the real data and history files.
+
+import argparse
+import json
+import os
+import pathlib
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import logging
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import binary_payload
+from history_store import HistoryStore
+from rollups import ROLLUP_TIERS, Rollups
+
+script_dir = pathlib.Path(__file__).parent.absolute()
+
+# Firmware constants (see letterbox_ultrasound_mqtt_v2.ino)
+BATTERY_CAPACITY_MAH = 10000.0
+ESP32_AVG_CURRENT_MA = 80.0
+
+LETTER_DURATION_DROP = 700  # Echo time change of a letter, in microseconds (about 120 mm)
+
+# Files and directories that are not copied into the scratch server directory
+SCRATCH_IGNORE = shutil.ignore_patterns("history_segments", "__pycache__", "*.db*", "*.log",
+                                        "letterbox_data.json", "letterbox_history.json", "letterbox_rollups.json")
+
+# (report path, whether higher values are better) of the values compared with --baseline
+REGRESSION_CHECKS = (
+    (("ingest", "throughput"), True),
+    (("notifications", "latency", "p95"), False),
+    (("history", "latency", "p95"), False),
+    (("startup", "firstIngest"), False),
+)
+
+logger = logging.getLogger("letterbox_benchmark")
+
+
+# Arduino String(float) prints two decimals
+def _arduino_float(value):
+    return f"{value:.2f}"
+
+
+# The exact payload publishData() builds
+def firmware_payload(durations, millis, start_millis=0):
+    run_time_hours = (millis - start_millis) / 3600000.0
+    used_capacity = ESP32_AVG_CURRENT_MA * run_time_hours
+    remaining_capacity = BATTERY_CAPACITY_MAH - used_capacity
+    battery_percentage = max(0, min(100, int(remaining_capacity / BATTERY_CAPACITY_MAH * 100.0)))
+    remaining_time = remaining_capacity / ESP32_AVG_CURRENT_MA if remaining_capacity > 0 else 0
+    seconds = (millis // 1000) % 60
+    minutes = (millis // 60000) % 60
+    hours = (millis // 3600000) % 24
+    timestamp = f"{hours}:{minutes:02d}:{seconds:02d}"
+    return ("{\"durations\":[" + ",".join(str(duration) for duration in durations) + "]"
+            + ",\"batteryPercentage\":" + str(battery_percentage)
+            + ",\"batteryCapacity\":" + _arduino_float(BATTERY_CAPACITY_MAH)
+            + ",\"estimatedUsedCapacity\":" + _arduino_float(used_capacity)
+            + ",\"estimatedRemainingTime\":" + _arduino_float(remaining_time)
+            + ",\"runTimeHours\":" + _arduino_float(run_time_hours)
+            + ",\"powerSource\":\"USB Accumulator\""
+            + ",\"timestamp\":\"" + timestamp + "\"}")
+
+
+class SimulatedDevice:
+    """One ESP32 letterbox: a stable echo time with sensor noise and a letter now and then."""
+
+    def __init__(self, device_id, letter_interval, started, binary=False):
+        self.device_id = device_id
+        self.binary = binary
+        self.topic = f"letterbox/{device_id}/data"
+        self.letter_interval = letter_interval
+        self.started = started
+        self.millis_offset = random.randint(0, 3600000)  # Devices were switched on at different times
+        self.empty_duration = random.randint(8600, 8800)
+        self.letter = False
+        self.next_change = started + random.uniform(0.5, 1.0) * letter_interval if letter_interval else None
+
+    def reading(self, now, allow_change=True):
+        """Payload of a reading at monotonic time now, and whether it starts a new level."""
+        changed = False
+        if allow_change and self.next_change is not None and now >= self.next_change:
+            self.letter = not self.letter
+            self.next_change = now + self.letter_interval
+            changed = True
+        level = self.empty_duration - (LETTER_DURATION_DROP if self.letter else 0)
+        durations = [level + random.randint(-3, 3) for _ in range(3)]
+        millis = self.millis_offset + int((now - self.started) * 1000)
+        payload = firmware_payload(durations, millis, self.millis_offset)
+        if self.binary:
+            return binary_payload.encode(json.loads(payload), millis // 1000), changed
+        return payload.encode(), changed
+
+
+class _PublishInfo:
+    rc = 0
+
+
+class _Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class InProcessBroker:
+    """Stand-in for Mosquitto: delivers publishes synchronously to matching subscribers."""
+
+    def __init__(self):
+        self._subscriptions = []
+
+    def subscribe(self, topic_filter, callback):
+        self._subscriptions.append((topic_filter, callback))
+
+    def publish(self, topic, payload, *args, **kwargs):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        for topic_filter, callback in self._subscriptions:
+            if mqtt.topic_matches_sub(topic_filter, topic):
+                callback(None, None, _Message(topic, payload))
+        return _PublishInfo()
+
+
+# Write a history log of count readings (10 s apart, spread over device_ids) and the
+# rollups that include them, as a server that ran for a while leaves them behind
+def write_startup_history(workdir, count, device_ids):
+    store = HistoryStore(os.path.join(workdir, "history_segments"), retention_records=count)
+    rollups = {device_id: Rollups({name: 10 ** 7 for name, _ in ROLLUP_TIERS}) for device_id in device_ids}
+    first_ts = time.time() - 10.0 * count / len(device_ids)
+    batch = []
+    for i in range(count):
+        device_id = device_ids[i % len(device_ids)]
+        seq = i // len(device_ids) + 1
+        ts = first_ts + 10.0 * seq
+        distance = 150.0 + random.uniform(-0.5, 0.5)
+        battery = max(100.0 - 0.001 * seq, 0.0)
+        rollups[device_id].add(seq, ts, distance, battery)
+        batch.append({"device": device_id, "seq": seq, "ts": ts, "durations": [8700, 8701, 8699],
+                      "avg_distance": distance, "batteryPercentage": battery, "estimatedUsedCapacity": 0.0})
+        if len(batch) == 1000:
+            store.append_many(batch)
+            batch = []
+    store.append_many(batch)
+    store.close()
+    with open(os.path.join(workdir, "letterbox_rollups.json"), 'w') as f:
+        json.dump({"devices": {device_id: device_rollups.to_dict() for device_id, device_rollups in rollups.items()}}, f)
+
+
+# Import the server from a scratch copy of this directory
+def load_server(workdir):
+    shutil.copytree(script_dir, workdir, ignore=SCRATCH_IGNORE, dirs_exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, str(workdir))
+    import raspberry_pi_mqtt_server_v2 as server
+    # One log line per message would dominate the measurement
+    logging.getLogger("letterbox_server").setLevel(logging.WARNING)
+    return server
+
+
+def percentiles(values):
+    """Summary of latencies in seconds, reported in milliseconds."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(fraction):
+        return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * 1000, 3)
+    }
+
+
+class LatencyTracker:
+    """Matches NewLetter notifications with the publish time of the level change that caused them."""
+
+    def __init__(self):
+        self._pending = {}  # device -> deque of publish times of level changes
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.expected = 0
+        self.unexpected = 0
+
+    def level_changed(self, device_id, published_at):
+        with self._lock:
+            self._pending.setdefault(device_id, deque()).append(published_at)
+            self.expected += 1
+
+    def on_notification(self, client, userdata, msg, properties=None):
+        received_at = time.monotonic()
+        try:
+            notification = json.loads(msg.payload)
+        except ValueError:
+            return
+        with self._lock:
+            pending = self._pending.get(notification.get("device"))
+            if not pending:
+                self.unexpected += 1
+                return
+            # A coalesced notification covers several level changes; measure from the first
+            published_at = pending.popleft()
+            for _ in range(notification.get("events", 1) - 1):
+                if pending:
+                    pending.popleft()
+            self.latencies.append(received_at - published_at)
+
+
+def publish_loop(devices, publish, tracker, interval, duration):
+    """Publish a reading of every device each interval seconds, spread evenly; returns the publish count."""
+    started = time.monotonic()
+    # The detector needs a few readings to confirm a change; no new letters right before the end
+    last_change = duration - 3 * interval
+    spacing = interval / len(devices)
+    published = 0
+    tick = 0
+    while True:
+        due = started + tick * spacing
+        if due - started >= duration:
+            return published
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        device = devices[tick % len(devices)]
+        now = time.monotonic()
+        payload, changed = device.reading(now, due - started < last_change)
+        if changed:
+            tracker.level_changed(device.device_id, now)
+        publish(device.topic, payload)
+        published += 1
+        tick += 1
+
+
+def history_loop(server, devices, query, interval, stop_event, timings):
+    client = server.app.test_client()
+    while not stop_event.wait(interval):
+        device = random.choice(devices)
+        started = time.perf_counter()
+        response = client.get(f"/api/devices/{device.device_id}/history?{query}")
+        response.get_data()
+        timings.append(time.perf_counter() - started)
+
+
+def wait_for_ingest(server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = server.ingest_pool.stats()
+        if stats["processed"] >= stats["enqueued"] - stats["dropped"]:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+# Names of the report values that got worse than the baseline by more than tolerance
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    for path, higher_is_better in REGRESSION_CHECKS:
+        current, previous = report, baseline
+        for key in path:
+            current = current.get(key, {}) if isinstance(current, dict) else None
+            previous = previous.get(key, {}) if isinstance(previous, dict) else None
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            continue
+        change = (current - previous) / previous
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append({"metric": ".".join(path), "baseline": previous, "current": current,
+                                "change": round(change, 3)})
+    return regressions
+
+
+# Time from the import of the server until a first reading is processed, and until
+# the older history has been loaded in the background
+def measure_startup(server, publish, device, import_started, timeout=600.0):
+    payload, _ = device.reading(time.monotonic(), allow_change=False)
+    publish(device.topic, payload)
+    wait_for_ingest(server, timeout)
+    first_ingest = time.monotonic() - import_started
+    loaded = server.history_loaded.wait(timeout)
+    return {
+        "firstIngest": round(first_ingest, 3),
+        "historyLoaded": round(time.monotonic() - import_started, 3) if loaded else None,
+        "historyEntries": sum(len(state.history) for state in server.devices),
+        "server": {phase: round(seconds, 3) for phase, seconds in server.startup_timings.items()}
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="letterbox-benchmark-")
+    device_ids = [f"bench-{i:05d}" for i in range(args.devices)]
+    if args.startup_history:
+        # The copy of the server files leaves these alone (SCRATCH_IGNORE)
+        write_startup_history(workdir, args.startup_history, device_ids)
+    import_started = time.monotonic()
+    server = load_server(workdir)
+    if args.coalesce_window is not None:
+        server.notification_dispatcher.coalesce_window = args.coalesce_window
+
+    tracker = LatencyTracker()
+    clients = []
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        server.MQTT_BROKER, server.MQTT_PORT = host, int(port or 1883)
+        server.start_mqtt_client()
+        listener = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        listener.on_message = tracker.on_notification
+        listener.connect(server.MQTT_BROKER, server.MQTT_PORT)
+        listener.subscribe(server.MQTT_NOTIFICATION_TOPIC)
+        listener.loop_start()
+        publisher = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        publisher.connect(server.MQTT_BROKER, server.MQTT_PORT)
+        publisher.loop_start()
+        clients = [listener, publisher]
+        publish = publisher.publish
+        time.sleep(1.0)  # Let the subscriptions settle
+    else:
+        broker = InProcessBroker()
+        broker.subscribe(server.MQTT_DATA_TOPIC, server.on_message)
+        broker.subscribe(server.MQTT_DEVICE_DATA_TOPIC, server.on_message)
+        broker.subscribe(server.MQTT_NOTIFICATION_TOPIC, tracker.on_notification)
+        # The MQTT notification sink publishes through the server's client
+        server.mqtt_client.publish = broker.publish
+        publish = broker.publish
+
+    started = time.monotonic()
+    devices = [SimulatedDevice(device_id, args.letter_interval, started, args.binary) for device_id in device_ids]
+    startup = measure_startup(server, publish, devices[0], import_started)
+    stop_event = threading.Event()
+    history_timings = []
+    history_thread = threading.Thread(target=history_loop, daemon=True,
+                                      args=(server, devices, args.history_query, args.history_interval,
+                                            stop_event, history_timings))
+    history_thread.start()
+
+    ingest_before = server.ingest_pool.stats()
+    published = publish_loop(devices, publish, tracker, args.interval, args.duration)
+    publish_seconds = time.monotonic() - started
+    drained = wait_for_ingest(server, timeout=60.0)
+    ingest_seconds = time.monotonic() - started
+    stop_event.set()
+    history_thread.join()
+    # Give the last notifications time to pass the coalescing window
+    time.sleep(server.notification_dispatcher.coalesce_window + 1.0)
+
+    ingest_after = server.ingest_pool.stats()
+    processed = ingest_after["processed"] - ingest_before["processed"]
+    report = {
+        "config": {
+            "devices": args.devices,
+            "interval": args.interval,
+            "duration": args.duration,
+            "letterInterval": args.letter_interval,
+            "broker": args.broker or "in-process",
+            "payload": "binary" if args.binary else "json",
+            "historyQuery": args.history_query,
+            "coalesceWindow": server.notification_dispatcher.coalesce_window,
+            "historyBackend": server.HISTORY_BACKEND
+        },
+        "ingest": {
+            "published": published,
+            "publishRate": round(published / publish_seconds, 1),
+            "processed": processed,
+            "dropped": ingest_after["dropped"] - ingest_before["dropped"],
+            "drained": drained,
+            "throughput": round(processed / ingest_seconds, 1),
+            "maxLagMs": round(ingest_after["maxLag"] * 1000, 3)
+        },
+        "notifications": {
+            "expected": tracker.expected,
+            "received": len(tracker.latencies),
+            "unexpected": tracker.unexpected,
+            "latency": percentiles(tracker.latencies)
+        },
+        "history": {
+            "requests": len(history_timings),
+            "latency": percentiles(history_timings)
+        },
+        "startup": dict(startup, historyRecords=args.startup_history)
+    }
+
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+    if args.broker:
+        server.mqtt_client.loop_stop()
+        server.mqtt_client.disconnect()
+    # Shut the server down in the same order as its atexit handlers before removing its files
+    server.ingest_pool.stop()
+    server.notification_dispatcher.stop()
+    server.rollup_writer.stop()
+    server.data_writer.stop()
+    server.history_store.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the letterbox server with simulated ESP32 devices")
+    parser.add_argument("--devices", type=int, default=100, help="Number of simulated letterboxes")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between readings of one device")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to publish readings")
+    parser.add_argument("--letter-interval", type=float, default=15.0,
+                        help="Seconds between letter events of one device (0 disables them)")
+    parser.add_argument("--binary", action="store_true", help="Publish the binary payload format instead of JSON")
+    parser.add_argument("--broker", help="host[:port] of an MQTT broker; default is an in-process stand-in")
+    parser.add_argument("--history-query", default="timeframe=1h&points=500")
+    parser.add_argument("--history-interval", type=float, default=0.1, help="Seconds between /api/history requests")
+    parser.add_argument("--startup-history", type=int, default=0,
+                        help="Readings in the history log at startup (spread over the devices)")
+    parser.add_argument("--coalesce-window", type=float, help="Override NOTIFICATION_COALESCE_WINDOW")
+    parser.add_argument("--report", default="benchmark_report.json", help="Where to write the JSON report")
+    parser.add_argument("--baseline", help="Earlier report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative change against the baseline")
+    args = parser.parse_args()
+    args.report = os.path.abspath(args.report)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    report = run(args)
+
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        report["regressions"] = find_regressions(report, baseline, args.tolerance)
+        for regression in report["regressions"]:
+            logger.error(f"Regression in {regression['metric']}: {regression['baseline']} -> {regression['current']}")
+        exit_code = 1 if report["regressions"] else 0
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Report written to {args.report}")
+    print(json.dumps(report, indent=2))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# Compact binary sensor payload, sent by the firmware when BINARY_PAYLOAD is set.
+#
+# Version 1 is a fixed little-endian struct of 36 bytes (JSON is about 230):
+#
+#   offset  type        field
+#        0  uint8       magic (0xB1; JSON payloads start with "{")
+#        1  uint8       version (1)
+#        2  uint8       flags (bit 0: powered by the USB accumulator)
+#        3  uint8       batteryPercentage
+#        4  uint32[3]   durations (echo times in microseconds)
+#       16  float32     batteryCapacity (mAh)
+#       20  float32     estimatedUsedCapacity (mAh)
+#       24  float32     estimatedRemainingTime (hours)
+#       28  float32     runTimeHours
+#       32  uint32      uptime in seconds (the "timestamp" of the JSON format)
+#
+# decode() returns the same dict as json.loads() of the JSON payload, so
+# everything after decoding is shared between both formats.
+
+import struct
+
+MAGIC = 0xB1
+FLAG_USB_POWER = 0x01
+
+_HEADER = struct.Struct("<BB")
+_LAYOUTS = {
+    1: struct.Struct("<BBBB3IffffI")
+}
+
+
+def is_binary(raw):
+    return len(raw) > 0 and raw[0] == MAGIC
+
+
+# "H:MM:SS" of an uptime, like the firmware formats millis() (hours wrap at 24)
+def _uptime_timestamp(seconds):
+    return f"{(seconds // 3600) % 24}:{(seconds // 60) % 60:02d}:{seconds % 60:02d}"
+
+
+def decode(raw):
+    """Payload dict of a binary message; raises ValueError if it is malformed."""
+    view = memoryview(raw)
+    if len(view) < _HEADER.size:
+        raise ValueError(f"Binary payload too short ({len(view)} bytes)")
+    magic, version = _HEADER.unpack_from(view)
+    layout = _LAYOUTS.get(version)
+    if magic != MAGIC or layout is None:
+        raise ValueError(f"Unsupported binary payload (magic 0x{magic:02X}, version {version})")
+    if len(view) < layout.size:
+        raise ValueError(f"Binary payload version {version} needs {layout.size} bytes, got {len(view)}")
+    # Newer firmware may append fields; a known version only reads its own prefix
+    (_, _, flags, battery_percentage, d0, d1, d2, capacity, used_capacity,
+     remaining_time, run_time_hours, uptime) = layout.unpack_from(view)
+    return {
+        "durations": [d0, d1, d2],
+        "batteryPercentage": battery_percentage,
+        "batteryCapacity": round(capacity, 2),
+        "estimatedUsedCapacity": round(used_capacity, 2),
+        "estimatedRemainingTime": round(remaining_time, 2),
+        "runTimeHours": round(run_time_hours, 2),
+        "powerSource": "USB Accumulator" if flags & FLAG_USB_POWER else "Battery",
+        "timestamp": _uptime_timestamp(uptime)
+    }
+
+
+def encode(payload, uptime_seconds=0, version=1):
+    """Binary message of a payload dict (what the firmware sends; used by benchmark.py)."""
+    durations = list(payload.get("durations") or [])[:3]
+    durations += [0] * (3 - len(durations))
+    flags = FLAG_USB_POWER if payload.get("powerSource", "USB Accumulator") == "USB Accumulator" else 0
+    return _LAYOUTS[version].pack(
+        MAGIC, version, flags, max(0, min(100, int(payload.get("batteryPercentage", 0)))),
+        *(max(0, int(duration)) for duration in durations),
+        float(payload.get("batteryCapacity", 0)),
+        float(payload.get("estimatedUsedCapacity", 0)),
+        float(payload.get("estimatedRemainingTime", 0)),
+        float(payload.get("runTimeHours", 0)),
+        int(uptime_seconds)
+    )
@@ -0,0 +1,225 @@
+# Incremental letter detectors.
+#
+# A detector gets the average distance of every reading through update() and
+# returns a LetterEvent when it decides that something was put into or taken
+# out of the letterbox. Every update takes constant time and every detector
+# keeps a constant amount of state, so one instance per device is cheap.
+
+from collections import deque, namedtuple
+
+# kind is "arrived" (distance decreased) or "removed" (distance increased)
+LetterEvent = namedtuple("LetterEvent", ["kind", "previous", "current", "difference"])
+
+
+def _event(previous, current):
+    difference = current - previous
+    return LetterEvent("arrived" if difference < 0 else "removed", previous, current, difference)
+
+
+class ThresholdDetector:
+    """Reports a change whenever a reading differs from the previous one by more than threshold."""
+
+    __slots__ = ("threshold", "baseline")
+
+    def __init__(self, threshold=5.0):
+        self.threshold = threshold
+        self.baseline = 0
+
+    def prime(self, value):
+        self.baseline = value
+
+    def update(self, value):
+        # Skip if this is the first measurement
+        if self.baseline == 0:
+            self.baseline = value
+            return None
+        previous = self.baseline
+        self.baseline = value
+        if abs(value - previous) > self.threshold:
+            return _event(previous, value)
+        return None
+
+
+class HysteresisDetector:
+    """Reports a change only after confirm readings in a row left the band around the last level
+    on the same side.
+
+    Single outliers are ignored, and the reference level only moves when a
+    change is confirmed, so slow drift below the threshold adds up until it is
+    reported once.
+    """
+
+    __slots__ = ("threshold", "confirm", "baseline", "_pending", "_pending_sum", "_direction")
+
+    def __init__(self, threshold=5.0, confirm=2):
+        self.threshold = threshold
+        self.confirm = confirm
+        self.baseline = 0
+        self._pending = 0
+        self._pending_sum = 0.0
+        self._direction = 0
+
+    def prime(self, value):
+        self.baseline = value
+        self._pending = 0
+        self._pending_sum = 0.0
+        self._direction = 0
+
+    def update(self, value):
+        if self.baseline == 0:
+            self.prime(value)
+            return None
+        if abs(value - self.baseline) <= self.threshold:
+            self._pending = 0
+            self._pending_sum = 0.0
+            return None
+        direction = 1 if value > self.baseline else -1
+        if direction != self._direction:
+            # Noise on both sides of the band is no change; start counting again
+            self._pending = 0
+            self._pending_sum = 0.0
+            self._direction = direction
+        self._pending += 1
+        self._pending_sum += value
+        if self._pending < self.confirm:
+            return None
+        # New level is the mean of the readings that confirmed it
+        level = self._pending_sum / self._pending
+        event = _event(self.baseline, level)
+        self.prime(level)
+        return event
+
+
+class CusumDetector:
+    """Two-sided CUSUM change-point detector.
+
+    Deviations from the reference level minus an allowed drift are summed up
+    per direction; a change is reported when one sum exceeds threshold. While
+    nothing changes, the reference follows the readings slowly (alpha).
+    """
+
+    __slots__ = ("threshold", "drift", "alpha", "baseline", "_high", "_low", "_started")
+
+    def __init__(self, threshold=20.0, drift=5.0, alpha=0.05):
+        self.threshold = threshold
+        self.drift = drift
+        self.alpha = alpha
+        self.baseline = 0
+        self._high = 0.0
+        self._low = 0.0
+        self._started = False
+
+    def prime(self, value):
+        self.baseline = value
+        self._high = 0.0
+        self._low = 0.0
+        self._started = value != 0
+
+    def update(self, value):
+        if not self._started:
+            self.prime(value)
+            return None
+        deviation = value - self.baseline
+        self._high = max(0.0, self._high + deviation - self.drift)
+        self._low = max(0.0, self._low - deviation - self.drift)
+        if self._high > self.threshold or self._low > self.threshold:
+            event = _event(self.baseline, value)
+            self.prime(value)
+            return event
+        if self._high == 0.0 and self._low == 0.0:
+            self.baseline += self.alpha * deviation
+        return None
+
+
+class PageHinkleyDetector:
+    """Two-sided Page-Hinkley test on the running mean of the readings.
+
+    delta is the tolerated deviation per reading and threshold (lambda) the
+    accumulated deviation that counts as a change.
+    """
+
+    __slots__ = ("threshold", "delta", "baseline", "_count", "_mean",
+                 "_up", "_up_min", "_down", "_down_max")
+
+    def __init__(self, threshold=30.0, delta=2.0):
+        self.threshold = threshold
+        self.delta = delta
+        self.prime(0)
+
+    def prime(self, value):
+        self.baseline = value
+        self._count = 1 if value else 0
+        self._mean = value
+        self._up = self._up_min = 0.0
+        self._down = self._down_max = 0.0
+
+    def update(self, value):
+        if self._count == 0:
+            self.prime(value)
+            return None
+        self._count += 1
+        self._mean += (value - self._mean) / self._count
+        self._up += value - self._mean - self.delta
+        self._up_min = min(self._up_min, self._up)
+        self._down += value - self._mean + self.delta
+        self._down_max = max(self._down_max, self._down)
+        if self._up - self._up_min > self.threshold or self._down_max - self._down > self.threshold:
+            event = _event(self.baseline, value)
+            self.prime(value)
+            return event
+        self.baseline = self._mean
+        return None
+
+
+class MedianFilter:
+    """Feeds the median of the last window readings into another detector.
+
+    Removes single-reading spikes (echo dropouts of the HC-SR04) before they
+    reach the detector. The window is small and fixed, so sorting it is O(1).
+    """
+
+    __slots__ = ("detector", "_values")
+
+    def __init__(self, detector, window=5):
+        self.detector = detector
+        self._values = deque(maxlen=window)
+
+    @property
+    def baseline(self):
+        return self.detector.baseline
+
+    def prime(self, value):
+        self._values.clear()
+        self._values.append(value)
+        self.detector.prime(value)
+
+    def update(self, value):
+        self._values.append(value)
+        ordered = sorted(self._values)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            median = ordered[middle]
+        else:
+            median = (ordered[middle - 1] + ordered[middle]) / 2
+        return self.detector.update(median)
+
+
+DETECTORS = {
+    "threshold": ThresholdDetector,
+    "hysteresis": HysteresisDetector,
+    "cusum": CusumDetector,
+    "page-hinkley": PageHinkleyDetector,
+}
+
+
+def create_detector(config):
+    """Build a detector from a config dict like {"type": "cusum", "threshold": 15, "median_window": 5}."""
+    options = dict(config)
+    detector_type = options.pop("type", "threshold")
+    median_window = options.pop("median_window", 1)
+    if detector_type not in DETECTORS:
+        raise ValueError(f"Unknown letter detector '{detector_type}'")
+    detector = DETECTORS[detector_type](**options)
+    if median_window and median_window > 1:
+        detector = MedianFilter(detector, median_window)
+    return detector
@@ -0,0 +1,18 @@
+# Letter detection settings, shared by the server and replay.py (which must not import
+# the server, as that starts it).
+
+LETTER_DETECTION_THRESHOLD = 5  # 5mm threshold for letter detection
+
+# Letter detector used for every device. "type" is one of
+#   "threshold"    - change against the previous reading (threshold)
+#   "hysteresis"   - change must hold for several readings (threshold, confirm)
+#   "cusum"        - two-sided CUSUM change-point test (threshold, drift, alpha)
+#   "page-hinkley" - Page-Hinkley change-point test (threshold, delta)
+# "median_window" > 1 runs the readings through a median filter first. 1 keeps the original
+# behaviour; 3 ignores single-reading spikes, but a change is then reported one reading later
+# and a letter seen in only one reading is not reported at all.
+LETTER_DETECTOR = {
+    "type": "threshold",
+    "threshold": LETTER_DETECTION_THRESHOLD,
+    "median_window": 1
+}
@@ -0,0 +1,152 @@
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+# Device that publishes on the old single-box topic "letterbox/data"
+DEFAULT_DEVICE_ID = "default"
+
+# Device IDs come from MQTT topics and end up in URLs and file names
+DEVICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def is_valid_device_id(device_id):
+    return bool(DEVICE_ID_PATTERN.match(device_id or ""))
+
+
+# Current data of a letterbox that hasn't reported yet
+def new_device_data():
+    return {
+        "durations": [0, 0, 0],  # Array of 3 duration measurements
+        "distances": [0, 0, 0],  # Array of 3 distance measurements (calculated from durations)
+        "batteryPercentage": 0,
+        "batteryCapacity": 10000,
+        "estimatedUsedCapacity": 0,
+        "estimatedRemainingTime": 0,
+        "runTimeHours": 0,
+        "powerSource": "USB Accumulator",
+        "timestamp": "Never",
+        "lastUpdateTime": "Never"
+    }
+
+
+# What API requests read of a device: current data and a view of the history,
+# with the versions and times for ETag / Last-Modified handling. Never modified;
+# the ingest side publishes a new one for every change.
+DeviceSnapshot = namedtuple("DeviceSnapshot",
+                            "data data_version data_modified history history_version history_modified")
+
+
+class DeviceState:
+    """Current data, history, rollups and letter detection baseline of one letterbox.
+
+    Only the ingest side writes. It publishes every change as a new
+    DeviceSnapshot with a single reference assignment, so a request that
+    reads device.snapshot once sees data, history and versions that belong
+    together, without a lock and without waiting for the ingest workers.
+    Writers (the ingest worker of the device, the background history loader
+    and clears) hold lock while they change the history, the rollups or the
+    forecast and while they publish a snapshot, so no change is lost between
+    reading the old snapshot and publishing the new one. Rollups and forecast
+    are not part of the snapshot (copying them per reading would be too slow);
+    readers in other threads copy them under lock.
+    """
+
+    __slots__ = ("device_id", "history", "rollups", "detector", "forecast", "snapshot", "lock")
+
+    def __init__(self, device_id, history, rollups, detector, forecast):
+        self.device_id = device_id
+        self.history = history  # Written by the ingest side only; readers use snapshot.history
+        self.rollups = rollups
+        self.detector = detector
+        self.forecast = forecast
+        self.lock = threading.Lock()
+        now = datetime.now()
+        self.snapshot = DeviceSnapshot(new_device_data(), 0, now, history.snapshot(), 0, now)
+
+    @property
+    def data(self):
+        return self.snapshot.data
+
+    @property
+    def data_version(self):
+        return self.snapshot.data_version
+
+    @property
+    def history_version(self):
+        return self.snapshot.history_version
+
+    def set_data(self, data):
+        """Publish new current data; the dict must not be modified afterwards."""
+        with self.lock:
+            snapshot = self.snapshot
+            self.snapshot = snapshot._replace(data=data, data_version=snapshot.data_version + 1,
+                                              data_modified=datetime.now())
+
+    def mark_history_changed(self):
+        """Publish the current state of the history buffer (the caller holds lock)."""
+        snapshot = self.snapshot
+        self.snapshot = snapshot._replace(history=self.history.snapshot(),
+                                          history_version=snapshot.history_version + 1,
+                                          history_modified=datetime.now())
+
+    def summary(self):
+        """Short status for the fleet overview."""
+        snapshot = self.snapshot
+        data = snapshot.data
+        distances = data.get("distances") or [0]
+        return {
+            "device": self.device_id,
+            "lastUpdateTime": data.get("lastUpdateTime"),
+            "lastModified": snapshot.data_modified.strftime("%Y-%m-%d %H:%M:%S"),
+            "avg_distance": sum(distances) / len(distances),
+            "batteryPercentage": data.get("batteryPercentage"),
+            "estimatedRemainingTime": data.get("estimatedRemainingTime"),
+            "historyEntries": len(snapshot.history),
+            "rollupMinutes": len(self.rollups),
+            "lastSeq": snapshot.history.last_seq,
+            "batteryForecast": self.forecast.estimate(data.get("batteryCapacity"))
+        }
+
+
+class DeviceRegistry:
+    """All known letterboxes by device ID.
+
+    Lookups are plain dict accesses. New devices are only created by the
+    ingest side; readers never block on the lock.
+    """
+
+    def __init__(self, history_factory, rollups_factory, detector_factory, forecast_factory, max_devices=10000):
+        self.history_factory = history_factory
+        self.rollups_factory = rollups_factory
+        self.detector_factory = detector_factory
+        self.forecast_factory = forecast_factory
+        self.max_devices = max_devices
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        return iter(list(self._devices.values()))
+
+    def get(self, device_id):
+        return self._devices.get(device_id)
+
+    def get_or_create(self, device_id):
+        """Return the device, creating it on first contact (None if the ID is invalid or the fleet is full)."""
+        device = self._devices.get(device_id)
+        if device is not None:
+            return device
+        if not is_valid_device_id(device_id):
+            return None
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                if len(self._devices) >= self.max_devices:
+                    return None
+                device = DeviceState(device_id, self.history_factory(), self.rollups_factory(),
+                                     self.detector_factory(), self.forecast_factory())
+                self._devices[device_id] = device
+        return device
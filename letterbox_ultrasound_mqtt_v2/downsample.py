@@ -0,0 +1,73 @@
+# Downsampling of history series for the dashboard charts.
+#
+# Both functions return sorted indices into the input columns, so the caller
+# can build the reduced response from whatever fields it needs.
+
+
+# Keep the minimum and the maximum of every bucket. Short spikes (a letter
+# dropping in and being taken out again) always survive.
+def minmax_indices(values, target):
+    count = len(values)
+    if target <= 0 or count <= target:
+        return list(range(count))
+    buckets = max(target // 2, 1)
+    bucket_size = count / buckets
+    indices = []
+    for bucket in range(buckets):
+        start = int(bucket * bucket_size)
+        stop = min(int((bucket + 1) * bucket_size), count)
+        if start >= stop:
+            continue
+        bucket_range = range(start, stop)
+        low = min(bucket_range, key=values.__getitem__)
+        high = max(bucket_range, key=values.__getitem__)
+        if low == high:
+            indices.append(low)
+        else:
+            indices.extend(sorted((low, high)))
+    return indices
+
+
+# Largest-Triangle-Three-Buckets: pick the point of every bucket that spans
+# the largest triangle with the previously picked point and the average of
+# the next bucket.
+def lttb_indices(xs, ys, target):
+    count = len(ys)
+    if target < 3 or count <= target:
+        return list(range(count))
+    bucket_size = (count - 2) / (target - 2)
+    indices = [0]
+    previous = 0
+    for bucket in range(target - 2):
+        start = int(bucket * bucket_size) + 1
+        stop = int((bucket + 1) * bucket_size) + 1
+
+        # Average point of the next bucket
+        next_start = stop
+        next_stop = min(max(int((bucket + 2) * bucket_size) + 1, next_start + 1), count)
+        next_count = next_stop - next_start
+        avg_x = sum(xs[next_start:next_stop]) / next_count
+        avg_y = sum(ys[next_start:next_stop]) / next_count
+
+        prev_x, prev_y = xs[previous], ys[previous]
+        best_area = -1.0
+        best_index = start
+        for index in range(start, stop):
+            area = abs((prev_x - avg_x) * (ys[index] - prev_y) - (prev_x - xs[index]) * (avg_y - prev_y))
+            if area > best_area:
+                best_area = area
+                best_index = index
+        indices.append(best_index)
+        previous = best_index
+    indices.append(count - 1)
+    return indices
+
+
+DOWNSAMPLE_METHODS = ("minmax", "lttb")
+
+
+# Downsample the (ts, value) series to about target points with the given method
+def downsample_indices(ts, values, target, method="minmax"):
+    if method == "lttb":
+        return lttb_indices(ts, values, target)
+    return minmax_indices(values, target)
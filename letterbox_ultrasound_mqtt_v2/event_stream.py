@@ -0,0 +1,104 @@
+import asyncio
+import json
+import queue
+import threading
+from collections import deque
+
+
+# Format one Server-Sent Events message
+def format_sse(event, data):
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class AsyncClientQueue:
+    """Client queue of an SSE connection served on an asyncio event loop.
+
+    Has the put_nowait()/get_nowait() of queue.Queue that publish() uses, so
+    it can be fed from the loop and from other threads; the connection waits
+    for messages with get() without blocking the loop.
+    """
+
+    def __init__(self, maxsize, loop):
+        self.maxsize = maxsize
+        self._loop = loop
+        self._loop_thread = threading.get_ident()  # Created by the connection, on the loop
+        self._messages = deque()
+        self._ready = asyncio.Event()
+
+    def put_nowait(self, message):
+        if len(self._messages) >= self.maxsize:
+            raise queue.Full
+        self._messages.append(message)
+        if threading.get_ident() == self._loop_thread:
+            self._ready.set()
+        else:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def get_nowait(self):
+        try:
+            return self._messages.popleft()
+        except IndexError:
+            raise queue.Empty from None
+
+    async def get(self, timeout):
+        """Next message; raises queue.Empty if none arrives within timeout seconds."""
+        while not self._messages:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise queue.Empty from None
+        return self._messages.popleft()
+
+
+class EventBroadcaster:
+    """Fans server events out to all connected /api/stream clients.
+
+    Every client gets its own bounded queue. An event is serialized once and
+    put into all queues without blocking; a client that is too slow to keep
+    up loses its oldest queued events instead of holding up ingest. Clients
+    can subscribe to a single device or (with device_id None) to all of them.
+    """
+
+    def __init__(self, client_queue_size=100):
+        self.client_queue_size = client_queue_size
+        self._lock = threading.Lock()
+        self._clients = {}  # client queue -> device ID filter
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def subscribe(self, device_id=None, loop=None):
+        """Queue of the events for a new client; an AsyncClientQueue on loop, if given."""
+        if loop is not None:
+            client = AsyncClientQueue(self.client_queue_size, loop)
+        else:
+            client = queue.Queue(maxsize=self.client_queue_size)
+        with self._lock:
+            self._clients[client] = device_id
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.pop(client, None)
+
+    def publish(self, event, payload, device_id=None):
+        if not self._clients:
+            return
+        with self._lock:
+            clients = [client for client, wanted in self._clients.items()
+                       if wanted is None or wanted == device_id]
+        if not clients:
+            return
+        message = format_sse(event, json.dumps(payload))
+        for client in clients:
+            while True:
+                try:
+                    client.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        client.get_nowait()
+                    except queue.Empty:
+                        pass
@@ -0,0 +1,269 @@
+# Cold history: readings that left the history log, compressed in day chunks.
+#
+# Each device has an index file (<device>.idx) and a data file
+# (<device>-<generation>.dat) of appended chunks. A chunk holds the readings
+# of one device from one UTC day as integer columns: seq, ts in milliseconds,
+# the three durations, and avg_distance, battery and used capacity in
+# hundredths. Every column is delta-encoded, stored in the narrowest array
+# type its deltas fit and zlib-compressed with the others, so a day at 10 s
+# intervals takes a few kilobytes. The index lists day, time range, offset and
+# length of every chunk, so a range read only decompresses the chunks it needs.
+#
+# Chunks are never rewritten; a day archived in two parts has two chunks. The
+# index is replaced atomically after the chunk is on disk, so readers in other
+# processes (the HTTP workers of serve.py) always see complete chunks.
+
+import os
+import struct
+import sys
+import threading
+import zlib
+import logging
+from array import array
+from collections import namedtuple
+from itertools import accumulate
+
+from devices import DEFAULT_DEVICE_ID
+from history_buffer import entry_timestamp
+
+logger = logging.getLogger("letterbox_server.history_archive")
+
+INDEX_MAGIC = b"LBHA"
+INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct("<4sHId")  # magic, version, data file generation, cleared_ts
+_INDEX_ENTRY = struct.Struct("<IddQQIII")  # day, first_ts, last_ts, last_seq, offset, length, count, crc32
+_COLUMN_HEADER = struct.Struct("<cq")  # array typecode of the deltas, first value
+_COUNT = struct.Struct("<I")
+
+# Column name and scale to integers
+_COLUMNS = (("seq", 1), ("ts", 1000), ("d0", 1), ("d1", 1), ("d2", 1),
+            ("avg_distance", 100), ("battery", 100), ("used_capacity", 100))
+_TYPECODES = (('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63))
+
+ChunkInfo = namedtuple("ChunkInfo", "day first_ts last_ts last_seq offset length count crc")
+
+
+# Column values of a history record (as appended by the server)
+def _values(record):
+    durations = list(record.get("durations") or [])[:3]
+    durations += [0] * (3 - len(durations))
+    return (
+        int(record.get("seq", 0) or 0),
+        entry_timestamp(record),
+        int(durations[0]), int(durations[1]), int(durations[2]),
+        float(record.get("avg_distance", record.get("distance", 0)) or 0),
+        float(record.get("batteryPercentage", 0) or 0),
+        float(record.get("estimatedUsedCapacity", 0) or 0)
+    )
+
+
+def _encode_column(values):
+    deltas = [b - a for a, b in zip(values, values[1:])]
+    bound = max((max(deltas), -min(deltas) - 1)) if deltas else 0
+    typecode = next(code for code, limit in _TYPECODES if bound < limit)
+    column = array(typecode, deltas)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return _COLUMN_HEADER.pack(typecode.encode(), values[0]) + column.tobytes()
+
+
+def encode_chunk(rows):
+    """Compressed chunk of value tuples (see _values), oldest first."""
+    parts = [_COUNT.pack(len(rows))]
+    for (_, scale), values in zip(_COLUMNS, zip(*rows)):
+        parts.append(_encode_column([round(value * scale) for value in values]))
+    return zlib.compress(b"".join(parts), 9)
+
+
+def decode_chunk(data, device_id):
+    """History records of a compressed chunk, oldest first."""
+    raw = memoryview(zlib.decompress(data))
+    (count,) = _COUNT.unpack_from(raw)
+    position = _COUNT.size
+    columns = []
+    for _, scale in _COLUMNS:
+        typecode, first = _COLUMN_HEADER.unpack_from(raw, position)
+        position += _COLUMN_HEADER.size
+        deltas = array(typecode.decode())
+        size = deltas.itemsize * (count - 1)
+        deltas.frombytes(raw[position:position + size])
+        position += size
+        if sys.byteorder == "big":
+            deltas.byteswap()
+        values = accumulate(deltas, initial=first)
+        columns.append(list(values) if scale == 1 else [value / scale for value in values])
+    return [{
+        "device": device_id,
+        "seq": seq,
+        "ts": ts,
+        "durations": [d0, d1, d2],
+        "avg_distance": avg_distance,
+        "batteryPercentage": battery,
+        "estimatedUsedCapacity": used_capacity
+    } for seq, ts, d0, d1, d2, avg_distance, battery, used_capacity in zip(*columns)]
+
+
+class _DeviceIndex:
+    __slots__ = ("generation", "cleared_ts", "chunks", "stat")
+
+    def __init__(self, generation=0, cleared_ts=0.0, chunks=None, stat=None):
+        self.generation = generation
+        self.cleared_ts = cleared_ts
+        self.chunks = chunks or []
+        self.stat = stat
+
+
+class HistoryArchive:
+    """Compressed per-device archive of the readings that left the history log.
+
+    The ingest process appends the records that compaction removes from the
+    log (append_records) and clears devices; with read_only set (HTTP
+    workers) it only answers oldest_ts() and query_range().
+    """
+
+    def __init__(self, directory, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._indexes = {}  # device ID -> _DeviceIndex
+        if not read_only:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _index_path(self, device_id):
+        return os.path.join(self.directory, f"{device_id}.idx")
+
+    def _data_path(self, device_id, generation):
+        return os.path.join(self.directory, f"{device_id}-{generation}.dat")
+
+    def _read_index(self, device_id):
+        path = self._index_path(device_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return _DeviceIndex()
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            index = self._indexes.get(device_id)
+            if index is not None and (not self.read_only or index.stat == stat_key):
+                return index
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, generation, cleared_ts = _INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path} is not a history archive index")
+        chunks = [ChunkInfo(*fields) for fields in _INDEX_ENTRY.iter_unpack(data[_INDEX_HEADER.size:])]
+        index = _DeviceIndex(generation, cleared_ts, chunks, stat_key)
+        with self._lock:
+            self._indexes[device_id] = index
+        return index
+
+    # Replace the index file of a device (the caller holds the write lock)
+    def _write_index(self, device_id, index):
+        path = self._index_path(device_id)
+        data = _INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, index.generation, index.cleared_ts)
+        data += b"".join(_INDEX_ENTRY.pack(*chunk) for chunk in index.chunks)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        with self._lock:
+            self._indexes[device_id] = index
+
+    def append_records(self, records):
+        """Archive history records (oldest first), as removed from the history log.
+
+        Clear markers drop the archive of their device. Records that are
+        already archived or older than the last clear are skipped, so a
+        compaction that is retried after a failure adds nothing twice.
+        """
+        pending = {}  # device ID -> value tuples
+        for record in records:
+            device_id = record.get("device", DEFAULT_DEVICE_ID)
+            if record.get("cleared"):
+                pending.pop(device_id, None)
+                self.clear(device_id, entry_timestamp(record))
+            else:
+                pending.setdefault(device_id, []).append(_values(record))
+        for device_id, rows in pending.items():
+            self._append_device(device_id, rows)
+
+    def _append_device(self, device_id, rows):
+        index = self._read_index(device_id)
+        last = (index.chunks[-1].last_ts, index.chunks[-1].last_seq) if index.chunks else (index.cleared_ts, -1)
+        rows = [row for row in rows if (row[1], row[0]) > last]
+        if not rows:
+            return
+        rows.sort(key=lambda row: row[1])
+
+        # One chunk per UTC day
+        chunks = list(index.chunks)
+        with open(self._data_path(device_id, index.generation), 'ab') as f:
+            offset = f.tell()
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i < len(rows) and int(rows[i][1] // 86400) == int(rows[start][1] // 86400):
+                    continue
+                day_rows = rows[start:i]
+                data = encode_chunk(day_rows)
+                f.write(data)
+                chunks.append(ChunkInfo(int(day_rows[0][1] // 86400), day_rows[0][1], day_rows[-1][1],
+                                        day_rows[-1][0], offset, len(data), len(day_rows), zlib.crc32(data)))
+                offset += len(data)
+                start = i
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_index(device_id, _DeviceIndex(index.generation, index.cleared_ts, chunks))
+
+    def clear(self, device_id, cleared_ts):
+        """Drop the archive of a device up to cleared_ts; older records are never archived again."""
+        index = self._read_index(device_id)
+        if cleared_ts <= index.cleared_ts:
+            return
+        # A new data file, so workers that still read the old index find no new chunks in it
+        self._write_index(device_id, _DeviceIndex(index.generation + 1, cleared_ts))
+        try:
+            os.remove(self._data_path(device_id, index.generation))
+        except FileNotFoundError:
+            pass
+        logger.info(f"Cleared the history archive of {device_id}")
+
+    def oldest_ts(self, device_id):
+        """Timestamp of the oldest archived reading of a device (None if there is none)."""
+        chunks = self._read_index(device_id).chunks
+        return chunks[0].first_ts if chunks else None
+
+    def query_range(self, device_id, since_ts, until_ts=None):
+        """Records of a device with since_ts <= ts (< until_ts), oldest first."""
+        if until_ts is None:
+            until_ts = float("inf")
+        index = self._read_index(device_id)
+        chunks = [chunk for chunk in index.chunks if chunk.last_ts >= since_ts and chunk.first_ts < until_ts]
+        if not chunks:
+            return []
+        records = []
+        try:
+            with open(self._data_path(device_id, index.generation), 'rb') as f:
+                for chunk in chunks:
+                    f.seek(chunk.offset)
+                    data = f.read(chunk.length)
+                    if zlib.crc32(data) != chunk.crc:
+                        logger.error(f"Skipping damaged archive chunk of {device_id} at byte {chunk.offset}")
+                        continue
+                    records.extend(record for record in decode_chunk(data, device_id)
+                                   if since_ts <= record["ts"] < until_ts)
+        except FileNotFoundError:
+            # Cleared in the meantime
+            return []
+        return records
+
+    def stats(self):
+        """Archived readings and compressed bytes, summed over all devices."""
+        readings = size = 0
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else ():
+            if name.endswith(".idx"):
+                chunks = self._read_index(name[:-len(".idx")]).chunks
+                readings += sum(chunk.count for chunk in chunks)
+                size += sum(chunk.length for chunk in chunks)
+        return {"readings": readings, "bytes": size}
@@ -0,0 +1,319 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+# Epoch timestamp of a history entry. Older entries only carry date/time strings.
+def entry_timestamp(entry):
+    if "ts" in entry:
+        return float(entry["ts"])
+    try:
+        return datetime.strptime(f"{entry['date']} {entry['time']}", "%Y-%m-%d %H:%M:%S").timestamp()
+    except (KeyError, ValueError):
+        return 0.0
+
+
+# Return whole numbers as int so the JSON output looks like the firmware values
+def _plain_number(value):
+    return int(value) if value.is_integer() else value
+
+
+_COLUMNS = ("seq", "ts", "d0", "d1", "d2", "avg_distance", "battery", "used_capacity")
+
+
+class _Chunk:
+    """Fixed-size block of column arrays; full chunks are never resized again."""
+
+    __slots__ = _COLUMNS + ("__weakref__",)
+
+    def __init__(self):
+        self.seq = array('Q')
+        self.ts = array('d')
+        self.d0 = array('i')
+        self.d1 = array('i')
+        self.d2 = array('i')
+        self.avg_distance = array('d')
+        self.battery = array('d')
+        self.used_capacity = array('d')
+
+    @classmethod
+    def filled(cls, size):
+        """A full chunk of zeros, filled from the back by HistoryBuffer.prepend()."""
+        chunk = cls()
+        for name in _COLUMNS:
+            column = getattr(chunk, name)
+            column.frombytes(bytes(size * column.itemsize))
+        return chunk
+
+
+class HistoryView:
+    """Immutable view of a HistoryBuffer at one point in time.
+
+    A view shares the chunks of the buffer instead of copying them. Full
+    chunks are never written again, the newest one only grows past the
+    length of the view, and the buffer replaces (never edits) its list of
+    chunks when it adds or drops one. So a view can be read from any thread
+    without a lock while the buffer keeps appending.
+    """
+
+    __slots__ = ("chunk_size", "distance_fn", "_chunks", "_start", "_length", "last_seq")
+
+    def __init__(self, chunk_size, distance_fn, chunks, start, length, last_seq):
+        self.chunk_size = chunk_size
+        self.distance_fn = distance_fn
+        self._chunks = chunks
+        self._start = start  # Number of evicted entries at the front of the first chunk
+        self._length = length
+        self.last_seq = last_seq
+
+    def __len__(self):
+        return self._length
+
+    # Chunk and offset of a logical index (0 = oldest retained entry)
+    def _locate(self, index):
+        position = index + self._start
+        return self._chunks[position // self.chunk_size], position % self.chunk_size
+
+    @property
+    def oldest_ts(self):
+        if not self._length:
+            return None
+        chunk, offset = self._locate(0)
+        return chunk.ts[offset]
+
+    @property
+    def newest_ts(self):
+        if not self._length:
+            return None
+        chunk, offset = self._locate(self._length - 1)
+        return chunk.ts[offset]
+
+    def newest(self, name):
+        """Value of one column for the newest entry."""
+        chunk, offset = self._locate(self._length - 1)
+        return getattr(chunk, name)[offset]
+
+    # Binary search over a sorted column ("ts" or "seq") across all chunks
+    def _search(self, name, value, right):
+        if not self._length:
+            return 0
+        search = bisect_right if right else bisect_left
+        # First find the chunk, then the position inside its column
+        firsts = [getattr(chunk, name)[0] for chunk in self._chunks]
+        chunk_index = max(search(firsts, value) - 1, 0)
+        end = self._start + self._length
+        while True:
+            column = getattr(self._chunks[chunk_index], name)
+            lo = self._start if chunk_index == 0 else 0
+            # The newest chunk may already hold entries appended after this view was made
+            hi = min(len(column), end - chunk_index * self.chunk_size)
+            offset = search(column, value, lo, hi)
+            if offset < hi or chunk_index == len(self._chunks) - 1:
+                break
+            # Everything in this chunk is before value, continue with the next one
+            chunk_index += 1
+        return chunk_index * self.chunk_size + offset - self._start
+
+    def index_at(self, ts, right=False):
+        """Logical index of the first entry with a timestamp >= ts (> ts if right)."""
+        return self._search("ts", ts, right)
+
+    def index_after_seq(self, seq):
+        """Logical index of the first entry with a sequence number > seq."""
+        return self._search("seq", seq, True)
+
+    def entry(self, index):
+        chunk, offset = self._locate(index)
+        ts = chunk.ts[offset]
+        moment = datetime.fromtimestamp(ts)
+        durations = [chunk.d0[offset], chunk.d1[offset], chunk.d2[offset]]
+        return {
+            "seq": chunk.seq[offset],
+            "ts": ts,
+            "date": moment.strftime("%Y-%m-%d"),
+            "time": moment.strftime("%H:%M:%S"),
+            "durations": durations,
+            "distances": [self.distance_fn(duration) for duration in durations],
+            "avg_distance": chunk.avg_distance[offset],
+            "batteryPercentage": _plain_number(chunk.battery[offset]),
+            "estimatedUsedCapacity": chunk.used_capacity[offset]
+        }
+
+    def entries_at(self, indices):
+        """History entries for the given logical indices."""
+        return [self.entry(index) for index in indices]
+
+    def column(self, name, start=0, stop=None):
+        """Copy of one column ("ts", "avg_distance", "battery", ...) for [start, stop) as an array."""
+        stop = self._length if stop is None else min(stop, self._length)
+        start = max(start, 0)
+        result = array(getattr(self._chunks[0], name).typecode) if self._chunks else array('d')
+        position, end = start + self._start, stop + self._start
+        while position < end:
+            chunk_index, offset = divmod(position, self.chunk_size)
+            take = min(self.chunk_size - offset, end - position)
+            result.extend(getattr(self._chunks[chunk_index], name)[offset:offset + take])
+            position += take
+        return result
+
+    def column_parts(self, name, start=0, stop=None):
+        """One column for [start, stop) as a list of buffers (oldest first), without copying full chunks.
+
+        Full chunks never change again, so they are shared as memoryviews. The
+        newest chunk is copied: an array with exported buffers cannot grow.
+        """
+        stop = self._length if stop is None else min(stop, self._length)
+        parts = []
+        position, end = max(start, 0) + self._start, stop + self._start
+        while position < end:
+            chunk_index, offset = divmod(position, self.chunk_size)
+            take = min(self.chunk_size - offset, end - position)
+            column = getattr(self._chunks[chunk_index], name)
+            if len(column) == self.chunk_size:
+                parts.append(memoryview(column).toreadonly()[offset:offset + take])
+            else:
+                parts.append(column[offset:offset + take])
+            position += take
+        return parts
+
+    def spans(self, start=0, stop=None):
+        """[start, stop) split at chunk borders, as (start, stop, chunk) tuples.
+
+        chunk is only set if the span covers a whole chunk. The entries of such
+        a chunk never change, so it can key a cache (weakly, it is dropped on
+        eviction); otherwise it is None.
+        """
+        stop = self._length if stop is None else min(stop, self._length)
+        spans = []
+        position, end = max(start, 0) + self._start, stop + self._start
+        while position < end:
+            chunk_index, offset = divmod(position, self.chunk_size)
+            take = min(self.chunk_size - offset, end - position)
+            first = position - self._start
+            spans.append((first, first + take, self._chunks[chunk_index] if take == self.chunk_size else None))
+            position += take
+        return spans
+
+    def entries(self, start=0, stop=None):
+        """History entries (as dicts) for the logical index range [start, stop)."""
+        stop = self._length if stop is None else min(stop, self._length)
+        return [self.entry(index) for index in range(max(start, 0), stop)]
+
+    def range(self, since_ts=None, until_ts=None):
+        """Entries with since_ts <= ts <= until_ts."""
+        start = 0 if since_ts is None else self.index_at(since_ts)
+        stop = self._length if until_ts is None else self.index_at(until_ts, right=True)
+        return self.entries(start, stop)
+
+    def tail(self, count):
+        """The newest count entries."""
+        return self.entries(self._length - count)
+
+
+class HistoryBuffer(HistoryView):
+    """Fixed-capacity, time-ordered history kept in compact column arrays.
+
+    Samples are stored in chunks of chunk_size entries. Once the capacity is
+    reached, the oldest samples are evicted by moving a start offset and
+    dropping whole chunks, so nothing is ever copied. Time range lookups use a
+    binary search over the timestamp column.
+
+    Every entry gets a sequence number that keeps increasing across
+    clear() calls, so clients can ask for "everything after seq N".
+
+    Only one thread may write; readers in other threads use snapshot().
+    """
+
+    __slots__ = ("capacity",)
+
+    def __init__(self, capacity, chunk_size=4096, distance_fn=None):
+        super().__init__(chunk_size, distance_fn or (lambda duration: 0), [], 0, 0, 0)
+        self.capacity = capacity
+
+    def snapshot(self):
+        """Immutable view of the current entries; O(1), shares the chunks."""
+        return HistoryView(self.chunk_size, self.distance_fn, self._chunks, self._start, self._length, self.last_seq)
+
+    def clear(self):
+        self._chunks = []
+        self._start = 0
+        self._length = 0
+
+    def append(self, entry):
+        """Add an entry and return its sequence number."""
+        seq = max(int(entry.get("seq", 0)), self.last_seq + 1)
+        self.last_seq = seq
+        ts = entry_timestamp(entry)
+        # Keep the time column sorted even if the clock jumps backwards
+        if self._length and ts < self.newest_ts:
+            ts = self.newest_ts
+        durations = list(entry.get("durations") or [])[:3]
+        durations += [0] * (3 - len(durations))
+
+        if not self._chunks or len(self._chunks[-1].ts) == self.chunk_size:
+            # A new list, so views keep the one they were made with
+            self._chunks = self._chunks + [_Chunk()]
+        chunk = self._chunks[-1]
+        chunk.seq.append(seq)
+        chunk.ts.append(ts)
+        chunk.d0.append(int(durations[0]))
+        chunk.d1.append(int(durations[1]))
+        chunk.d2.append(int(durations[2]))
+        chunk.avg_distance.append(float(entry.get("avg_distance", entry.get("distance", 0)) or 0))
+        chunk.battery.append(float(entry.get("batteryPercentage", 0) or 0))
+        chunk.used_capacity.append(float(entry.get("estimatedUsedCapacity", 0) or 0))
+        self._length += 1
+
+        if self._length > self.capacity:
+            self._evict_oldest()
+        return seq
+
+    def prepend(self, entries):
+        """Insert entries (oldest first) that are older than all current ones, keeping their seq.
+
+        Used to load old history in the background while new readings are
+        appended. Entries beyond the capacity are skipped, oldest first.
+        Returns the number of entries inserted.
+        """
+        room = self.capacity - self._length
+        if room <= 0 or not entries:
+            return 0
+        entries = entries[-room:]
+        chunks, start = self._chunks, self._start
+        oldest = self.oldest_ts
+        for entry in reversed(entries):
+            if start == 0:
+                chunks = [_Chunk.filled(self.chunk_size)] + chunks
+                start = self.chunk_size
+            # Views of this buffer only read from their own start offset on, so
+            # filling the slots before it does not change what they see
+            start -= 1
+            ts = entry_timestamp(entry)
+            if oldest is not None and ts > oldest:
+                ts = oldest
+            oldest = ts
+            durations = list(entry.get("durations") or [])[:3]
+            durations += [0] * (3 - len(durations))
+            chunk = chunks[0]
+            chunk.seq[start] = int(entry.get("seq", 0) or 0)
+            chunk.ts[start] = ts
+            chunk.d0[start] = int(durations[0])
+            chunk.d1[start] = int(durations[1])
+            chunk.d2[start] = int(durations[2])
+            chunk.avg_distance[start] = float(entry.get("avg_distance", entry.get("distance", 0)) or 0)
+            chunk.battery[start] = float(entry.get("batteryPercentage", 0) or 0)
+            chunk.used_capacity[start] = float(entry.get("estimatedUsedCapacity", 0) or 0)
+        self._chunks, self._start = chunks, start
+        self._length += len(entries)
+        return len(entries)
+
+    def continue_after(self, seq):
+        """Make new entries get sequence numbers above seq (history that is still being loaded)."""
+        self.last_seq = max(self.last_seq, seq)
+
+    def _evict_oldest(self):
+        self._start += 1
+        self._length -= 1
+        if self._start == self.chunk_size:
+            self._chunks = self._chunks[1:]
+            self._start = 0
@@ -0,0 +1,413 @@
+import json
+import os
+import threading
+import time
+import zlib
+import logging
+
+from devices import DEFAULT_DEVICE_ID
+
+logger = logging.getLogger("letterbox_server.history_store")
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".ndjson"
+SUMMARY_SUFFIX = ".summary.json"
+
+
+# One log line: CRC32 of the JSON (8 hex digits), a space and the JSON. The
+# checksum finds records that a power cut left half written or garbled.
+def encode_record(record):
+    body = json.dumps(record, separators=(',', ':')).encode()
+    return b"%08x " % zlib.crc32(body) + body + b"\n"
+
+
+def decode_line(line):
+    """Record of a log line, or None if it is incomplete or damaged."""
+    if not line.endswith(b"\n"):
+        return None
+    try:
+        # Lines written before the checksums were added are plain JSON
+        if line.startswith(b"{"):
+            return json.loads(line)
+        body = line[9:-1]
+        if line[8:9] != b" " or int(line[:8], 16) != zlib.crc32(body):
+            return None
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+# Per-device record count and sequence number range of a segment, so startup
+# can tell which segments it has to replay before MQTT ingest starts. Updates
+# and returns devices if given.
+def summarize_records(records, devices=None):
+    devices = {} if devices is None else devices
+    for record in records:
+        device_id = record.get("device", DEFAULT_DEVICE_ID)
+        seq = int(record.get("seq", 0) or 0)
+        count, first, last = devices.get(device_id, (0, seq, seq))
+        devices[device_id] = (count + 1, min(first, seq), max(last, seq))
+    return devices
+
+
+# Sorted list of the segment numbers in a directory
+def segment_numbers(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            try:
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+    return sorted(numbers)
+
+
+def read_segment_records(directory):
+    """Yield the records of all segments in order without changing any file (for offline tools)."""
+    for number in segment_numbers(directory):
+        try:
+            f = open(os.path.join(directory, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"), 'rb')
+        except FileNotFoundError:
+            # Compacted by the server in the meantime
+            continue
+        with f:
+            for line in f:
+                record = decode_line(line)
+                if record is not None:
+                    yield record
+
+
+class SegmentReader:
+    """Read-only view of a segment log owned by another process (the HTTP workers of serve.py)."""
+
+    supports_queries = False
+
+    def __init__(self, directory, retention_records=1000):
+        self.directory = directory
+        self.retention_records = retention_records
+
+    def load(self):
+        """Return the retained records, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        records = list(read_segment_records(self.directory))
+        return records[-self.retention_records:] if len(records) > self.retention_records else records
+
+    def has_records(self):
+        return os.path.isdir(self.directory) and bool(segment_numbers(self.directory))
+
+    def close(self):
+        pass
+
+
+class HistoryStore:
+    """Append-only history log split into rotating NDJSON segment files.
+
+    Every record is written as a single checksummed line to the active
+    segment, so the cost of an append does not depend on how much history is
+    kept. Segments are rotated after a fixed number of records and compacted
+    in the background once they fall out of the retention window. A sealed
+    segment gets a small summary file, which lets load_lazily() leave the
+    segments that only hold old history for a background thread.
+    """
+
+    # Segments can only be replayed as a whole, not queried by device and time
+    supports_queries = False
+
+    def __init__(self, directory, segment_max_records=5000, retention_records=1000,
+                 fsync_every=50, fsync_interval=5.0, compact_interval=60.0, sync_observer=None, on_expire=None):
+        self.directory = directory
+        self.sync_observer = sync_observer  # Called with the duration of every fsync in seconds
+        self.on_expire = on_expire  # Called with the records of a segment before compaction deletes it
+        self.segment_max_records = segment_max_records
+        self.retention_records = retention_records
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+
+        self._lock = threading.Lock()
+        self._segments = {}  # segment number -> record count
+        self._active_records = {}  # device ID -> (count, first seq, last seq) in the active segment
+        self._active_number = 0
+        self._active_file = None
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+        self._stop_event = threading.Event()
+        self._compactor = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Path of the segment file with the given number
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+    def _summary_path(self, number):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:06d}{SUMMARY_SUFFIX}")
+
+    # Sorted list of segment numbers currently on disk
+    def _list_segments(self):
+        return segment_numbers(self.directory)
+
+    # Read all valid records of a segment. Damaged lines are skipped, and a damaged
+    # tail (power cut during a write) is cut off so that new appends start on a clean line.
+    def _read_segment(self, number):
+        path = self._segment_path(number)
+        records = []
+        offset = good_offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                record = decode_line(line)
+                if record is None:
+                    continue
+                if offset - len(line) != good_offset:
+                    logger.warning(f"Skipped damaged records in {path} before byte {offset - len(line)}")
+                records.append(record)
+                good_offset = offset
+        if good_offset != offset:
+            logger.warning(f"Truncating damaged tail of {path} at byte {good_offset}")
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+        return records
+
+    def _write_summary(self, number, devices):
+        summary = {"size": os.path.getsize(self._segment_path(number)), "devices": devices}
+        path = self._summary_path(number)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(summary, f, separators=(',', ':'))
+        os.replace(path + ".tmp", path)
+
+    # Summary of a sealed segment, or None if it is missing or does not match the file
+    def _read_summary(self, number):
+        try:
+            with open(self._summary_path(number), 'r') as f:
+                summary = json.load(f)
+            if summary["size"] != os.path.getsize(self._segment_path(number)):
+                return None
+            return {device_id: tuple(values) for device_id, values in summary["devices"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def load(self):
+        """Replay all segments in order and return the retained records."""
+        recent, older, _ = self.load_lazily({})
+        records = [record for batch in reversed(list(older)) for record in batch] + recent
+        if len(records) > self.retention_records:
+            records = records[-self.retention_records:]
+        return records
+
+    def load_lazily(self, folded_seqs):
+        """Split the log for a fast startup: (recent, older, last_seqs).
+
+        recent holds the records of every segment from the first one with a
+        record whose seq is not below folded_seqs[device] (what the saved
+        rollups already include) on, oldest first; they have to be replayed
+        before ingest starts. older yields the records of the segments before
+        that, one list per segment, newest segment first, up to the retention
+        window. last_seqs has the highest seq of every device in the log.
+        """
+        with self._lock:
+            numbers = self._list_segments()
+            summaries = {number: self._read_summary(number) for number in numbers[:-1]}
+            split = len(numbers) - 1 if numbers else 0
+            for i, number in enumerate(numbers[:-1]):
+                summary = summaries[number]
+                if summary is None or any(last >= folded_seqs.get(device_id, 0)
+                                          for device_id, (_, _, last) in summary.items()):
+                    split = i
+                    break
+
+            recent = []
+            self._segments = {}
+            self._active_records = {}
+            for i, number in enumerate(numbers):
+                if i < split:
+                    self._segments[number] = sum(count for count, _, _ in summaries[number].values())
+                    continue
+                segment_records = self._read_segment(number)
+                self._segments[number] = len(segment_records)
+                recent.extend(segment_records)
+                if i == len(numbers) - 1:
+                    summarize_records(segment_records, self._active_records)
+                elif summaries[number] is None:
+                    # Written before summaries existed, or lost in a crash right after a rotation
+                    self._write_summary(number, summarize_records(segment_records))
+            self._active_number = numbers[-1] if numbers else 1
+            self._segments.setdefault(self._active_number, 0)
+            self._open_active()
+
+            last_seqs = {}
+            for summary in [summaries[number] for number in numbers[:split]] + [summarize_records(recent)]:
+                for device_id, (_, _, last) in summary.items():
+                    last_seqs[device_id] = max(last, last_seqs.get(device_id, 0))
+            older_numbers = numbers[:split]
+        logger.info(f"Replayed {len(recent)} history records from {len(numbers) - split} segments"
+                    + (f", {len(older_numbers)} older segments follow" if older_numbers else ""))
+        return recent, self._read_older(older_numbers, self.retention_records - len(recent)), last_seqs
+
+    def _read_older(self, numbers, budget):
+        for number in reversed(numbers):
+            if budget <= 0:
+                return
+            try:
+                records = self._read_segment(number)
+            except FileNotFoundError:
+                # Cleared in the meantime
+                continue
+            budget -= len(records)
+            yield records[-budget:] if budget < 0 else records
+
+    def has_records(self):
+        return any(self._segments.values())
+
+    def _open_active(self):
+        if self._active_file is not None:
+            self._active_file.close()
+        self._active_file = open(self._segment_path(self._active_number), 'ab')
+
+    # Seal the active segment and start a new one
+    def _rotate(self):
+        self._sync()
+        try:
+            self._write_summary(self._active_number, self._active_records)
+        except OSError as e:
+            # The next startup reads the segment instead
+            logger.warning(f"Could not write the summary of segment {self._active_number}: {e}")
+        self._active_records = {}
+        self._active_number += 1
+        self._segments[self._active_number] = 0
+        self._open_active()
+
+    def _sync(self):
+        if self._active_file is None:
+            return
+        started = time.perf_counter()
+        self._active_file.flush()
+        os.fsync(self._active_file.fileno())
+        if self.sync_observer is not None:
+            self.sync_observer(time.perf_counter() - started)
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, record):
+        """Append one record to the active segment."""
+        line = encode_record(record)
+        with self._lock:
+            if self._active_file is None:
+                self._open_active()
+            if self._segments.get(self._active_number, 0) >= self.segment_max_records:
+                self._rotate()
+            self._active_file.write(line)
+            summarize_records((record,), self._active_records)
+            self._segments[self._active_number] = self._segments.get(self._active_number, 0) + 1
+            self._pending_sync += 1
+            if (self._pending_sync >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def append_many(self, records):
+        """Append several records with a single write."""
+        if not records:
+            return
+        data = b"".join(encode_record(record) for record in records)
+        with self._lock:
+            if self._active_file is None:
+                self._open_active()
+            # Rotation only happens between batches, so a batch may overfill a segment slightly
+            if self._segments.get(self._active_number, 0) >= self.segment_max_records:
+                self._rotate()
+            self._active_file.write(data)
+            summarize_records(records, self._active_records)
+            self._segments[self._active_number] = self._segments.get(self._active_number, 0) + len(records)
+            self._pending_sync += len(records)
+            if (self._pending_sync >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def flush(self):
+        """Force buffered records to disk."""
+        with self._lock:
+            if self._pending_sync:
+                self._sync()
+
+    def clear(self):
+        """Delete all segments and start over with an empty log."""
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.close()
+                self._active_file = None
+            for number in self._list_segments():
+                self._remove_segment(number)
+            self._segments = {}
+            self._active_records = {}
+            # Never reuse segment numbers so a running compaction cannot touch the new log
+            self._active_number += 1
+            self._segments[self._active_number] = 0
+            self._pending_sync = 0
+            self._open_active()
+
+    def _remove_segment(self, number):
+        os.remove(self._segment_path(number))
+        try:
+            os.remove(self._summary_path(number))
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        """Delete sealed segments whose records all fell out of the retention window."""
+        with self._lock:
+            sealed = sorted(n for n in self._segments if n != self._active_number)
+            total = sum(self._segments.values())
+        excess = total - self.retention_records
+
+        for number in sealed:
+            count = self._segments.get(number, 0)
+            if count > excess:
+                # Segment still holds retained records
+                break
+            if self.on_expire is not None:
+                # Sealed segments are not written anymore; if this fails, the segment is kept and tried again
+                try:
+                    records = self._read_segment(number)
+                except FileNotFoundError:
+                    # History was cleared in the meantime
+                    break
+                self.on_expire(records)
+            with self._lock:
+                if self._segments.pop(number, None) is None:
+                    # History was cleared in the meantime
+                    break
+                self._remove_segment(number)
+            excess -= count
+            logger.info(f"Compaction removed expired segment {number} ({count} records)")
+
+    def _compaction_loop(self):
+        while not self._stop_event.wait(min(self.fsync_interval, self.compact_interval)):
+            try:
+                with self._lock:
+                    if self._pending_sync and time.monotonic() - self._last_sync >= self.fsync_interval:
+                        self._sync()
+                if time.monotonic() - self._last_compaction >= self.compact_interval:
+                    self._last_compaction = time.monotonic()
+                    self.compact()
+            except Exception as e:
+                logger.error(f"Error during history compaction: {e}")
+
+    def start_compaction(self):
+        """Start the background thread that syncs idle data and compacts old segments."""
+        if self._compactor is not None:
+            return
+        self._last_compaction = time.monotonic()
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        self._stop_event.set()
+        if self._compactor is not None:
+            self._compactor.join(timeout=5)
+            self._compactor = None
+        with self._lock:
+            if self._active_file is not None:
+                self._sync()
+                self._active_file.close()
+                self._active_file = None
@@ -0,0 +1,198 @@
+import asyncio
+import threading
+import time
+import zlib
+import logging
+from collections import deque
+
+logger = logging.getLogger("letterbox_server.ingest")
+
+OVERFLOW_POLICIES = ("drop-oldest", "block")
+
+
+class IngestQueue:
+    """Bounded FIFO between the MQTT callback and an ingest worker.
+
+    When the queue is full, "drop-oldest" discards the oldest waiting item
+    and "block" makes put() wait until the worker has made room.
+    """
+
+    def __init__(self, maxsize=10000, overflow_policy="drop-oldest"):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'")
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.dequeued = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Queue an item; returns False if it (or an older one) had to be dropped."""
+        with self._condition:
+            dropped = False
+            while len(self._items) >= self.maxsize and not self._closed:
+                if self.overflow_policy == "block":
+                    self._condition.wait()
+                else:
+                    self._items.popleft()
+                    self.dropped += 1
+                    dropped = True
+            self._items.append((time.monotonic(), item))
+            self.enqueued += 1
+            self._condition.notify_all()
+            return not dropped
+
+    def get_batch(self, max_items, timeout=None):
+        """Wait for at least one item and return up to max_items of them as (enqueued_at, item) pairs."""
+        with self._condition:
+            if not self._items and not self._closed:
+                self._condition.wait(timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                batch.append(self._items.popleft())
+            self.dequeued += len(batch)
+            if batch:
+                self._condition.notify_all()
+            return batch
+
+    def oldest_age(self):
+        """Seconds the oldest waiting item has been queued."""
+        try:
+            return time.monotonic() - self._items[0][0]
+        except IndexError:
+            return 0.0
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class IngestWorkerPool:
+    """Worker threads draining ingest queues in micro-batches.
+
+    Items are routed to a worker by key (the device ID), so readings of one
+    letterbox are always processed in order by the same worker.
+    process_batch(items) receives a list of (enqueued_at, item) pairs.
+
+    start() runs one thread per worker queue; run_async() drains the same
+    queues on an asyncio event loop instead (async_server.py).
+    """
+
+    def __init__(self, process_batch, workers=2, queue_depth=10000,
+                 overflow_policy="drop-oldest", batch_size=100):
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.queues = [IngestQueue(queue_depth, overflow_policy) for _ in range(workers)]
+        self._threads = []
+        self._stopping = False
+        # Lag counters per worker (seconds between enqueue and processing)
+        self.last_lag = [0.0] * workers
+        self.max_lag = [0.0] * workers
+        self.batches = [0] * workers
+        self.processed = [0] * workers
+        self.errors = [0] * workers
+
+    def submit(self, key, item):
+        # crc32 instead of hash() so the routing is stable between runs
+        worker = zlib.crc32(key.encode()) % len(self.queues) if len(self.queues) > 1 else 0
+        return self.queues[worker].put(item)
+
+    def _process(self, worker, batch):
+        try:
+            self.process_batch(batch)
+        except Exception as e:
+            self.errors[worker] += 1
+            logger.error(f"Error processing ingest batch: {e}")
+        lag = time.monotonic() - batch[0][0]
+        self.last_lag[worker] = lag
+        self.max_lag[worker] = max(self.max_lag[worker], lag)
+        self.batches[worker] += 1
+        self.processed[worker] += len(batch)
+
+    def _run(self, worker):
+        ingest_queue = self.queues[worker]
+        while True:
+            batch = ingest_queue.get_batch(self.batch_size, timeout=1.0)
+            if not batch:
+                if self._stopping:
+                    return
+                continue
+            self._process(worker, batch)
+
+    def process_pending(self):
+        """Process one batch of every non-empty queue without waiting; returns the number of items."""
+        count = 0
+        for worker, ingest_queue in enumerate(self.queues):
+            batch = ingest_queue.get_batch(self.batch_size, timeout=0)
+            if batch:
+                self._process(worker, batch)
+                count += len(batch)
+        return count
+
+    async def run_async(self, wakeup):
+        """Process the queues for the running event loop until cancelled; wakeup is an
+        asyncio.Event set after submit(). The batches run one at a time in the loop's
+        default executor (bounded, see async_server.py), since they write and fsync the
+        history log, so a batch may wait for a free thread. Needs the
+        "drop-oldest" policy, since a blocking put() would wait for the loop it runs on."""
+        if any(ingest_queue.overflow_policy == "block" for ingest_queue in self.queues):
+            raise ValueError("The asyncio ingest loop needs the drop-oldest overflow policy")
+        loop = asyncio.get_running_loop()
+        batch = None
+        try:
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                while True:
+                    # Shielded, so a cancel never leaves a batch running behind our back
+                    batch = loop.run_in_executor(None, self.process_pending)
+                    if not await asyncio.shield(batch):
+                        break
+        finally:
+            # Cancelled on shutdown: let the running batch finish, then process what is still queued
+            if batch is not None:
+                await asyncio.wait([batch])
+            while await loop.run_in_executor(None, self.process_pending):
+                pass
+
+    def start(self):
+        if self._threads:
+            return
+        for worker in range(len(self.queues)):
+            thread = threading.Thread(target=self._run, args=(worker,), daemon=True,
+                                      name=f"ingest-worker-{worker}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        """Process what is still queued, then stop the workers."""
+        self._stopping = True
+        for ingest_queue in self.queues:
+            ingest_queue.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        return {
+            "workers": len(self.queues),
+            "queueDepth": sum(len(q) for q in self.queues),
+            "queueCapacity": sum(q.maxsize for q in self.queues),
+            "overflowPolicy": self.queues[0].overflow_policy,
+            "enqueued": sum(q.enqueued for q in self.queues),
+            "dropped": sum(q.dropped for q in self.queues),
+            "processed": sum(self.processed),
+            "batches": sum(self.batches),
+            "errors": sum(self.errors),
+            "oldestQueuedAge": max(q.oldest_age() for q in self.queues),
+            "lastLag": max(self.last_lag),
+            "maxLag": max(self.max_lag)
+        }
@@ -8,8 +8,8 @@ const char* password = "123456789";            // Replace with your WiFi passwor
 // MQTT Settings
 const char* mqtt_server = "172.20.10.6";      // Replace with your Raspberry Pi's IP address
 const int mqtt_port = 1883;                    // Default MQTT port
-const char* mqtt_client_id = "letterbox_sensor";
-const char* mqtt_topic = "letterbox/data";
+const char* mqtt_client_id = "letterbox_sensor";  // Must be unique per letterbox
+const char* mqtt_topic = "letterbox/data";         // Use "letterbox/<device-id>/data" when running several letterboxes
 
 // Ultrasonic sensor pins
 #define TRIG_PIN 2  // D2 on ESP32
@@ -18,6 +18,23 @@ const char* mqtt_topic = "letterbox/data";
 // USB connected accumulator settings
 #define USB_CONNECTED true  // Flag to indicate USB power source
 
+// Payload format
+#define BINARY_PAYLOAD false  // true: send the compact 36 byte binary format instead of JSON (needs the v2 server)
+
+// Binary payload version 1 (little-endian, decoded by binary_payload.py on the server)
+struct __attribute__((packed)) BinaryPayload {
+  uint8_t magic;                 // 0xB1
+  uint8_t version;               // 1
+  uint8_t flags;                 // Bit 0: powered by the USB accumulator
+  uint8_t batteryPercentage;
+  uint32_t durations[3];         // Echo times in microseconds
+  float batteryCapacity;         // mAh
+  float estimatedUsedCapacity;   // mAh
+  float estimatedRemainingTime;  // Hours
+  float runTimeHours;
+  uint32_t uptimeSeconds;
+};
+
 // Variables
 long durations[3] = {0, 0, 0};  // Array to store 3 measurements
 int measurementCount = 0;        // Counter for measurements
@@ -216,6 +233,27 @@ void publishData() {
   // Calculate run time in hours
   float runTimeHours = (currentMillis - startTime) / 3600000.0;
   
+#if BINARY_PAYLOAD
+  // Fill the fixed binary layout; no string building and about a sixth of the airtime
+  BinaryPayload payload;
+  payload.magic = 0xB1;
+  payload.version = 1;
+  payload.flags = USB_CONNECTED ? 0x01 : 0x00;
+  payload.batteryPercentage = (uint8_t)batteryPercentage;
+  for (int i = 0; i < 3; i++) {
+    payload.durations[i] = (uint32_t)durations[i];
+  }
+  payload.batteryCapacity = BATTERY_CAPACITY_MAH;
+  payload.estimatedUsedCapacity = estimatedUsedCapacity;
+  payload.estimatedRemainingTime = estimatedRemainingTime;
+  payload.runTimeHours = runTimeHours;
+  payload.uptimeSeconds = currentMillis / 1000;
+  
+  Serial.print("Publishing binary data to MQTT topic: ");
+  Serial.println(mqtt_topic);
+  
+  client.publish(mqtt_topic, (const uint8_t*)&payload, sizeof(payload));
+#else
   // Prepare JSON payload with all 3 measurements and accumulator information
   String jsonPayload = "{\"durations\":[" + 
                       String(durations[0]) + "," + 
@@ -235,4 +273,5 @@ void publishData() {
   
   // Publish to MQTT topic
   client.publish(mqtt_topic, jsonPayload.c_str());
+#endif
 }
@@ -0,0 +1,148 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Same line format as before, so replay.py can still read the logs
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class RotatingLogFile(logging.handlers.RotatingFileHandler):
+    """Rotates when the file reaches max_bytes or is older than rotate_interval seconds.
+
+    Backups are numbered like RotatingFileHandler's (.1 is the newest), so
+    backup_count bounds the space the log can take on the SD card.
+    """
+
+    def __init__(self, path, max_bytes, backup_count, rotate_interval=None):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.rotate_interval = rotate_interval
+        self._rotate_at = self._next_rotation()
+
+    def _next_rotation(self):
+        return time.time() + self.rotate_interval if self.rotate_interval else None
+
+    def shouldRollover(self, record):
+        if self._rotate_at is not None and time.time() >= self._rotate_at:
+            # Nothing to rotate in an empty file, just restart the interval
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            self._rotate_at = self._next_rotation()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._rotate_at = self._next_rotation()
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site for repetitive lines.
+
+    Every logging call (file and line) may log burst records at once and
+    rate records per second after that. Beyond the limit only every
+    sample_every-th record passes (0 drops them all). The next record that
+    passes mentions how many lines were suppressed in between. Records at
+    exempt_level and above always pass.
+    """
+
+    def __init__(self, rate=1.0, burst=20, sample_every=100, exempt_level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = sample_every
+        self.exempt_level = exempt_level
+        self._sites = {}  # (path, line) -> [tokens, last refill, over the limit, suppressed]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= self.exempt_level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [self.burst, now, 0, 0]
+            site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] >= 1:
+                site[0] -= 1
+            else:
+                site[2] += 1
+                if not self.sample_every or site[2] % self.sample_every:
+                    site[3] += 1
+                    self.suppressed += 1
+                    return False
+            suppressed, site[3] = site[3], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} [{suppressed} similar lines suppressed]"
+            record.args = None
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the logging thread: drops records while the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(path, level=logging.INFO, max_bytes=5 * 1024 * 1024, backup_count=3,
+                      rotate_interval=86400, json_format=False, console=True,
+                      rate_limit=None, rate_limited_loggers=(), queue_size=10000):
+    """Log through a queue to a rotating file (if path is set) and the console.
+
+    Callers only format the record and put it on the queue; a listener
+    thread does the file and console I/O. rate_limit is a dict of
+    RateLimitFilter arguments for the records of rate_limited_loggers (the
+    noisy ones), or None to log everything. Returns the listener; stop() it
+    at exit to write the records still queued.
+    """
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = [RotatingLogFile(path, max_bytes, backup_count, rotate_interval)] if path else []
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = _DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    if rate_limit is not None:
+        rate_limit_filter = RateLimitFilter(**rate_limit)
+        for name in rate_limited_loggers:
+            logging.getLogger(name).addFilter(rate_limit_filter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
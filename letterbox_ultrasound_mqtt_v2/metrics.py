@@ -0,0 +1,218 @@
+# In-process metrics in the Prometheus text format.
+#
+# Counters and histograms keep one set of cells per thread. Recording a value
+# only touches the cells of the calling thread, so the hot path needs no lock;
+# the cells of all threads are summed up when /metrics is scraped.
+
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+# Upper bounds in seconds for latency histograms (100 us ... 10 s)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _PerThread:
+    """Cells of one metric, one dict per thread.
+
+    Cells of finished threads are merged into a shared dict whenever a new
+    thread registers and at scrape time, so short-lived request threads do
+    not pile up even if nobody scrapes.
+    """
+
+    def __init__(self, new_cell, merge):
+        self._new_cell = new_cell
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()  # Only taken when a thread records its first value and on scrape
+        self._threads = []  # (weakref to thread, cells)
+        self._retired = {}
+
+    def cell(self, key):
+        try:
+            cells = self._local.cells
+        except AttributeError:
+            cells = self._local.cells = {}
+            with self._lock:
+                self._retire_finished()
+                self._threads.append((weakref.ref(threading.current_thread()), cells))
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = self._new_cell()
+        return cell
+
+    # Merge the cells of finished threads into the retired ones (the caller holds the lock)
+    def _retire_finished(self):
+        alive = []
+        for thread_ref, cells in self._threads:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                for key, cell in list(cells.items()):
+                    self._merge(self._retired.setdefault(key, self._new_cell()), cell)
+            else:
+                alive.append((thread_ref, cells))
+        self._threads = alive
+
+    def collect(self):
+        """Sum of the cells of all threads, by key."""
+        with self._lock:
+            self._retire_finished()
+            total = {}
+            for key, cell in self._retired.items():
+                self._merge(total.setdefault(key, self._new_cell()), cell)
+            for _, cells in self._threads:
+                for key, cell in list(cells.items()):
+                    self._merge(total.setdefault(key, self._new_cell()), cell)
+        return total
+
+
+def _merge_counter(target, source):
+    target[0] += source[0]
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._cells = _PerThread(lambda: [0], _merge_counter)
+
+    def inc(self, *label_values, amount=1):
+        self._cells.cell(label_values)[0] += amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, cell in sorted(self._cells.collect().items()):
+            lines.append(f"{self.name}{_label_text(self.label_names, label_values)} {_number(cell[0])}")
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a binary search and two additions."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        size = len(self.buckets) + 1
+        # Cell: [bucket counts..., +Inf count, sum]
+        self._cells = _PerThread(lambda: [0] * size + [0.0], self._merge)
+
+    @staticmethod
+    def _merge(target, source):
+        for i, value in enumerate(source):
+            target[i] += value
+
+    def observe(self, value, *label_values):
+        cell = self._cells.cell(label_values)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, *label_values):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self, label_values)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, cell in sorted(self._cells.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell[:-1]):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_label_text(self.label_names, label_values, le)} {cumulative}")
+            labels = _label_text(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(cell[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+class Gauge:
+    """Value read when scraped. fn returns a number, or a list of (label values, number)."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, fn, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.label_names = tuple(label_names)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        value = self.fn()
+        samples = value if isinstance(value, list) else [((), value)]
+        for label_values, number in samples:
+            if number is not None:
+                lines.append(f"{self.name}{_label_text(self.label_names, label_values)} {_number(number)}")
+        return lines
+
+
+class CounterFunction(Gauge):
+    """Counter kept elsewhere (e.g. a stats() total since startup), read when scraped like a Gauge."""
+
+    metric_type = "counter"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, fn, label_names=()):
+        return self._add(Gauge(name, help_text, fn, label_names))
+
+    def counter_function(self, name, help_text, fn, label_names=()):
+        return self._add(CounterFunction(name, help_text, fn, label_names))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self, include=None):
+        """All metrics (or those whose name include() accepts) in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            if include is None or include(metric.name):
+                lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,74 @@
+# Import the JSON/NDJSON history of the server into the SQLite history database.
+#
+# Usage: python migrate_to_sqlite.py [--db letterbox_history.db]
+# Then set HISTORY_BACKEND = "sqlite" in raspberry_pi_mqtt_server_v2.py.
+#
+# The segment log (history_segments/) is imported if it has records, otherwise
+# the old single-file history (letterbox_history.json). The current data file
+# letterbox_data.json stays as it is; both backends use it.
+
+import argparse
+import json
+import logging
+import os
+import pathlib
+import sys
+
+from history_store import HistoryStore
+from sqlite_store import SqliteHistoryStore
+
+script_dir = pathlib.Path(__file__).parent.absolute()
+
+BATCH_SIZE = 5000  # Records inserted per transaction
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("letterbox_migrate")
+
+
+# Records of the segment log, or of the legacy history file if the log is empty
+def read_history(history_dir, history_file):
+    if os.path.isdir(history_dir):
+        segments = HistoryStore(history_dir, retention_records=sys.maxsize)
+        records = segments.load()
+        segments.close()
+        if records:
+            logger.info(f"Read {len(records)} records from {history_dir}")
+            return records
+    if os.path.exists(history_file) and os.path.getsize(history_file) > 0:
+        with open(history_file, 'r') as f:
+            records = json.load(f)
+        # Legacy entries have no sequence numbers yet
+        for seq, record in enumerate(records, start=1):
+            record.setdefault("seq", seq)
+        logger.info(f"Read {len(records)} records from {history_file}")
+        return records
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the letterbox history into an SQLite database")
+    parser.add_argument("--db", default=os.path.join(script_dir, "letterbox_history.db"))
+    parser.add_argument("--history-dir", default=os.path.join(script_dir, "history_segments"))
+    parser.add_argument("--history-file", default=os.path.join(script_dir, "letterbox_history.json"))
+    parser.add_argument("--force", action="store_true", help="Replace the history already in the database")
+    args = parser.parse_args()
+
+    store = SqliteHistoryStore(args.db, retention_records=sys.maxsize)
+    try:
+        if store.has_records():
+            if not args.force:
+                logger.error(f"{args.db} already holds history; use --force to replace it")
+                return 1
+            store.clear()
+
+        records = read_history(args.history_dir, args.history_file)
+        for start in range(0, len(records), BATCH_SIZE):
+            store.append_many(records[start:start + BATCH_SIZE])
+        logger.info(f"Imported {len(records)} records into {args.db}")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+import asyncio
+import heapq
+import json
+import queue
+import random
+import threading
+import time
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("letterbox_server.notifications")
+
+TECHULUS_URL = "https://push.techulus.com/api/v1/notify"
+
+
+# HTTP session with a keep-alive connection pool, shared by all requests of a sink
+def pooled_session(pool_size=4):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class MqttSink:
+    """Publishes notifications as JSON to an MQTT topic."""
+
+    name = "mqtt"
+    blocking = False  # publish() only queues the message
+
+    def __init__(self, client, topic):
+        self.client = client
+        self.topic = topic
+
+    def send(self, notification):
+        info = self.client.publish(self.topic, json.dumps(notification))
+        if info.rc != 0:
+            raise ConnectionError(f"MQTT publish to {self.topic} failed with code {info.rc}")
+
+
+class WebhookSink:
+    """POSTs notifications as JSON to an HTTP endpoint."""
+
+    name = "webhook"
+
+    def __init__(self, url, headers=None, timeout=5.0, session=None):
+        self.url = url
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.session = session or pooled_session()
+
+    def send(self, notification):
+        response = self.session.post(self.url, json=notification, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class TechulusSink:
+    """Sends notifications through the Techulus Push API."""
+
+    name = "techulus"
+
+    def __init__(self, api_key, url=TECHULUS_URL, link=None, timeout=10.0, session=None):
+        self.api_key = api_key
+        self.url = url
+        self.link = link
+        self.timeout = timeout
+        self.session = session or pooled_session()
+
+    def send(self, notification):
+        payload = {
+            "title": "Letterbox Alert",
+            "body": notification["message"],
+            "sound": "default",
+            "channel": "letterbox",
+            "timeSensitive": True
+        }
+        if self.link:
+            payload["link"] = self.link
+        headers = {"x-api-key": self.api_key, "Content-Type": "application/json", "Accept": "*/*"}
+        response = self.session.post(self.url, json=payload, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+
+
+# One notification for a burst of letter events of the same device. The
+# distances span the whole burst and the message is the one of the last event.
+def coalesce(notifications):
+    if len(notifications) == 1:
+        return notifications[0]
+    first, last = notifications[0], notifications[-1]
+    merged = dict(last)
+    merged["previous_distance"] = first.get("previous_distance")
+    if first.get("previous_distance") is not None and last.get("current_distance") is not None:
+        merged["difference"] = last["current_distance"] - first["previous_distance"]
+    merged["events"] = len(notifications)
+    merged["message"] = f"{last.get('message', '')} ({len(notifications)} changes in a row)"
+    return merged
+
+
+class _SinkWorker:
+    """Delivers notifications to one sink in order, retrying with exponential backoff.
+
+    Every sink has its own thread (or task, see run_async()), so a slow push
+    provider never holds up the other sinks (or the ingest path, which only
+    queues notifications).
+    """
+
+    def __init__(self, sink, max_retries, backoff_base, backoff_max, queue_size):
+        self.sink = sink
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"notify-{sink.name}")
+        self._wakeup = None  # Set by run_async()
+        self._stop_wakeup = None  # Set by run_async(), cuts the backoff short
+        # Counters
+        self.delivered = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def put(self, notification):
+        try:
+            self.queue.put_nowait(notification)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Notification queue of sink '{self.sink.name}' is full, dropped a notification")
+            return
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def _deliver(self, notification):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.send(notification)
+                self.delivered += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries or self.stopping.is_set():
+                    self.failed += 1
+                    logger.error(f"Giving up on notification to '{self.sink.name}' after {attempt + 1} attempts: {e}")
+                    return
+                self.retries += 1
+                # Full jitter keeps many devices from retrying in lockstep
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                logger.warning(f"Notification to '{self.sink.name}' failed ({e}), retrying in {delay:.1f}s")
+                if self.stopping.wait(delay):
+                    # Shutting down: one last attempt without waiting
+                    continue
+
+    def stop(self):
+        """Deliver what is queued (retries are cut short), then end; never blocks.
+        With a full queue there is no room for the None marker, so the worker
+        also ends when it finds the queue empty after stopping."""
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if self._wakeup is not None:
+            self._wakeup()
+        if self._stop_wakeup is not None:
+            self._stop_wakeup()
+
+    def _run(self):
+        while True:
+            try:
+                notification = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            if notification is None:
+                return
+            self._deliver(notification)
+
+    # Same as _deliver(), without blocking the event loop: blocking sinks (HTTP
+    # requests) run in the default executor and the backoff waits for stopped
+    async def _deliver_async(self, notification, stopped):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                if getattr(self.sink, "blocking", True):
+                    await loop.run_in_executor(None, self.sink.send, notification)
+                else:
+                    self.sink.send(notification)
+                self.delivered += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries or self.stopping.is_set():
+                    self.failed += 1
+                    logger.error(f"Giving up on notification to '{self.sink.name}' after {attempt + 1} attempts: {e}")
+                    return
+                self.retries += 1
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                logger.warning(f"Notification to '{self.sink.name}' failed ({e}), retrying in {delay:.1f}s")
+                try:
+                    # Shutting down: one last attempt without waiting
+                    await asyncio.wait_for(stopped.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run_async(self):
+        """Deliver the queued notifications in order as a task on the running event loop."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        stopped = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        self._stop_wakeup = lambda: loop.call_soon_threadsafe(stopped.set)
+        if self.stopping.is_set():
+            stopped.set()
+        try:
+            while True:
+                try:
+                    notification = self.queue.get_nowait()
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        return
+                    await ready.wait()
+                    ready.clear()
+                    continue
+                if notification is None:
+                    return
+                await self._deliver_async(notification, stopped)
+        finally:
+            self._wakeup = None
+            self._stop_wakeup = None
+
+
+class NotificationDispatcher:
+    """Queues letter notifications and delivers them to pluggable sinks in the background.
+
+    Notifications of the same device that arrive within coalesce_window
+    seconds of the first one are merged into a single message, so an
+    "arrived, removed, arrived" burst only notifies once. submit() never
+    blocks; it only puts the notification on a queue.
+
+    start() runs the dispatcher and every sink in threads; run_async() runs
+    them as tasks on an asyncio event loop instead (async_server.py).
+    """
+
+    def __init__(self, sinks, coalesce_window=5.0, max_retries=5, backoff_base=1.0,
+                 backoff_max=60.0, queue_size=1000):
+        self.coalesce_window = coalesce_window
+        self._incoming = queue.Queue(maxsize=queue_size)
+        self._workers = [_SinkWorker(sink, max_retries, backoff_base, backoff_max, queue_size) for sink in sinks]
+        self._pending = {}  # device -> notifications waiting for the coalescing window to close
+        self._deadlines = []  # heap of (deadline, device)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._wakeup = None  # Set by run_async()
+        # Counters
+        self.submitted = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.pending = 0  # Notifications in _pending; kept by the dispatcher so stats() never iterates it
+
+    def submit(self, notification, coalesce=True):
+        """Queue a notification for delivery; returns False if the queue was full."""
+        try:
+            self._incoming.put_nowait((notification, coalesce))
+            self.submitted += 1
+            if self._wakeup is not None:
+                self._wakeup()
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Notification queue full, dropped a notification")
+            return False
+
+    @property
+    def sinks(self):
+        return [worker.sink for worker in self._workers]
+
+    def _fan_out(self, notification):
+        for worker in self._workers:
+            worker.put(notification)
+
+    def _release(self, device):
+        notifications = self._pending.pop(device, None)
+        if notifications:
+            self.pending -= len(notifications)
+            self.coalesced += len(notifications) - 1
+            self._fan_out(coalesce(notifications))
+
+    def _run(self):
+        while True:
+            # Wake up at least once a second to notice a stop() that found the queue full
+            timeout = min(max(self._deadlines[0][0] - time.monotonic(), 0), 1.0) if self._deadlines else 1.0
+            try:
+                item = self._incoming.get(timeout=timeout)
+            except queue.Empty:
+                item = None if self._stopping.is_set() else ()
+            if item is None:
+                # Shutdown: deliver what is still waiting for its window to close
+                for device in list(self._pending):
+                    self._release(device)
+                return
+            if item:
+                self._accept(item)
+            self._release_due()
+
+    def _accept(self, item):
+        notification, coalesce_it = item
+        device = notification.get("device")
+        if not coalesce_it or self.coalesce_window <= 0:
+            self._fan_out(notification)
+        elif device in self._pending:
+            self._pending[device].append(notification)
+            self.pending += 1
+        else:
+            self._pending[device] = [notification]
+            self.pending += 1
+            heapq.heappush(self._deadlines, (time.monotonic() + self.coalesce_window, device))
+
+    # Release the devices whose coalescing window has closed
+    def _release_due(self):
+        while self._deadlines and self._deadlines[0][0] <= time.monotonic():
+            _, device = heapq.heappop(self._deadlines)
+            self._release(device)
+
+    def _accept_queued(self):
+        while True:
+            try:
+                self._accept(self._incoming.get_nowait())
+            except queue.Empty:
+                return
+
+    async def run_async(self, timeout=5.0):
+        """Coalesce and deliver on the running event loop until cancelled, then
+        deliver what is still pending (retries are cut short), like stop()."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        workers = [loop.create_task(worker.run_async()) for worker in self._workers]
+        try:
+            while True:
+                self._accept_queued()
+                self._release_due()
+                delay = max(self._deadlines[0][0] - time.monotonic(), 0) if self._deadlines else None
+                try:
+                    await asyncio.wait_for(ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+        finally:
+            self._wakeup = None
+            self._accept_queued()
+            for device in list(self._pending):
+                self._release(device)
+            for worker in self._workers:
+                worker.stop()
+            await asyncio.wait(workers, timeout=timeout)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        for worker in self._workers:
+            worker.thread.start()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="notify-dispatcher")
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Deliver pending notifications (retries are cut short), then stop the threads."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        try:
+            self._incoming.put_nowait(None)
+        except queue.Full:
+            # The dispatcher ends once it has emptied the queue
+            pass
+        self._thread.join(timeout)
+        for worker in self._workers:
+            worker.stop()
+        for worker in self._workers:
+            worker.thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "dropped": self.dropped + sum(worker.dropped for worker in self._workers),
+            "coalesced": self.coalesced,
+            "pending": self.pending,
+            "sinks": {
+                worker.sink.name: {
+                    "queued": worker.queue.qsize(),
+                    "delivered": worker.delivered,
+                    "retries": worker.retries,
+                    "failed": worker.failed
+                }
+                for worker in self._workers
+            }
+        }
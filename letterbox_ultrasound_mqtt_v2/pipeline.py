@@ -0,0 +1,61 @@
+# Processing of a single reading, shared by the server and the offline tools.
+#
+# Nothing here imports Flask or paho, so replay.py can run recorded readings
+# through exactly the same code as on_message() without a broker or web server.
+
+import json
+
+import binary_payload
+from analytics import SOUND_SPEED_MM_PER_US
+
+
+# Payload dict of a raw MQTT message: the binary format (by its magic byte) or JSON.
+# Raises ValueError if it is neither, or valid JSON but not an object.
+def decode_payload(raw):
+    if binary_payload.is_binary(raw):
+        return binary_payload.decode(raw)
+    payload = json.loads(raw)
+    if not isinstance(payload, dict):
+        raise ValueError(f"Expected a JSON object, got {type(payload).__name__}")
+    return payload
+
+
+# Function to calculate distance in mm from duration in microseconds
+def calculate_distance_mm(duration):
+    # Speed of sound is 343.2 m/s or 0.3432 mm/microsecond
+    # Distance = (duration * speed of sound) / 2 (for round trip)
+    return (duration * SOUND_SPEED_MM_PER_US) / 2 if duration > 0 else 0
+
+
+# Echo times of a payload (default if it has none). Early firmware sent a single "duration".
+def payload_durations(payload, default):
+    durations = payload.get("durations")
+    if isinstance(durations, list):
+        return durations
+    if "duration" in payload:
+        return [payload["duration"]]
+    return default
+
+
+def average_distance(distances):
+    return sum(distances) / len(distances) if distances else 0
+
+
+# Human-readable message of a LetterEvent
+def letter_message(event):
+    if event.kind == "arrived":  # Distance decreased (something added to letterbox)
+        return "New letter has arrived! Distance decreased by {:.2f}mm".format(abs(event.difference))
+    # Distance increased (something removed from letterbox)
+    return "Letter removed! Distance increased by {:.2f}mm".format(abs(event.difference))
+
+
+# Notification sent for a LetterEvent of a device at the datetime when
+def letter_notification(device_id, event, when):
+    return {
+        "device": device_id,
+        "timestamp": when.strftime("%Y-%m-%d %H:%M:%S"),
+        "message": letter_message(event),
+        "previous_distance": event.previous,
+        "current_distance": event.current,
+        "difference": event.difference
+    }
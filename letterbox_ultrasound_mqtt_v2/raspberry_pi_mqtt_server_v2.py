@@ -1,23 +1,81 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, abort, g
 import json
 import time
+import queue
 import os
 import paho.mqtt.client as mqtt
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
 import pathlib
 import logging
+import atexit
+import signal
+import sys
+from history_store import HistoryStore, SegmentReader
+from history_archive import HistoryArchive
+from sqlite_store import SqliteHistoryStore
+from snapshot_writer import SnapshotWriter
+from history_buffer import HistoryBuffer
+from downsample import downsample_indices, DOWNSAMPLE_METHODS
+from event_stream import EventBroadcaster, format_sse
+from devices import DeviceRegistry, DEFAULT_DEVICE_ID
+from ingest_queue import IngestWorkerPool
+import analytics
+from analytics import durations_to_distances
+from pipeline import calculate_distance_mm, payload_durations, average_distance, letter_notification, decode_payload
+from detection import create_detector
+from detector_config import LETTER_DETECTOR
+from battery_forecast import BatteryForecaster
+from rollups import ROLLUP_TIERS, Rollups
+from notifications import NotificationDispatcher, MqttSink, WebhookSink, TechulusSink
+from metrics import MetricsRegistry
+from log_setup import configure_logging
+import binary_payload
+from replication import ReplicationServer, ReplicaClient, request_ingest
+from response_cache import ResponseCache
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("letterbox_server.log"),
-        logging.StreamHandler()
-    ]
+# Seconds from process start until the server answers requests, processes its first
+# reading and has loaded all history (see Fast Startup in README.md)
+STARTED = time.monotonic()
+startup_timings = {}
+
+# "standalone" runs everything in this process (python raspberry_pi_mqtt_server_v2.py).
+# serve.py starts one "ingest" process that owns the MQTT client and the data files, and
+# HTTP worker processes in the "replica" role that follow its state (see Production Mode in README.md).
+# async_server.py imports this module in the "async" role and runs ingest, notifications, file
+# writes and the API as tasks on one asyncio event loop instead of threads (see Async Mode in README.md).
+SERVER_ROLES = ("standalone", "ingest", "replica", "async")
+SERVER_ROLE = os.environ.get("LETTERBOX_ROLE", "standalone")
+if SERVER_ROLE not in SERVER_ROLES:
+    raise ValueError(f"Unknown server role '{SERVER_ROLE}', expected one of {', '.join(SERVER_ROLES)}")
+
+# Configure logging. Records go through a queue, so the ingest threads never wait for the SD card.
+SERVER_LOG_FILE = "letterbox_server.log"
+SERVER_LOG_LEVEL = logging.INFO
+SERVER_LOG_MAX_BYTES = 5 * 1024 * 1024  # Rotate the log at this size ...
+SERVER_LOG_ROTATE_INTERVAL = 86400  # ... or after this many seconds, whichever comes first
+SERVER_LOG_BACKUPS = 3  # Rotated log files kept
+SERVER_LOG_JSON = False  # One compact JSON object per line instead of the text format
+# Per logging call of the per-message lines (INGEST_LOGGER): burst lines at once, then rate lines
+# per second, plus every sample_every-th line beyond that. Warnings and errors always get through.
+# None logs every line (e.g. to record a log for replay.py).
+SERVER_LOG_RATE_LIMIT = {"rate": 1 / 60, "burst": 10, "sample_every": 100}
+INGEST_LOGGER = "letterbox_server.ingest.messages"
+log_listener = configure_logging(
+    # Workers log to the console only; rotating one file from several processes would lose lines
+    SERVER_LOG_FILE if SERVER_ROLE != "replica" else None,
+    level=SERVER_LOG_LEVEL,
+    max_bytes=SERVER_LOG_MAX_BYTES,
+    backup_count=SERVER_LOG_BACKUPS,
+    rotate_interval=SERVER_LOG_ROTATE_INTERVAL,
+    json_format=SERVER_LOG_JSON,
+    rate_limit=SERVER_LOG_RATE_LIMIT,
+    rate_limited_loggers=(INGEST_LOGGER,)
 )
+# Registered first so it runs last and writes the records of the other atexit handlers
+atexit.register(log_listener.stop)
 logger = logging.getLogger("letterbox_server")
+ingest_logger = logging.getLogger(INGEST_LOGGER)  # One line per message, rate-limited
 
 # Get the directory where this script is located
 script_dir = pathlib.Path(__file__).parent.absolute()
@@ -31,196 +89,526 @@ app = Flask(__name__, template_folder=templates_dir, static_folder=static_dir)
 
 # Configuration
 DATA_FILE = os.path.join(script_dir, "letterbox_data.json")
-LOG_FILE = os.path.join(script_dir, "letterbox_history.json")
+DATA_WRITE_DEBOUNCE = 5.0  # Write the current data file once no reading came in for this many seconds ...
+DATA_FLUSH_INTERVAL = 30.0  # ... but at most this often (seconds)
+DATA_MAX_STALENESS = 60.0  # Unsaved changes are written at the latest after this many seconds
+LOG_FILE = os.path.join(script_dir, "letterbox_history.json")  # Legacy history file, imported once
+HISTORY_DIR = os.path.join(script_dir, "history_segments")
+HISTORY_SEGMENT_RECORDS = 5000  # Records per segment file before rotating
+HISTORY_FSYNC_EVERY = 50  # fsync after this many appended records ...
+HISTORY_FSYNC_INTERVAL = 5.0  # ... or after this many seconds, whichever comes first
+HISTORY_LOG_RETENTION = 1000000  # Records kept in the history log, summed over all devices; older ones move to the archive
+HISTORY_BACKEND = "segments"  # "segments" (NDJSON files in HISTORY_DIR) or "sqlite" (HISTORY_DB, see migrate_to_sqlite.py)
+HISTORY_DB = os.path.join(script_dir, "letterbox_history.db")
+HISTORY_ARCHIVE_DIR = os.path.join(script_dir, "history_archive")  # Compressed day chunks of the readings that left the log
+REPLICATION_SOCKET = os.environ.get("LETTERBOX_SOCKET", os.path.join(script_dir, "letterbox_ingest.sock"))
+REPLICATION_QUEUE_SIZE = 50000  # Changes buffered per worker; a worker that falls further behind resyncs
+REPLICA_START_TIMEOUT = 120.0  # Seconds a worker waits for its first snapshot before serving anyway
 
 # MQTT Configuration
 MQTT_BROKER = "localhost"  # Use localhost for the broker connection
 MQTT_PORT = 1883
-MQTT_DATA_TOPIC = "letterbox/data"
+MQTT_DATA_TOPIC = "letterbox/data"  # Single-box topic, mapped to the "default" device
+MQTT_DEVICE_DATA_TOPIC = "letterbox/+/data"  # One topic per letterbox: letterbox/<device-id>/data
 MQTT_NOTIFICATION_TOPIC = "NewLetter"  # Topic for letter notifications
+MAX_DEVICES = 10000  # Upper limit for the number of letterboxes tracked by one server
+
+# Notification Configuration
+NOTIFICATION_COALESCE_WINDOW = 5.0  # Letter events of one device within this many seconds become one notification
+NOTIFICATION_MAX_RETRIES = 5  # Delivery attempts after the first one, with exponential backoff
+NOTIFICATION_WEBHOOK_URL = None  # e.g. "http://localhost:8080/letterbox"; None disables the webhook
+TECHULUS_API_KEY = None  # Techulus Push API key; None disables push notifications
+
+# Ingest pipeline: on_message only queues the raw payload, workers process it in batches
+INGEST_WORKERS = 2  # Worker threads; each device is always handled by the same worker
+INGEST_QUEUE_DEPTH = 10000  # Messages waiting per worker before the overflow policy applies
+INGEST_OVERFLOW_POLICY = "drop-oldest"  # "drop-oldest" or "block" (blocks the MQTT network thread)
+INGEST_BATCH_SIZE = 100  # Messages processed per batch
+
+# Live updates for the dashboard (Server-Sent Events)
+STREAM_HEARTBEAT_INTERVAL = 15  # Seconds between keepalive comments on idle streams
+STREAM_CLIENT_QUEUE_SIZE = 100  # Events buffered per client before the oldest are dropped
+event_broadcaster = EventBroadcaster(client_queue_size=STREAM_CLIENT_QUEUE_SIZE)
 
-# Initial data
-letterbox_data = {
-    "durations": [0, 0, 0],  # Array of 3 duration measurements
-    "distances": [0, 0, 0],  # Array of 3 distance measurements (calculated from durations)
-    "batteryPercentage": 0,
-    "batteryCapacity": 10000,
-    "estimatedUsedCapacity": 0,
-    "estimatedRemainingTime": 0,
-    "runTimeHours": 0,
-    "powerSource": "USB Accumulator",
-    "timestamp": "Never",
-    "lastUpdateTime": "Never"
-}
-
-# Variable to store the previous average distance for letter detection
-previous_avg_distance = 0
-LETTER_DETECTION_THRESHOLD = 5  # 5mm threshold for letter detection
-
-# Function to calculate distance in mm from duration in microseconds
-def calculate_distance_mm(duration):
-    # Speed of sound is 343.2 m/s or 0.3432 mm/microsecond
-    # Distance = (duration * speed of sound) / 2 (for round trip)
-    return (duration * 0.3432) / 2 if duration > 0 else 0
+# Keeps ETags from a previous server run from matching the new state
+STATE_EPOCH = format(int(time.time()), 'x')
+
+# Serialized (and gzip/brotli compressed) /api/data and /api/history bodies, kept
+# until the device's data or history changes
+RESPONSE_CACHE_ENTRIES = 256  # Cached responses over all devices and query parameters
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024  # Upper limit for the cached bodies, compressed variants included
+RESPONSE_COMPRESS_MIN_SIZE = 512  # Smaller bodies are always sent uncompressed
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_COMPRESS_MIN_SIZE)
+
+# The letter detector used for every device (LETTER_DETECTOR) is set in detector_config.py,
+# which replay.py imports as well
+
+# Server-side battery forecast per letterbox (see battery_forecast.py): half-life of the
+# drain rate estimates in hours, and z of the time-to-empty bounds (1.96 for about 95%)
+BATTERY_FORECAST = {"half_life_hours": 6.0, "z": 1.96}
 
 # History data for the graph
-letterbox_history = []
-MAX_HISTORY_ENTRIES = 1000  # Limit the number of entries to prevent the file from growing too large
+MAX_HISTORY_ENTRIES = 1000000  # Samples kept in memory per device (~44 bytes each, about 4 months at 10 s intervals)
+HISTORY_CHUNK_SIZE = 4096  # Samples per column chunk; eviction drops whole chunks
+MAX_HISTORY_POINTS = 10000  # Upper limit for the points= parameter of /api/history
+STATS_DEFAULT_WINDOW = 30  # Samples per rolling window in /api/stats (5 minutes at 10 s intervals)
+SQLITE_HISTORY_ENTRIES = 50000  # With the sqlite backend: samples kept in memory per device, older ones are read from the database
+
+# Minute/hour/day aggregates of every device, kept much longer than the raw samples
+ROLLUP_FILE = os.path.join(script_dir, "letterbox_rollups.json")
+ROLLUP_RETENTION = {"minute": 60 * 24 * 14, "hour": 24 * 400, "day": 365 * 10}  # Buckets kept per tier
+ROLLUP_WRITE_DEBOUNCE = 60.0  # Write the rollup file once no reading came in for this many seconds ...
+ROLLUP_FLUSH_INTERVAL = 300.0  # ... but at most this often (seconds)
+ROLLUP_MAX_STALENESS = 600.0  # At the latest after this many seconds; newer rollups are also rebuilt from the history log on startup
+ROLLUP_TIER_NAMES = ("auto", "raw") + tuple(name for name, _ in ROLLUP_TIERS)  # Values of the tier= parameter
+
+# Metrics served on /metrics in the Prometheus text format. Recording is lock-free;
+# the gauges and counter functions are only evaluated when scraped.
+metrics = MetricsRegistry()
+messages_received = metrics.counter("letterbox_messages_received_total",
+                                    "MQTT messages received, by subscribed topic", ("topic",))
+decode_errors = metrics.counter("letterbox_decode_errors_total", "MQTT messages that could not be decoded")
+binary_payloads = metrics.counter("letterbox_binary_payloads_total", "MQTT messages in the binary payload format")
+ingest_stage_seconds = metrics.histogram("letterbox_ingest_stage_seconds",
+                                         "Ingest time per stage (parse, detect and publish per message, persist per batch)",
+                                         ("stage",))
+ingest_lag_seconds = metrics.histogram("letterbox_ingest_lag_seconds", "Time from MQTT receipt until a message is processed")
+snapshot_write_seconds = metrics.histogram("letterbox_snapshot_write_seconds",
+                                           "Duration of current data and rollup file writes", ("file",))
+history_sync_seconds = metrics.histogram("letterbox_history_sync_seconds",
+                                         "Duration of history log fsyncs or database commits")
+mqtt_connects = metrics.counter("letterbox_mqtt_connects_total", "Connections to the MQTT broker, including reconnects")
+mqtt_disconnects = metrics.counter("letterbox_mqtt_unexpected_disconnects_total", "Unexpected MQTT disconnections")
+http_request_seconds = metrics.histogram("letterbox_http_request_seconds", "HTTP handler latency", ("route", "method"))
+http_responses = metrics.counter("letterbox_http_responses_total", "HTTP responses", ("route", "status"))
+metrics.counter_function("letterbox_response_cache_lookups_total", "Response cache hits and misses",
+                         lambda: [(("hit",), response_cache.hits), (("miss",), response_cache.misses)], ("result",))
+metrics.gauge("letterbox_response_cache_bytes", "Bytes of cached response bodies", lambda: response_cache.size_bytes)
+# Recorded by each HTTP worker itself (see /metrics)
+HTTP_METRIC_NAMES = (http_request_seconds.name, http_responses.name,
+                     "letterbox_response_cache_lookups_total", "letterbox_response_cache_bytes")
+metrics.gauge("letterbox_devices", "Letterboxes known to the server", lambda: len(devices))
+metrics.gauge("letterbox_history_entries", "History entries in memory, summed over all devices",
+              lambda: sum(len(device.history) for device in devices))
+metrics.gauge("letterbox_ingest_queue_depth", "Messages waiting for an ingest worker",
+              lambda: ingest_pool.stats()["queueDepth"])
+metrics.counter_function("letterbox_ingest_dropped_messages_total", "Messages dropped by full ingest queues",
+                         lambda: ingest_pool.stats()["dropped"])
+metrics.gauge("letterbox_startup_seconds", "Seconds from process start until each startup phase finished",
+              lambda: [((phase,), seconds) for phase, seconds in list(startup_timings.items())], ("phase",))
+metrics.gauge("letterbox_history_archive_bytes", "Compressed size of the history archive",
+              lambda: history_archive.stats()["bytes"])
+metrics.gauge("letterbox_stream_clients", "Connected Server-Sent Events clients", lambda: event_broadcaster.client_count)
+metrics.counter_function("letterbox_notifications_total", "Notifications per sink and outcome",
+                         lambda: [((sink, outcome), stats[outcome])
+                                  for sink, stats in notification_dispatcher.stats()["sinks"].items()
+                                  for outcome in ("delivered", "retries", "failed")],
+                         ("sink", "outcome"))
+
+# History buffers only allocate memory as samples arrive, so idle devices stay small
+def new_history_buffer():
+    capacity = SQLITE_HISTORY_ENTRIES if HISTORY_BACKEND == "sqlite" else MAX_HISTORY_ENTRIES
+    return HistoryBuffer(capacity, chunk_size=HISTORY_CHUNK_SIZE, distance_fn=calculate_distance_mm)
+
+# State of all letterboxes, keyed by device ID
+devices = DeviceRegistry(new_history_buffer, lambda: Rollups(ROLLUP_RETENTION),
+                         lambda: create_detector(LETTER_DETECTOR), lambda: BatteryForecaster(**BATTERY_FORECAST),
+                         max_devices=MAX_DEVICES)
+default_device = devices.get_or_create(DEFAULT_DEVICE_ID)
+
+# Readings that compaction removes from the history log; workers only read it
+history_archive = HistoryArchive(HISTORY_ARCHIVE_DIR, read_only=SERVER_ROLE == "replica")
+
+# History log on disk, shared by all devices. Both backends have the same
+# interface; only the sqlite one supports range queries (supports_queries).
+def open_history_store():
+    # Workers only read; the segment files belong to the ingest process
+    if SERVER_ROLE == "replica" and HISTORY_BACKEND != "sqlite":
+        return SegmentReader(HISTORY_DIR, retention_records=HISTORY_LOG_RETENTION)
+    if HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryStore(HISTORY_DB, retention_records=HISTORY_LOG_RETENTION,
+                                  sync_observer=history_sync_seconds.observe,
+                                  on_expire=history_archive.append_records)
+    return HistoryStore(
+        HISTORY_DIR,
+        segment_max_records=HISTORY_SEGMENT_RECORDS,
+        retention_records=HISTORY_LOG_RETENTION,
+        fsync_every=HISTORY_FSYNC_EVERY,
+        fsync_interval=HISTORY_FSYNC_INTERVAL,
+        sync_observer=history_sync_seconds.observe,
+        on_expire=history_archive.append_records
+    )
+
+history_store = open_history_store()
+
+# Current data of all devices as written to DATA_FILE
+def data_file_state():
+    return {"devices": {device.device_id: device.data for device in devices}}
+
+# Background writer for the current data file
+data_writer = SnapshotWriter(DATA_FILE, flush_interval=DATA_FLUSH_INTERVAL,
+                             max_staleness=DATA_MAX_STALENESS, debounce=DATA_WRITE_DEBOUNCE,
+                             state_fn=data_file_state,
+                             observer=lambda seconds: snapshot_write_seconds.observe(seconds, "data"))
+
+# Rollups of all devices as written to ROLLUP_FILE. The ingest worker changes
+# them under the device lock, so each device is copied under it too.
+def rollup_file_state():
+    state = {"devices": {}, "forecasts": {}}
+    for device in devices:
+        with device.lock:
+            state["devices"][device.device_id] = device.rollups.to_dict()
+            state["forecasts"][device.device_id] = device.forecast.to_dict()
+    return state
+
+# Background writer for the rollup file
+rollup_writer = SnapshotWriter(ROLLUP_FILE, flush_interval=ROLLUP_FLUSH_INTERVAL,
+                               max_staleness=ROLLUP_MAX_STALENESS, debounce=ROLLUP_WRITE_DEBOUNCE,
+                               state_fn=rollup_file_state,
+                               observer=lambda seconds: snapshot_write_seconds.observe(seconds, "rollups"))
 
 # Load data from file if exists
 def load_data():
-    global letterbox_data, letterbox_history, previous_avg_distance
     try:
-        if os.path.exists(DATA_FILE):
+        if os.path.exists(DATA_FILE) and os.path.getsize(DATA_FILE) > 0:
             with open(DATA_FILE, 'r') as f:
-                letterbox_data = json.load(f)
-            logger.info("Current data loaded from file")
-            
-            # Initialize previous_avg_distance from loaded data
-            if "distances" in letterbox_data and isinstance(letterbox_data["distances"], list) and len(letterbox_data["distances"]) > 0:
-                previous_avg_distance = sum(letterbox_data["distances"]) / len(letterbox_data["distances"])
+                saved = json.load(f)
+            # Files written before multi-device support hold a single device
+            saved_devices = saved["devices"] if "devices" in saved else {DEFAULT_DEVICE_ID: saved}
+            for device_id, data in saved_devices.items():
+                device = devices.get_or_create(device_id)
+                if device is None:
+                    continue
+                device.set_data(data)
+                
+                # Initialize the detection baseline from loaded data
+                if "distances" in data and isinstance(data["distances"], list) and len(data["distances"]) > 0:
+                    device.detector.prime(sum(data["distances"]) / len(data["distances"]))
+            logger.info(f"Current data loaded from file ({len(saved_devices)} devices)")
         
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, 'r') as f:
-                letterbox_history = json.load(f)
-            logger.info(f"History data loaded from file ({len(letterbox_history)} entries)")
+        load_rollups()
+        # Only the segments with entries the saved rollups do not include yet are
+        # replayed here; older history follows in the background (load_older_history)
+        folded_seqs = {device.device_id: device.rollups.last_seq for device in devices}
+        recent, older, last_seqs = history_store.load_lazily(folded_seqs)
+        for record in recent:
+            device = devices.get_or_create(record.pop("device", DEFAULT_DEVICE_ID))
+            if device is None:
+                continue
+            if record.get("cleared"):
+                device.history.clear()
+                history_complete.add(device.device_id)
+                # Rollups saved after the clear already start from scratch
+                if record.get("seq", device.rollups.last_seq) >= device.rollups.last_seq:
+                    device.rollups.clear()
+            else:
+                add_to_rollups(device, device.history.append(record))
+        # New readings get sequence numbers after those still being loaded
+        for device_id, seq in last_seqs.items():
+            device = devices.get_or_create(device_id)
+            if device is not None:
+                device.history.continue_after(seq)
+        if not history_store.has_records():
+            import_legacy_history()
+        logger.info(f"Recent history loaded ({sum(len(device.history) for device in devices)} entries)")
     except Exception as e:
         logger.error(f"Error loading data: {e}")
+        older = iter(())
+    # Publish what was loaded to the API
+    for device in devices:
+        with device.lock:
+            device.mark_history_changed()
+    threading.Thread(target=load_older_history, args=(older,), name="history-loader", daemon=True).start()
+
+# Devices whose history needs nothing from older segments (cleared since the split point)
+history_complete = set()
+history_loaded = threading.Event()
+
+# Prepend the older history segments (newest first) to the devices while ingest runs.
+# Each segment becomes queryable as soon as it is in memory.
+def load_older_history(batches):
+    count = 0
+    try:
+        for batch in batches:
+            by_device = {}
+            cleared = set()
+            for record in batch:
+                device_id = record.pop("device", DEFAULT_DEVICE_ID)
+                if device_id in history_complete:
+                    continue
+                if record.get("cleared"):
+                    # Only what was logged after the clear belongs to the current history
+                    by_device[device_id] = []
+                    cleared.add(device_id)
+                else:
+                    by_device.setdefault(device_id, []).append(record)
+            for device_id, records in by_device.items():
+                device = devices.get_or_create(device_id)
+                if device is None or not records:
+                    continue
+                with device.lock:
+                    # Cleared while this segment was read
+                    if device_id in history_complete:
+                        continue
+                    count += device.history.prepend(records)
+                    device.mark_history_changed()
+            history_complete.update(cleared)
+    except Exception as e:
+        logger.error(f"Error loading older history: {e}")
+    startup_timings["historyLoaded"] = time.monotonic() - STARTED
+    history_loaded.set()
+    logger.info(f"Older history loaded ({count} entries) after {startup_timings['historyLoaded']:.1f}s")
+    history_store.start_compaction()
+
+# Load the saved rollups; entries newer than the file are folded in again while the history log is replayed
+def load_rollups():
+    try:
+        if not os.path.exists(ROLLUP_FILE) or os.path.getsize(ROLLUP_FILE) == 0:
+            return
+        with open(ROLLUP_FILE, 'r') as f:
+            saved = json.load(f)
+        for device_id, rollups in saved.get("devices", {}).items():
+            device = devices.get_or_create(device_id)
+            if device is not None:
+                device.rollups.load_dict(rollups)
+        for device_id, forecast in saved.get("forecasts", {}).items():
+            device = devices.get_or_create(device_id)
+            if device is not None:
+                device.forecast.load_dict(forecast)
+        logger.info(f"Rollups loaded from file ({len(saved.get('devices', {}))} devices)")
+    except Exception as e:
+        logger.error(f"Error loading rollups: {e}")
 
-# Save data to file
+# Import the old single-file history into the segment log (runs once, when the log is empty)
+def import_legacy_history():
+    if not os.path.exists(LOG_FILE) or os.path.getsize(LOG_FILE) == 0:
+        return
+    with open(LOG_FILE, 'r') as f:
+        legacy_history = json.load(f)
+    for entry in legacy_history:
+        append_history(default_device, entry)
+    history_store.flush()
+    logger.info(f"Imported {len(legacy_history)} entries from {LOG_FILE}")
+
+# Mark the current data as changed for the background writer (written atomically and debounced)
 def save_data():
     try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump(letterbox_data, f)
-        logger.info("Current data saved to file")
+        data_writer.update()
     except Exception as e:
         logger.error(f"Error saving current data: {e}")
 
-# Save history data to file
-def save_history():
+# Fold the newest history entry of a device (with sequence number seq) into its rollup tiers and battery forecast
+def add_to_rollups(device, seq):
+    history = device.history
+    ts = history.newest_ts
+    device.rollups.add(seq, ts, history.newest("avg_distance"), history.newest("battery"))
+    device.forecast.update(seq, ts, history.newest("used_capacity"))
+
+# Append a history entry of a device to memory; returns the record for the segment log
+def add_history_entry(device, entry):
+    # The buffer evicts the oldest samples itself once it is full
+    with device.lock:
+        entry["seq"] = device.history.append(entry)
+        add_to_rollups(device, entry["seq"])
+        device.mark_history_changed()
+    return entry if device is default_device else dict(entry, device=device.device_id)
+
+# Append a history entry of a device to memory and to the segment log
+def append_history(device, entry):
+    record = add_history_entry(device, entry)
     try:
-        # Limit the size of the history
-        global letterbox_history
-        if len(letterbox_history) > MAX_HISTORY_ENTRIES:
-            letterbox_history = letterbox_history[-MAX_HISTORY_ENTRIES:]
-        
-        with open(LOG_FILE, 'w') as f:
-            json.dump(letterbox_history, f)
-        logger.info(f"History data saved to file ({len(letterbox_history)} entries)")
+        history_store.append(record)
     except Exception as e:
-        logger.error(f"Error saving history data: {e}")
+        logger.error(f"Error appending history entry: {e}")
+
+# Drop the history of a device. The shared log gets a marker record, so the
+# cleared entries are skipped on replay until compaction removes them.
+def clear_device_history(device):
+    with device.lock:
+        device.history.clear()
+        device.rollups.clear()
+        history_complete.add(device.device_id)
+        device.mark_history_changed()
+    # seq tells the replay whether the saved rollups are older than the clear
+    marker = {"device": device.device_id, "cleared": True, "seq": device.history.last_seq, "ts": time.time()}
+    history_store.append(marker)
+    history_store.flush()
+    history_archive.clear(device.device_id, marker["ts"])
+    rollup_writer.update()
+    replicate({"type": "cleared", "device": device.device_id, "seq": device.history.last_seq})
 
 # Function to check for letter status changes
-def check_letter_status(current_avg_distance):
-    global previous_avg_distance, mqtt_client
-    
-    # Skip if this is the first measurement
-    if previous_avg_distance == 0:
-        previous_avg_distance = current_avg_distance
+def check_letter_status(device, current_avg_distance):
+    # Let the device's detector decide whether the level changed
+    event = device.detector.update(current_avg_distance)
+    if event is None:
         return
     
-    # Calculate the difference between current and previous average distance
-    distance_diff = current_avg_distance - previous_avg_distance
-    
-    # Check if the difference exceeds the threshold
-    if abs(distance_diff) > LETTER_DETECTION_THRESHOLD:
-        message = ""
-        if distance_diff < 0:  # Distance decreased (something added to letterbox)
-            message = "New letter has arrived! Distance decreased by {:.2f}mm".format(abs(distance_diff))
-            logger.info(message)
-        else:  # Distance increased (something removed from letterbox)
-            message = "Letter removed! Distance increased by {:.2f}mm".format(abs(distance_diff))
-            logger.info(message)
-        
-        # Publish notification to MQTT topic
-        try:
-            notification = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "message": message,
-                "previous_distance": previous_avg_distance,
-                "current_distance": current_avg_distance,
-                "difference": distance_diff
-            }
-            mqtt_client.publish(MQTT_NOTIFICATION_TOPIC, json.dumps(notification))
-            logger.info(f"Published notification to {MQTT_NOTIFICATION_TOPIC}")
-        except Exception as e:
-            logger.error(f"Error publishing notification: {e}")
+    notification = letter_notification(device.device_id, event, datetime.now())
+    logger.info(f"[{device.device_id}] {notification['message']}")
     
-    # Update previous average distance
-    previous_avg_distance = current_avg_distance
+    # Queue the notification for the sinks (MQTT topic, webhook, push) and tell the dashboards
+    try:
+        notification_dispatcher.submit(notification)
+        event_broadcaster.publish("letter", notification, device.device_id)
+        replicate({"type": "letter", "device": device.device_id, "notification": notification})
+    except Exception as e:
+        logger.error(f"Error publishing notification: {e}")
+
+# Device ID of a data topic: "letterbox/data" -> default, "letterbox/<id>/data" -> <id>
+def device_id_from_topic(topic):
+    if topic == MQTT_DATA_TOPIC:
+        return DEFAULT_DEVICE_ID
+    parts = topic.split('/')
+    if len(parts) == 3 and parts[0] == "letterbox" and parts[2] == "data":
+        return parts[1]
+    return None
 
 # MQTT callbacks
 def on_connect(client, userdata, flags, reason_code, properties=None):
     logger.info(f"Connected to MQTT broker with result code {reason_code}")
+    mqtt_connects.inc()
     # Subscribe to topics
-    client.subscribe(MQTT_DATA_TOPIC)
+    client.subscribe([(MQTT_DATA_TOPIC, 0), (MQTT_DEVICE_DATA_TOPIC, 0)])
 
 def on_message(client, userdata, msg, properties=None):
-    global letterbox_data, letterbox_history
+    # Only route the raw payload to an ingest worker; parsing, detection and
+    # persistence happen in process_batch() so the network loop never waits
+    device_id = device_id_from_topic(msg.topic)
+    # Count per subscription, not per letterbox, to keep the number of series small
+    messages_received.inc(msg.topic if device_id in (None, DEFAULT_DEVICE_ID) else MQTT_DEVICE_DATA_TOPIC)
+    if device_id is None:
+        return
+    if not ingest_pool.submit(device_id, (device_id, msg.topic, msg.payload, time.time())):
+        logger.warning("Ingest queue full, dropped the oldest queued message")
+
+# Process one decoded reading of a device; returns the new history entry.
+# distances can be passed in when they were already calculated for the whole batch.
+def process_reading(device, payload, received_at, distances=None):
+    # Get time the message was received
+    now = datetime.fromtimestamp(received_at)
+    current_time = now.strftime("%H:%M:%S")
+    current_date = now.strftime("%Y-%m-%d")
+    data = device.data
+    
+    # Get durations array from payload
+    durations = payload_durations(payload, data["durations"])
+    
+    # Calculate distances in mm from durations
+    if distances is None or "durations" not in payload:
+        distances = [calculate_distance_mm(duration) for duration in durations]
+    
+    # Calculate average distance
+    avg_distance = average_distance(distances)
     
-    # Get current time
-    current_time = datetime.now().strftime("%H:%M:%S")
-    current_date = datetime.now().strftime("%Y-%m-%d")
+    # Check for letter status changes
+    check_letter_status(device, avg_distance)
     
+    # Publish a new dict (rather than modify the old one), so readers always see a complete one
+    device.set_data(dict(data, **{
+        "durations": durations,
+        "distances": distances,  # Calculated from durations
+        "batteryPercentage": payload.get("batteryPercentage", data["batteryPercentage"]),
+        "batteryCapacity": payload.get("batteryCapacity", data["batteryCapacity"]),
+        "estimatedUsedCapacity": payload.get("estimatedUsedCapacity", data["estimatedUsedCapacity"]),
+        "estimatedRemainingTime": payload.get("estimatedRemainingTime", data["estimatedRemainingTime"]),
+        "runTimeHours": payload.get("runTimeHours", data["runTimeHours"]),
+        "powerSource": payload.get("powerSource", data["powerSource"]),
+        "timestamp": payload.get("timestamp", data["timestamp"]),
+        "lastUpdateTime": current_time
+    }))
+    
+    # Add to history with timestamp for the graph
+    return {
+        "ts": received_at,
+        "date": current_date,
+        "time": current_time,
+        "durations": durations,
+        "distances": distances,
+        "avg_distance": avg_distance,
+        "batteryPercentage": payload.get("batteryPercentage", 0),
+        "estimatedUsedCapacity": payload.get("estimatedUsedCapacity", 0)
+    }
+
+# Process a batch of queued messages: parse and detect per message, then
+# persist the whole batch with one history write and one data update
+def process_batch(batch):
+    decoded = []
+    for _, (device_id, topic, raw_payload, received_at) in batch:
+        ingest_lag_seconds.observe(time.time() - received_at)
+        started = time.perf_counter()
+        try:
+            # Decode the binary or JSON message
+            payload = decode_payload(raw_payload)
+            if binary_payload.is_binary(raw_payload):
+                binary_payloads.inc()
+            ingest_logger.info(f"Received message on topic {topic}: {payload}")
+            decoded.append((device_id, payload, received_at))
+        except ValueError as e:
+            decode_errors.inc()
+            logger.error(f"Error decoding payload: {e}")
+        ingest_stage_seconds.observe(time.perf_counter() - started, "parse")
+    
+    # Convert the durations of the whole batch to distances at once
     try:
-        # Decode and parse the JSON message
-        payload = json.loads(msg.payload.decode())
-        logger.info(f"Received message on topic {msg.topic}: {payload}")
-        
-        if msg.topic == MQTT_DATA_TOPIC:
-            # Get durations array from payload
-            durations = payload.get("durations", letterbox_data["durations"])
-            
-            # Calculate distances in mm from durations
-            distances = [calculate_distance_mm(duration) for duration in durations]
-            
-            # Calculate average distance
-            avg_distance = sum(distances) / len(distances) if distances else 0
-            
-            # Check for letter status changes
-            check_letter_status(avg_distance)
-            
-            # Update our data storage with incoming data
-            letterbox_data.update({
-                "durations": durations,
-                "distances": distances,  # Calculated from durations
-                "batteryPercentage": payload.get("batteryPercentage", letterbox_data["batteryPercentage"]),
-                "batteryCapacity": payload.get("batteryCapacity", letterbox_data["batteryCapacity"]),
-                "estimatedUsedCapacity": payload.get("estimatedUsedCapacity", letterbox_data["estimatedUsedCapacity"]),
-                "estimatedRemainingTime": payload.get("estimatedRemainingTime", letterbox_data["estimatedRemainingTime"]),
-                "runTimeHours": payload.get("runTimeHours", letterbox_data["runTimeHours"]),
-                "powerSource": payload.get("powerSource", letterbox_data["powerSource"]),
-                "timestamp": payload.get("timestamp", letterbox_data["timestamp"]),
-                "lastUpdateTime": current_time
-            })
-            
-            # Add to history with timestamp for the graph
-            history_entry = {
-                "date": current_date,
-                "time": current_time,
-                "durations": durations,
-                "distances": distances,
-                "avg_distance": avg_distance,
-                "batteryPercentage": payload.get("batteryPercentage", 0),
-                "estimatedUsedCapacity": payload.get("estimatedUsedCapacity", 0)
-            }
-            letterbox_history.append(history_entry)
-            
-            # Save updated data
-            save_data()
+        batch_distances = durations_to_distances([
+            payload["durations"] if isinstance(payload.get("durations"), list) else []
+            for _, payload, _ in decoded
+        ])
+    except (TypeError, ValueError):
+        batch_distances = [None] * len(decoded)
+    
+    records = []
+    changes = []
+    for (device_id, payload, received_at), distances in zip(decoded, batch_distances):
+        try:
+            device = devices.get_or_create(device_id)
+            if device is None:
+                logger.warning(f"Ignoring message from unknown or invalid device '{device_id}'")
+                continue
             
-            # Save history periodically (every 10 entries to avoid excessive writes)
-            if len(letterbox_history) % 10 == 0:
-                save_history()
+            started = time.perf_counter()
+            history_entry = process_reading(device, payload, received_at, distances)
+            records.append(add_history_entry(device, history_entry))
+            changes.append((device, history_entry))
+            ingest_stage_seconds.observe(time.perf_counter() - started, "detect")
             
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON: {e}")
-    except Exception as e:
-        logger.error(f"Error processing message: {e}")
+            # Push the new reading to connected dashboards
+            started = time.perf_counter()
+            event_broadcaster.publish("reading", {"device": device_id, "data": device.data, "entry": history_entry}, device_id)
+            ingest_stage_seconds.observe(time.perf_counter() - started, "publish")
+        except Exception as e:
+            logger.error(f"Error processing message: {e}")
+    
+    if records:
+        if "firstIngest" not in startup_timings:
+            startup_timings["firstIngest"] = time.monotonic() - STARTED
+            logger.info(f"First reading processed {startup_timings['firstIngest']:.2f}s after startup")
+        started = time.perf_counter()
+        try:
+            history_store.append_many(records)
+        except Exception as e:
+            logger.error(f"Error appending history entries: {e}")
+        # Save updated data
+        save_data()
+        rollup_writer.update()
+        ingest_stage_seconds.observe(time.perf_counter() - started, "persist")
+        # Only after the history write, so a worker that loads the log meanwhile misses nothing
+        for device, history_entry in changes:
+            replicate({"type": "reading", "device": device.device_id, "record": history_entry, "data": device.data})
+
+ingest_pool = IngestWorkerPool(
+    process_batch,
+    workers=INGEST_WORKERS,
+    queue_depth=INGEST_QUEUE_DEPTH,
+    overflow_policy=INGEST_OVERFLOW_POLICY,
+    batch_size=INGEST_BATCH_SIZE
+)
 
 # MQTT error callback
 def on_disconnect(client, userdata, rc, properties=None):
     if rc != 0:
+        mqtt_disconnects.inc()
         logger.error(f"Unexpected MQTT disconnection with code {rc}. Will attempt to reconnect.")
     else:
         logger.info("MQTT client disconnected successfully")
@@ -231,82 +619,551 @@ mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
 mqtt_client.on_disconnect = on_disconnect
 
+# Notification sinks; delivery runs in background threads so ingest never waits for them
+def notification_sinks():
+    sinks = [MqttSink(mqtt_client, MQTT_NOTIFICATION_TOPIC)]
+    if NOTIFICATION_WEBHOOK_URL:
+        sinks.append(WebhookSink(NOTIFICATION_WEBHOOK_URL))
+    if TECHULUS_API_KEY:
+        sinks.append(TechulusSink(TECHULUS_API_KEY))
+    return sinks
+
+notification_dispatcher = NotificationDispatcher(
+    notification_sinks(),
+    coalesce_window=NOTIFICATION_COALESCE_WINDOW,
+    max_retries=NOTIFICATION_MAX_RETRIES
+)
+
+# Commands the HTTP workers run in the ingest process (call_ingest), because they
+# change files or use the MQTT client that only the ingest process has
+ingest_commands = {}
+
+def ingest_command(name):
+    def register(fn):
+        ingest_commands[name] = fn
+        return fn
+    return register
+
+# Run an ingest command here, or in the ingest process when this is a worker
+def call_ingest(name, **fields):
+    if SERVER_ROLE == "replica":
+        return request_ingest(REPLICATION_SOCKET, name, **fields)
+    return ingest_commands[name](**fields)
+
+@ingest_command("clear-history")
+def clear_history_command(device):
+    target = devices.get(device)
+    if target is None:
+        raise KeyError(f"Unknown device '{device}'")
+    clear_device_history(target)
+
+@ingest_command("test-notification")
+def test_notification_command(device):
+    notification_dispatcher.submit({
+        "device": device,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "message": "This is a test notification from your Smart Letterbox"
+    }, coalesce=False)
+
+ingest_command("ingest-stats")(lambda: dict(ingest_pool.stats(), startup=dict(startup_timings),
+                                            historyLoading=not history_loaded.is_set()))
+ingest_command("notification-stats")(lambda: notification_dispatcher.stats())
+ingest_command("metrics")(lambda http=True: metrics.expose(None if http else lambda name: name not in HTTP_METRIC_NAMES))
+
+# What a worker needs besides the history log when it (re)subscribes
+def replication_snapshot():
+    # Everything appended so far has to be readable before the worker loads the log
+    history_store.flush()
+    return {"data": {device.device_id: device.data for device in devices}}
+
+replication_server = ReplicationServer(REPLICATION_SOCKET, replication_snapshot, ingest_commands,
+                                       queue_size=REPLICATION_QUEUE_SIZE) if SERVER_ROLE == "ingest" else None
+
+# Send a state change to the HTTP workers (ingest role only)
+def replicate(message):
+    if replication_server is not None:
+        replication_server.publish(message)
+
+# Apply a history record in a worker. Records it already has (by seq) are skipped,
+# so the overlap between the loaded log and the queued changes does no harm.
+def apply_history_record(device, record):
+    seq = record.get("seq")
+    with device.lock:
+        if record.get("cleared"):
+            if seq is None or seq >= device.history.last_seq:
+                device.history.clear()
+                if seq is None or seq >= device.rollups.last_seq:
+                    device.rollups.clear()
+                device.mark_history_changed()
+            return False
+        if seq is not None and seq <= device.history.last_seq:
+            return False
+        add_to_rollups(device, device.history.append(record))
+        device.mark_history_changed()
+    return True
+
+# Worker: (re)build the state from the history log and the snapshot of the ingest process
+def resync_replica(snapshot):
+    for device_id, data in snapshot.get("data", {}).items():
+        device = devices.get_or_create(device_id)
+        if device is not None:
+            device.set_data(data)
+    count = 0
+    for record in history_store.load():
+        device = devices.get_or_create(record.pop("device", DEFAULT_DEVICE_ID))
+        if device is not None and apply_history_record(device, record):
+            count += 1
+    logger.info(f"Worker synced {count} new history entries ({len(devices)} devices)")
+
+# Worker: apply one change published by the ingest process
+def apply_replicated_change(message):
+    device = devices.get_or_create(message.get("device", DEFAULT_DEVICE_ID))
+    if device is None:
+        return
+    kind = message.get("type")
+    if kind == "reading":
+        device.set_data(message["data"])
+        entry = message["record"]
+        if apply_history_record(device, dict(entry)):
+            event_broadcaster.publish("reading", {"device": device.device_id, "data": device.data, "entry": entry}, device.device_id)
+    elif kind == "cleared":
+        apply_history_record(device, {"cleared": True, "seq": message.get("seq")})
+    elif kind == "letter":
+        event_broadcaster.publish("letter", message["notification"], device.device_id)
+
+replica_client = ReplicaClient(REPLICATION_SOCKET, resync_replica, apply_replicated_change) if SERVER_ROLE == "replica" else None
+
 # Load data at startup
-load_data()
+if SERVER_ROLE == "replica":
+    # Rollups come from the file; the log replay in resync_replica() adds the newer entries
+    load_rollups()
+    replica_client.start()
+    if not replica_client.wait_ready(REPLICA_START_TIMEOUT):
+        logger.warning(f"No snapshot from the ingest process after {REPLICA_START_TIMEOUT}s, serving until it arrives")
+    atexit.register(history_store.close)
+    atexit.register(replica_client.stop)
+else:
+    load_data()
+    if SERVER_ROLE != "async":
+        # async_server.py runs them as tasks on its event loop instead
+        data_writer.start()
+        rollup_writer.start()
+        notification_dispatcher.start()
+        ingest_pool.start()
+    # atexit runs these in reverse order: drain the ingest queues first, then flush
+    atexit.register(history_store.close)
+    atexit.register(data_writer.stop)
+    atexit.register(rollup_writer.stop)
+    atexit.register(notification_dispatcher.stop)
+    atexit.register(ingest_pool.stop)
+    if replication_server is not None:
+        replication_server.start()
+        atexit.register(replication_server.stop)
+startup_timings["ready"] = time.monotonic() - STARTED
+logger.info(f"Ready after {startup_timings['ready']:.2f}s")
+
+# Look up a device for an API route, or answer with 404
+def get_device_or_404(device_id):
+    device = devices.get(device_id)
+    if device is None:
+        abort(404, description=f"Unknown device '{device_id}'")
+    return device
+
+# Request latency and status per route pattern (not per URL, so device IDs don't create series)
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    started = g.get("request_started")
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, route, request.method)
+    http_responses.inc(route, str(response.status_code))
+    return response
 
 # Routes
 @app.route('/')
 def index():
-    return render_template('index.html', data=letterbox_data)
+    return render_template('index.html', data=default_device.data, device_id=DEFAULT_DEVICE_ID, api_base='/api')
+
+@app.route('/devices/<device_id>')
+def device_index(device_id):
+    device = get_device_or_404(device_id)
+    return render_template('index.html', data=device.data, device_id=device_id, api_base=f'/api/devices/{device_id}')
+
+# JSON response with ETag/Last-Modified revalidation. The body is serialized
+# once per ETag and served from the response cache until the version of
+# cache_group changes.
+def conditional_json(etag, last_modified, build, cache_group, version):
+    last_modified = last_modified.replace(microsecond=0).astimezone()
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        not_modified = last_modified <= request.if_modified_since
+    else:
+        not_modified = False
+    
+    if not_modified:
+        response = Response(status=304)
+    else:
+        body, encoding = response_cache.body(cache_group, version, etag,
+                                             lambda: app.json.dumps(build(), separators=(",", ":")).encode(),
+                                             request.accept_encodings)
+        response = Response(body, mimetype="application/json")
+        if encoding:
+            response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Let browsers cache the body but always revalidate it
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def device_data_response(device):
+    state = device.snapshot
+    return conditional_json(f"data-{STATE_EPOCH}-{device.device_id}-{state.data_version}", state.data_modified,
+                            lambda: state.data, ("data", device.device_id), state.data_version)
 
 @app.route('/api/data')
 def get_data():
-    return jsonify(letterbox_data)
+    return device_data_response(default_device)
 
-@app.route('/api/history')
-def get_history():
+@app.route('/api/devices/<device_id>/data')
+def get_device_data(device_id):
+    return device_data_response(get_device_or_404(device_id))
+
+@app.route('/api/ingest-stats')
+def get_ingest_stats():
+    """Queue depth, drops and lag of the ingest workers"""
+    return jsonify(call_ingest("ingest-stats"))
+
+@app.route('/api/notification-stats')
+def get_notification_stats():
+    """Delivered, retried, failed and coalesced notifications per sink"""
+    return jsonify(call_ingest("notification-stats"))
+
+@app.route('/metrics')
+def get_metrics():
+    """Ingest, storage, MQTT and HTTP metrics in the Prometheus text format"""
+    if SERVER_ROLE == "replica":
+        # Everything but the HTTP metrics comes from the ingest process; those are this worker's
+        text = call_ingest("metrics", http=False) + metrics.expose(lambda name: name in HTTP_METRIC_NAMES)
+    else:
+        text = metrics.expose()
+    return Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/test-notification', methods=['POST'])
+def test_notification():
+    """Route to test the notification sinks"""
+    call_ingest("test-notification", device=request.args.get('device', DEFAULT_DEVICE_ID))
+    return jsonify({"success": True, "message": "Test notification queued"})
+
+@app.route('/api/devices')
+def get_devices():
+    """Fleet overview with a short status per letterbox"""
+    return jsonify([device.summary() for device in devices])
+
+def forecast_response(device):
+    forecast = device.forecast.estimate(device.data.get("batteryCapacity"))
+    forecast["device"] = device.device_id
+    return jsonify(forecast)
+
+@app.route('/api/forecast')
+def get_forecast():
+    """Server-side drain rate and time to empty with confidence bounds"""
+    return forecast_response(default_device)
+
+@app.route('/api/devices/<device_id>/forecast')
+def get_device_forecast(device_id):
+    return forecast_response(get_device_or_404(device_id))
+
+@app.route('/api/forecasts')
+def get_forecasts():
+    """Battery forecasts of the fleet, soonest empty first; within=<hours> keeps the
+    letterboxes that may be empty within that time (by the lower bound)"""
+    within = request.args.get('within', type=float)
+    forecasts = []
+    for device in devices:
+        forecast = device.forecast.estimate(device.data.get("batteryCapacity"))
+        if within is not None and (forecast["hoursToEmptyLow"] is None or forecast["hoursToEmptyLow"] > within):
+            continue
+        forecast["device"] = device.device_id
+        forecasts.append(forecast)
+    # Letterboxes without a forecast last
+    forecasts.sort(key=lambda forecast: (forecast["hoursToEmpty"] is None, forecast["hoursToEmpty"] or 0))
+    return jsonify(forecasts)
+
+# Parse a timeframe like "6h", "1d", "1w" or "1m" into a timedelta (None if invalid)
+def parse_timeframe(timeframe):
+    try:
+        amount = int(timeframe[:-1])
+    except ValueError:
+        return None
+    if timeframe.endswith('h'):  # Hours
+        return timedelta(hours=amount)
+    elif timeframe.endswith('d'):  # Days
+        return timedelta(days=amount)
+    elif timeframe.endswith('w'):  # Weeks
+        return timedelta(weeks=amount)
+    elif timeframe.endswith('m'):  # Months (approximate)
+        return timedelta(days=amount*30)
+    return None
+
+# Index of the first history entry inside a timeframe (None if the timeframe is invalid)
+def timeframe_start(history, timeframe):
+    if timeframe == 'all':
+        return 0
+    window = parse_timeframe(timeframe)
+    if window is None:
+        return None
+    # Binary search for the first entry inside the time window
+    cutoff_ts = (datetime.now() - window).timestamp()
+    return history.index_at(cutoff_ts)
+
+# Build history entries for the index range [start, stop), downsampled to about
+# points entries if requested
+def history_entries(history, start, stop, points=None, method="minmax"):
+    if not points or stop - start <= points:
+        return history.entries(start, stop)
+    ts = history.column("ts", start, stop)
+    values = history.column("avg_distance", start, stop)
+    indices = downsample_indices(ts, values, points, method)
+    return history.entries_at(start + index for index in indices)
+
+# Oldest raw sample of a device, in memory (history is a view of it), in the
+# history database or in the archive
+def raw_oldest_ts(device, history):
+    oldest = history.oldest_ts
+    stored = [history_archive.oldest_ts(device.device_id)]
+    if history_store.supports_queries:
+        stored.append(history_store.oldest_ts(device.device_id))
+    for ts in stored:
+        if ts is not None and (oldest is None or ts < oldest):
+            oldest = ts
+    return oldest
+
+# History entries from since_ts on, read from the database and the archive (for
+# windows that start before the samples kept in memory) and downsampled like history_entries()
+def stored_history_entries(device, history, since_ts, points=None, method="minmax"):
+    if history_store.supports_queries:
+        records = history_store.query_range(device.device_id, since_ts)
+    else:
+        records = history.range(since_ts)
+    # The archive has the readings that are no longer in the history log
+    records = history_archive.query_range(device.device_id, since_ts, records[0]["ts"] if records else None) + records
+    buffer = HistoryBuffer(max(len(records), 1), chunk_size=HISTORY_CHUNK_SIZE, distance_fn=calculate_distance_mm)
+    for record in records:
+        buffer.append(record)
+    return history_entries(buffer, 0, len(buffer), points, method)
+
+# Copy of the rollups of a device for a request; the ingest worker changes them under the device lock
+def rollups_snapshot(device):
+    with device.lock:
+        return device.rollups.copy()
+
+# Rollup tier that answers a history request over [since_ts, now], or None for raw samples.
+# "auto" picks the coarsest tier that still has a bucket per requested point, and
+# only uses a tier when the raw samples don't reach back far enough and it does.
+def select_rollup_tier(device, rollups, history, since_ts, points, requested):
+    if requested == 'raw' or not len(rollups):
+        return None
+    if requested != 'auto':
+        return rollups.tier(requested)
+    oldest = raw_oldest_ts(device, history)
+    covering = rollups.covering(since_ts, oldest)
+    if covering is None:
+        # No tier has older readings than the raw samples (a new or recently cleared
+        # device): the raw samples hold everything, so the window starts at the oldest
+        if oldest is not None:
+            since_ts = max(since_ts, oldest)
+        covering = rollups.complete()
+    raw_covers = oldest is not None and oldest <= since_ts
+    if not points:
+        return None if raw_covers else covering
+    in_memory = history.oldest_ts is not None and history.oldest_ts <= since_ts
+    if in_memory and len(history) - history.index_at(since_ts) <= points:
+        return None
+    tier = rollups.coarsest((time.time() - since_ts) / points)
+    if tier is None and raw_covers:
+        return None
+    # Finer tiers are kept for a shorter time; go coarser until the window is covered
+    if tier is None or covering.period > tier.period:
+        tier = covering
+    return tier
+
+# Rollup entries from since_ts on, reduced to about points entries if requested: with
+# "minmax" neighbouring buckets are merged (exact for min, max and mean), with "lttb"
+# the buckets are picked by their mean distance like raw samples
+def rollup_entries(tier, since_ts, points=None, method="minmax"):
+    start = tier.index_at(since_ts)
+    stop = len(tier)
+    if method == "lttb" and points and stop - start > points:
+        means = [tier.distance_sum[i] / tier.count[i] for i in range(start, stop)]
+        indices = downsample_indices(tier.ts[start:stop], means, points, method)
+        return [entry for index in indices for entry in tier.entries(start + index, start + index + 1)]
+    group = -(-(stop - start) // points) if points else 1
+    return tier.entries(start, stop, max(group, 1))
+
+def device_history_response(device):
+    # One snapshot for the whole request: entries, version and times belong together
+    state = device.snapshot
+    history = state.history
+    
     # Get timeframe parameter from request, default to 'all'
     timeframe = request.args.get('timeframe', 'all')
     
-    # Get current time for time-based filtering
-    current_time = datetime.now()
+    # Optional target number of points for downsampling (min/max per bucket or LTTB)
+    points = request.args.get('points', type=int)
+    if points is not None:
+        points = max(2, min(points, MAX_HISTORY_POINTS))
+    method = request.args.get('method', 'minmax')
+    if method not in DOWNSAMPLE_METHODS:
+        method = 'minmax'
     
-    # Filter data based on timeframe
-    filtered_data = []
+    # Aggregation tier: "auto" (default), "raw", or one of the rollup tiers
+    requested_tier = request.args.get('tier', 'auto')
+    if requested_tier not in ROLLUP_TIER_NAMES:
+        requested_tier = 'auto'
     
-    if timeframe == 'all':
-        # Return all data (limited to last 1000 entries for performance)
-        filtered_data = letterbox_history[-1000:] if len(letterbox_history) > 1000 else letterbox_history
+    # Optional cursor: only return entries newer than this sequence number
+    since = request.args.get('since', type=int)
+    
+    version = state.history_version
+    length = len(history)
+    mode = "full"
+    tier = None
+    stored = False
+    if since is not None and since <= history.last_seq:
+        # Incremental fetch; the timeframe is ignored
+        start = history.index_after_seq(since)
+        points = None
+        mode = "delta"
+    elif timeframe == 'all':
+        # Return all data, downsampled if points is given, otherwise the last 1000 entries
+        start = 0 if points else max(length - 1000, 0)
+        if points or requested_tier != 'auto':
+            rollups = rollups_snapshot(device)
+            oldest = [ts for ts in (history.oldest_ts, rollups.tiers[-1].oldest_ts) if ts is not None]
+            since_ts = min(oldest) if oldest else 0
+            tier = select_rollup_tier(device, rollups, history, since_ts, points, requested_tier)
+    else:
+        window = parse_timeframe(timeframe)
+        if window is None:
+            # Default to last 100 entries if timeframe format is invalid
+            start = max(length - 100, 0)
+            points = None
+        else:
+            since_ts = time.time() - window.total_seconds()
+            start = history.index_at(since_ts)
+            tier = select_rollup_tier(device, rollups_snapshot(device), history, since_ts, points, requested_tier)
+            # Raw samples older than the in-memory history come from the database or the archive
+            if tier is None and start == 0:
+                stored = raw_oldest_ts(device, history) != history.oldest_ts
+    
+    if tier is not None:
+        start = tier.index_at(since_ts)
+        build = lambda: rollup_entries(tier, since_ts, points, method)
+    elif stored:
+        build = lambda: stored_history_entries(device, history, since_ts, points, method)
     else:
-        # Parse the timeframe to determine the time window
+        build = lambda: history_entries(history, start, length, points, method)
+    tier_name = tier.name if tier is not None else "raw"
+    
+    # The start index changes when entries leave the time window, even without new data.
+    # Stored windows start before the memory (start is 0), so they are told apart by the minute they start.
+    window = int(since_ts // 60) if stored else "mem"
+    etag = f"history-{STATE_EPOCH}-{device.device_id}-{version}-{mode}-{tier_name}-{window}-{start}-{length}-{points}-{method}"
+    response = conditional_json(etag, state.history_modified, build, ("history", device.device_id), version)
+    # Tells the client whether it received only new entries or a whole window
+    response.headers["X-History-Mode"] = mode
+    response.headers["X-History-Tier"] = tier_name
+    response.headers["X-History-Seq"] = str(history.last_seq)
+    return response
+
+@app.route('/api/history')
+def get_history():
+    return device_history_response(default_device)
+
+@app.route('/api/devices/<device_id>/history')
+def get_device_history(device_id):
+    return device_history_response(get_device_or_404(device_id))
+
+def stats_response(device):
+    if not analytics.numpy_available():
+        return jsonify({"error": "Statistics need NumPy (pip install numpy)"}), 501
+    history = device.snapshot.history
+    timeframe = request.args.get('timeframe', '1d')
+    start = timeframe_start(history, timeframe)
+    if start is None:
+        return jsonify({"error": f"Invalid timeframe '{timeframe}'"}), 400
+    window = max(1, request.args.get('window', STATS_DEFAULT_WINDOW, type=int))
+    points = max(2, min(request.args.get('points', 500, type=int), MAX_HISTORY_POINTS))
+    stats = analytics.history_stats(history, start, len(history), window=window, points=points)
+    stats.update({"device": device.device_id, "timeframe": timeframe})
+    return jsonify(stats)
+
+@app.route('/api/stats')
+def get_stats():
+    """Rolling distance statistics, sensor noise and battery drain over a timeframe"""
+    return stats_response(default_device)
+
+@app.route('/api/devices/<device_id>/stats')
+def get_device_stats(device_id):
+    return stats_response(get_device_or_404(device_id))
+
+# Server-Sent Events stream with every new reading and letter event of one
+# device (or of all devices if device is None)
+def stream_response(device=None):
+    client = event_broadcaster.subscribe(device.device_id if device else None)
+    
+    def generate():
         try:
-            if timeframe.endswith('h'):  # Hours
-                hours = int(timeframe[:-1])
-                cutoff_time = current_time - datetime.timedelta(hours=hours)
-            elif timeframe.endswith('d'):  # Days
-                days = int(timeframe[:-1])
-                cutoff_time = current_time - datetime.timedelta(days=days)
-            elif timeframe.endswith('w'):  # Weeks
-                weeks = int(timeframe[:-1])
-                cutoff_time = current_time - datetime.timedelta(weeks=weeks)
-            elif timeframe.endswith('m'):  # Months (approximate)
-                months = int(timeframe[:-1])
-                cutoff_time = current_time - datetime.timedelta(days=months*30)
-            else:
-                # Default to last 100 entries if timeframe format is invalid
-                return jsonify(letterbox_history[-100:] if len(letterbox_history) > 100 else letterbox_history)
-            
-            # Convert cutoff_time to string format for comparison
-            cutoff_date_str = cutoff_time.strftime("%Y-%m-%d")
-            cutoff_time_str = cutoff_time.strftime("%H:%M:%S")
-            
-            # Filter data based on date and time
-            for entry in letterbox_history:
-                entry_date = entry.get('date', '')
-                entry_time = entry.get('time', '')
-                
-                # Compare dates first
-                if entry_date > cutoff_date_str:
-                    filtered_data.append(entry)
-                elif entry_date == cutoff_date_str and entry_time >= cutoff_time_str:
-                    filtered_data.append(entry)
-        except (ValueError, AttributeError):
-            # Return last 100 entries if there's an error parsing the timeframe
-            filtered_data = letterbox_history[-100:] if len(letterbox_history) > 100 else letterbox_history
+            yield "retry: 5000\n\n"
+            if device is not None:
+                # Start with the current state so the client doesn't need an extra request
+                yield format_sse("data", json.dumps(device.data))
+            while True:
+                try:
+                    yield client.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            event_broadcaster.unsubscribe(client)
     
-    return jsonify(filtered_data)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-@app.route('/api/clear-history', methods=['POST'])
-def clear_history():
-    """Route to clear the history data"""
-    global letterbox_history
+@app.route('/api/stream')
+def stream():
+    return stream_response(default_device)
+
+@app.route('/api/devices/<device_id>/stream')
+def device_stream(device_id):
+    return stream_response(get_device_or_404(device_id))
+
+@app.route('/api/devices/stream')
+def fleet_stream():
+    """Events of all devices in one stream"""
+    return stream_response()
+
+def clear_history_response(device):
     try:
-        letterbox_history = []
-        save_history()
+        call_ingest("clear-history", device=device.device_id)
         return jsonify({"success": True, "message": "History cleared successfully"})
     except Exception as e:
         return jsonify({"success": False, "message": f"Error clearing history: {str(e)}"})
 
+@app.route('/api/clear-history', methods=['POST'])
+def clear_history():
+    """Route to clear the history data"""
+    return clear_history_response(default_device)
+
+@app.route('/api/devices/<device_id>/clear-history', methods=['POST'])
+def clear_device_history_route(device_id):
+    return clear_history_response(get_device_or_404(device_id))
+
 def start_mqtt_client():
     global mqtt_client
     try:
@@ -328,203 +1185,32 @@ def start_mqtt_client():
         logger.error("  sudo systemctl start mosquitto.service")
         return False
 
+# Exit through the atexit handlers on the first SIGTERM and ignore repeated ones
+def exit_on_signal(signum, frame):
+    signal.signal(signum, signal.SIG_IGN)
+    sys.exit(0)
+
 if __name__ == '__main__':
     # Create directories if they don't exist
     os.makedirs(templates_dir, exist_ok=True)
     os.makedirs(static_dir, exist_ok=True)
     
-    # Create CSS file
-    with open(os.path.join(static_dir, 'style.css'), 'w') as f:
-        f.write("""
-body {
-    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-    margin: 0;
-    padding: 0;
-    background-color: #f5f5f5;
-    color: #333;
-}
-
-.container {
-    max-width: 1200px;
-    margin: 0 auto;
-    padding: 20px;
-}
-
-header {
-    background-color: #2c3e50;
-    color: white;
-    padding: 1rem;
-    text-align: center;
-    margin-bottom: 2rem;
-    border-radius: 5px;
-}
-
-h1, h2, h3 {
-    margin: 0;
-}
-
-.dashboard {
-    display: grid;
-    grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-    gap: 20px;
-    margin-bottom: 2rem;
-}
-
-.card {
-    background-color: white;
-    border-radius: 8px;
-    box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-    padding: 20px;
-    transition: transform 0.3s ease;
-}
-
-.card:hover {
-    transform: translateY(-5px);
-}
-
-.card-title {
-    font-size: 1.2rem;
-    margin-bottom: 15px;
-    color: #2c3e50;
-    border-bottom: 2px solid #ecf0f1;
-    padding-bottom: 10px;
-}
-
-.card-value {
-    font-size: 2rem;
-    font-weight: bold;
-    margin-bottom: 10px;
-    color: #3498db;
-}
-
-.card-value.warning {
-    color: #e74c3c;
-}
-
-.card-subtitle {
-    font-size: 0.9rem;
-    color: #7f8c8d;
-}
-
-.graph-container {
-    background-color: white;
-    border-radius: 8px;
-    box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-    padding: 20px;
-    margin-bottom: 2rem;
-}
-
-.btn {
-    background-color: #3498db;
-    color: white;
-    border: none;
-    padding: 10px 15px;
-    border-radius: 5px;
-    cursor: pointer;
-    font-size: 1rem;
-    transition: background-color 0.3s ease;
-}
-
-.btn:hover {
-    background-color: #2980b9;
-}
-
-.btn-danger {
-    background-color: #e74c3c;
-}
-
-.btn-danger:hover {
-    background-color: #c0392b;
-}
-
-.btn-container {
-    display: flex;
-    justify-content: center;
-    gap: 10px;
-    margin-bottom: 2rem;
-}
-
-.timeframe-selector {
-    display: flex;
-    justify-content: center;
-    gap: 10px;
-    margin-bottom: 1rem;
-}
-
-.btn-timeframe {
-    background-color: #95a5a6;
-    color: white;
-    border: none;
-    padding: 5px 10px;
-    border-radius: 5px;
-    cursor: pointer;
-    font-size: 0.9rem;
-    transition: background-color 0.3s ease;
-}
-
-.btn-timeframe:hover {
-    background-color: #7f8c8d;
-}
-
-.btn-timeframe.active {
-    background-color: #3498db;
-}
-
-.btn-timeframe.active:hover {
-    background-color: #2980b9;
-}
-
-.footer {
-    text-align: center;
-    margin-top: 2rem;
-    padding: 1rem;
-    background-color: #2c3e50;
-    color: white;
-    border-radius: 5px;
-}
-
-.battery-indicator {
-    width: 100%;
-    height: 20px;
-    background-color: #ecf0f1;
-    border-radius: 10px;
-    margin-top: 10px;
-    overflow: hidden;
-}
-
-.battery-level {
-    height: 100%;
-    background-color: #2ecc71;
-    border-radius: 10px;
-    transition: width 0.5s ease;
-}
-
-.battery-level.warning {
-    background-color: #e74c3c;
-}
-
-.battery-level.low {
-    background-color: #f39c12;
-}
-
-.last-update {
-    text-align: right;
-    font-size: 0.8rem;
-    color: #7f8c8d;
-    margin-top: 1rem;
-}
-
-@media (max-width: 768px) {
-    .dashboard {
-        grid-template-columns: 1fr;
-    }
-}
-""")
+    if SERVER_ROLE == "async":
+        sys.exit("The async role is run by async_server.py")
+    
+    if SERVER_ROLE == "ingest":
+        # serve.py runs the HTTP workers; SIGTERM exits through the atexit handlers
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        start_mqtt_client()
+        while True:
+            time.sleep(3600)
     
     # Start MQTT client in a separate thread
-    mqtt_thread = threading.Thread(target=start_mqtt_client)
-    mqtt_thread.daemon = True
-    mqtt_thread.start()
+    if SERVER_ROLE == "standalone":
+        mqtt_thread = threading.Thread(target=start_mqtt_client)
+        mqtt_thread.daemon = True
+        mqtt_thread.start()
     
-    # Run the Flask server
-    app.run(host='0.0.0.0', port=80, debug=True)
+    # Run the Flask server. The reloader would import this module a second time and
+    # start a second MQTT client, so every message was processed twice.
+    app.run(host='0.0.0.0', port=80, debug=True, use_reloader=False)
@@ -0,0 +1,210 @@
+# Offline replay of recorded readings through the letter detection.
+#
+# Usage:
+#   python replay.py ../letterbox_server.log
+#   python replay.py letterbox_history.json --threshold 3,5,8,12
+#   python replay.py history_segments --detector cusum --median-window 5 --events
+#   python replay.py letterbox_history.db --option drift=4 --json
+#
+# Sources can be server logs ("Received message" lines), history JSON files,
+# segment directories and SQLite history databases. The readings go through the
+# same code as on_message() and check_letter_status() (pipeline.py and
+# detection.py), as fast as the CPU allows and without broker or Flask.
+# Without options they use the server's LETTER_DETECTOR (detector_config.py), so
+# a replayed log gives the same events as the server.
+
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+from detection import create_detector
+from detector_config import LETTER_DETECTOR
+from devices import DEFAULT_DEVICE_ID
+from history_buffer import entry_timestamp
+from history_store import read_segment_records
+from pipeline import calculate_distance_mm, payload_durations, average_distance, letter_notification
+from sqlite_store import read_records
+
+# "2025-05-17 20:16:17,476 - letterbox_server - INFO - Received message on topic letterbox/data: {...}"
+LOG_LINE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - \S+ - INFO - (.*)$")
+# Message part; the rate limiter may have appended "[n similar lines suppressed]"
+MESSAGE = re.compile(r"^Received message on topic (\S+): (\{.*\})(?: \[\d+ similar lines suppressed\])?\s*$")
+
+
+# Device ID of a data topic: "letterbox/data" -> default, "letterbox/<id>/data" -> <id>
+def _topic_device(topic):
+    parts = topic.split('/')
+    if len(parts) == 3 and parts[0] == "letterbox" and parts[2] == "data":
+        return parts[1]
+    return DEFAULT_DEVICE_ID
+
+
+# (ts, message) of a text or JSON (SERVER_LOG_JSON) log line, or None
+def _log_message(line):
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        return entry.get("ts"), entry.get("msg", "")
+    match = LOG_LINE.match(line)
+    if match is None:
+        return None
+    stamp, millis, message = match.groups()
+    return datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S").timestamp() + int(millis) / 1000, message
+
+
+def read_log(path, keep_duplicates=False):
+    """Yield (ts, device, payload) of the "Received message" lines of a server log.
+
+    The debug reloader used to run two servers that both logged every message;
+    repeated identical lines are skipped unless keep_duplicates is set. The
+    server rate-limits these lines, so record a log for replay with
+    SERVER_LOG_RATE_LIMIT = None (or replay the history instead).
+    """
+    previous = None
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            if "Received message" not in line:
+                continue
+            parsed = _log_message(line)
+            if parsed is None:
+                continue
+            match = MESSAGE.match(parsed[1])
+            if match is None:
+                continue
+            if not keep_duplicates and (parsed[0], match.groups()) == previous:
+                continue
+            previous = (parsed[0], match.groups())
+            topic, payload_text = match.groups()
+            try:
+                # The server logs the parsed payload as a Python dict
+                payload = ast.literal_eval(payload_text)
+            except (ValueError, SyntaxError):
+                continue
+            yield parsed[0], _topic_device(topic), payload
+
+
+# (ts, device, payload) of history records; clear markers are skipped
+def _from_records(records):
+    for record in records:
+        if record.get("cleared"):
+            continue
+        yield entry_timestamp(record), record.get("device", DEFAULT_DEVICE_ID), record
+
+
+def read_source(path, keep_duplicates=False):
+    if os.path.isdir(path):
+        return _from_records(read_segment_records(path))
+    if path.endswith(".db"):
+        return _from_records(read_records(path))
+    if path.endswith(".json"):
+        with open(path, 'r') as f:
+            return _from_records(json.load(f))
+    return read_log(path, keep_duplicates)
+
+
+def replay(readings, detector_config):
+    """Run readings through a fresh detector per device; returns (notifications, seconds)."""
+    detectors = {}
+    durations = {}
+    notifications = []
+    started = time.perf_counter()
+    for ts, device_id, payload in readings:
+        detector = detectors.get(device_id)
+        if detector is None:
+            detector = detectors[device_id] = create_detector(detector_config)
+        # Same steps as process_reading() and check_letter_status()
+        device_durations = durations[device_id] = payload_durations(payload, durations.get(device_id, [0, 0, 0]))
+        if "durations" in payload or "duration" in payload:
+            avg_distance = average_distance([calculate_distance_mm(duration) for duration in device_durations])
+        else:
+            # History entries without echo times only kept the distance
+            avg_distance = float(payload.get("avg_distance", payload.get("distance", 0)) or 0)
+        event = detector.update(avg_distance)
+        if event is not None:
+            notifications.append(letter_notification(device_id, event, datetime.fromtimestamp(ts)))
+    return notifications, time.perf_counter() - started
+
+
+# Detector configs for every value of the swept --threshold list
+def detector_configs(args):
+    base = dict(LETTER_DETECTOR)
+    if args.detector is not None and args.detector != base.get("type"):
+        # The settings of the server's detector don't apply to another type
+        base = {"type": args.detector, "median_window": base.get("median_window", 1)}
+    if args.median_window is not None:
+        base["median_window"] = args.median_window
+    for option in args.option:
+        key, _, value = option.partition("=")
+        base[key] = float(value)
+    if not args.threshold:
+        return [base]
+    return [dict(base, threshold=float(threshold)) for threshold in args.threshold.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded letterbox readings through the letter detection")
+    parser.add_argument("sources", nargs="+", help="Server logs, history JSON files, segment directories or .db files")
+    parser.add_argument("--detector", help="threshold, hysteresis, cusum or page-hinkley (default: the server's)")
+    parser.add_argument("--threshold", help="Threshold in mm, or a comma-separated list to compare several")
+    parser.add_argument("--median-window", type=int, help="Median filter length (1 = off; default: the server's)")
+    parser.add_argument("--option", action="append", default=[], help="Other detector setting as key=value")
+    parser.add_argument("--device", help="Only replay this device")
+    parser.add_argument("--keep-duplicates", action="store_true", help="Keep repeated identical log lines")
+    parser.add_argument("--events", action="store_true", help="Print every detected event")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    readings = []
+    for source in args.sources:
+        readings.extend(read_source(source, args.keep_duplicates))
+    if args.device:
+        readings = [reading for reading in readings if reading[1] == args.device]
+    readings.sort(key=lambda reading: reading[0])
+    load_seconds = time.perf_counter() - started
+
+    results = []
+    for config in detector_configs(args):
+        notifications, seconds = replay(readings, config)
+        results.append({
+            "detector": config,
+            "events": len(notifications),
+            "arrived": sum(1 for n in notifications if n["difference"] < 0),
+            "removed": sum(1 for n in notifications if n["difference"] >= 0),
+            "seconds": round(seconds, 4),
+            "readingsPerSecond": round(len(readings) / seconds) if seconds > 0 else None,
+            "notifications": notifications if args.events else None
+        })
+
+    summary = {
+        "readings": len(readings),
+        "devices": len({reading[1] for reading in readings}),
+        "from": datetime.fromtimestamp(readings[0][0]).isoformat() if readings else None,
+        "to": datetime.fromtimestamp(readings[-1][0]).isoformat() if readings else None,
+        "loadSeconds": round(load_seconds, 3),
+        "results": results
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    print(f"{summary['readings']} readings of {summary['devices']} devices from {summary['from']} to {summary['to']} "
+          f"(loaded in {summary['loadSeconds']}s)")
+    for result in results:
+        settings = ", ".join(f"{key}={value}" for key, value in result["detector"].items())
+        print(f"{settings}: {result['events']} events ({result['arrived']} arrived, {result['removed']} removed) "
+              f"in {result['seconds']}s, {result['readingsPerSecond']} readings/s")
+        for notification in result["notifications"] or []:
+            print(f"  {notification['timestamp']} [{notification['device']}] {notification['message']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
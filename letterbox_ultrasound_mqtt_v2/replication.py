@@ -0,0 +1,216 @@
+import json
+import os
+import queue
+import socket
+import threading
+import logging
+
+logger = logging.getLogger("letterbox_server.replication")
+
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message, separators=(",", ":")) + "\n").encode())
+
+
+def request_ingest(path, op, timeout=10.0, **fields):
+    """Run a command in the ingest process and return its result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        _send(sock, dict(fields, op=op))
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError(f"No reply from the ingest process to '{op}'")
+    reply = json.loads(line)
+    if not reply.get("ok"):
+        raise RuntimeError(reply.get("error") or f"Command '{op}' failed")
+    return reply.get("result")
+
+
+class _Subscriber:
+    __slots__ = ("queue", "lagging")
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lagging = False
+
+
+class ReplicationServer:
+    """Streams the state changes of the ingest process to the HTTP workers.
+
+    Workers connect to a Unix socket and subscribe. They are registered before
+    snapshot_fn() runs, so a change made meanwhile reaches them twice (once
+    in what they load, once as a message) but never not at all; the sequence
+    numbers let them skip the duplicates. A worker that falls more than
+    queue_size messages behind is disconnected and resyncs. Any other line
+    sent to the socket is a command, answered by commands[op](**fields).
+    """
+
+    def __init__(self, path, snapshot_fn, commands, queue_size=50000):
+        self.path = path
+        self.snapshot_fn = snapshot_fn
+        self.commands = commands
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._listener = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def start(self):
+        if self._listener is not None:
+            return
+        # A socket file left over from a crash would make bind() fail
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._listener.listen(16)
+        threading.Thread(target=self._accept_loop, daemon=True, name="replication-accept").start()
+        logger.info(f"Replication socket listening on {self.path}")
+
+    def stop(self):
+        if self._listener is None:
+            return
+        self._listener.close()
+        self._listener = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(None)
+            except queue.Full:
+                subscriber.lagging = True
+
+    def publish(self, message):
+        """Send a change to all workers; never blocks."""
+        if not self._subscribers:
+            return
+        line = (json.dumps(message, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(line)
+            except queue.Full:
+                subscriber.lagging = True
+
+    def _accept_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(connection,), daemon=True, name="replication-client").start()
+
+    def _serve(self, connection):
+        try:
+            with connection.makefile('rb') as reader:
+                request = json.loads(reader.readline() or b"{}")
+            op = request.pop("op", None)
+            if op == "subscribe":
+                self._stream(connection)
+                return
+            handler = self.commands.get(op)
+            if op == "ping":
+                reply = {"ok": True, "result": True}
+            elif handler is None:
+                reply = {"ok": False, "error": f"Unknown command '{op}'"}
+            else:
+                try:
+                    reply = {"ok": True, "result": handler(**request)}
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+            _send(connection, reply)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Replication request failed: {e}")
+        finally:
+            connection.close()
+
+    def _stream(self, connection):
+        subscriber = _Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            _send(connection, dict(self.snapshot_fn(), type="ready"))
+            logger.info(f"Worker subscribed ({len(self._subscribers)} connected)")
+            while True:
+                line = subscriber.queue.get()
+                if line is None:
+                    return
+                if subscriber.lagging:
+                    logger.warning("Dropping a worker that fell behind; it will resync")
+                    return
+                connection.sendall(line)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+
+class ReplicaClient:
+    """Follows the ingest process from an HTTP worker.
+
+    on_ready(snapshot) runs after every (re)connect, before the changes that
+    were queued for this worker meanwhile are passed to on_change(message).
+    """
+
+    def __init__(self, path, on_ready, on_change, retry_interval=1.0):
+        self.path = path
+        self.on_ready = on_ready
+        self.on_change = on_change
+        self.retry_interval = retry_interval
+        self._ready = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.connected = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="replica")
+            self._thread.start()
+
+    def wait_ready(self, timeout=None):
+        """Wait until the first snapshot has been applied."""
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _follow(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            _send(sock, {"op": "subscribe"})
+            with sock.makefile('rb') as reader:
+                for line in reader:
+                    message = json.loads(line)
+                    if message.get("type") == "ready":
+                        self.on_ready(message)
+                        self.connected = True
+                        self._ready.set()
+                        logger.info(f"Following the ingest process at {self.path}")
+                    else:
+                        self.on_change(message)
+                    if self._stop_event.is_set():
+                        return
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._follow()
+                if not self._stop_event.is_set():
+                    logger.warning("Lost the connection to the ingest process, reconnecting")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Cannot follow the ingest process at {self.path}: {e}")
+            self.connected = False
+            self._stop_event.wait(self.retry_interval)
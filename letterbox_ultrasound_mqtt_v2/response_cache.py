@@ -0,0 +1,140 @@
+# Serialized and compressed API responses, reused until the state changes.
+#
+# Responses are cached under their ETag, which already names everything the
+# body depends on. Each entry also belongs to a group (e.g. the history of one
+# device) with the version of that state; when a request sees a newer version,
+# the entries of the old one are dropped. Compressed variants are made on
+# first use for each encoding. Brotli is optional (pip install brotli); without
+# it clients get gzip.
+
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first when the client accepts several
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    # mtime=0 keeps the bytes (and so the Content-Length) the same across restarts
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def negotiate(accept_encodings, size, min_size):
+    """Best encoding from a werkzeug Accept-Encoding header, or None for identity."""
+    if size < min_size:
+        return None
+    for encoding in ENCODINGS:
+        if accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+class _Entry:
+    __slots__ = ("group", "variants", "size")
+
+    def __init__(self, group, body):
+        self.group = group
+        self.variants = {None: body}
+        self.size = len(body)
+
+
+class ResponseCache:
+    """LRU cache of response bodies, bounded by entries and bytes."""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, min_compress_size=512):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.min_compress_size = min_compress_size
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._groups = {}  # group -> (version, keys)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def body(self, group, version, key, build, accept_encodings):
+        """(bytes, encoding) of a response; build() returns the uncompressed bytes."""
+        with self._lock:
+            entry = self._lookup(group, version, key)
+        if entry is None:
+            # Built outside the lock, so a slow request does not hold up the others.
+            # Two threads may build the same body at once; the result is the same.
+            entry = _Entry(group, build())
+            with self._lock:
+                self._store(group, version, key, entry)
+        encoding = negotiate(accept_encodings, len(entry.variants[None]), self.min_compress_size)
+        variant = entry.variants.get(encoding)
+        if variant is None:
+            variant = _compress(entry.variants[None], encoding)
+            with self._lock:
+                if encoding not in entry.variants:
+                    entry.variants[encoding] = variant
+                    entry.size += len(variant)
+                    if self._entries.get(key) is entry:
+                        self._bytes += len(variant)
+                        self._evict()
+        return variant, encoding
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self._bytes = 0
+
+    def _lookup(self, group, version, key):
+        known = self._groups.get(group)
+        if known is not None and known[0] != version:
+            if version < known[0]:
+                # A request that read the state just before a change; do not cache it
+                self.misses += 1
+                return None
+            self._drop_group(group)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _store(self, group, version, key, entry):
+        known = self._groups.get(group)
+        if known is not None and known[0] != version:
+            if version < known[0]:
+                return
+            self._drop_group(group)
+        if key in self._entries:
+            return
+        self._groups.setdefault(group, (version, set()))[1].add(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def _drop_group(self, group):
+        _, keys = self._groups.pop(group)
+        for key in keys:
+            self._bytes -= self._entries.pop(key).size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            keys = self._groups[entry.group][1]
+            keys.discard(key)
+            if not keys:
+                del self._groups[entry.group]
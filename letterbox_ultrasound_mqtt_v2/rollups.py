@@ -0,0 +1,216 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+# Rollup tiers as (name, bucket length in seconds), finest first
+ROLLUP_TIERS = (("minute", 60), ("hour", 3600), ("day", 86400))
+
+# Column names and array types of a tier
+_COLUMNS = (
+    ("ts", 'd'),  # Bucket start (epoch seconds)
+    ("count", 'I'),
+    ("distance_min", 'd'),
+    ("distance_max", 'd'),
+    ("distance_sum", 'd'),
+    ("battery_min", 'd'),
+    ("battery_max", 'd'),
+    ("battery_sum", 'd'),
+)
+
+
+class RollupTier:
+    """Min, max, mean and count of avg_distance and battery per fixed time bucket.
+
+    Buckets are kept in column arrays sorted by start time. A reading only
+    touches the newest bucket (or opens a new one), so updates are O(1).
+    Once more than capacity buckets exist, the oldest are dropped.
+
+    Not thread-safe: the server changes the tiers of a device under its lock,
+    and other threads read a copy() taken under the same lock.
+    """
+
+    def __init__(self, name, period, capacity):
+        self.name = name
+        self.period = period
+        self.capacity = capacity
+        self.clear()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def clear(self):
+        for column, typecode in _COLUMNS:
+            setattr(self, column, array(typecode))
+
+    def add(self, ts, distance, battery):
+        bucket = ts - ts % self.period
+        if self.ts and bucket == self.ts[-1]:
+            i = len(self.ts) - 1
+        elif not self.ts or bucket > self.ts[-1]:
+            self._insert(len(self.ts), bucket, distance, battery)
+            self._evict()
+            return
+        else:
+            # Late reading (clock jump or replayed record) for an older bucket
+            i = bisect_left(self.ts, bucket)
+            if i == len(self.ts) or self.ts[i] != bucket:
+                if i == 0 and len(self.ts) >= self.capacity:
+                    return
+                self._insert(i, bucket, distance, battery)
+                self._evict()
+                return
+        self.count[i] += 1
+        self.distance_min[i] = min(self.distance_min[i], distance)
+        self.distance_max[i] = max(self.distance_max[i], distance)
+        self.distance_sum[i] += distance
+        self.battery_min[i] = min(self.battery_min[i], battery)
+        self.battery_max[i] = max(self.battery_max[i], battery)
+        self.battery_sum[i] += battery
+
+    def _insert(self, i, bucket, distance, battery):
+        for column, value in (("ts", bucket), ("count", 1),
+                              ("distance_min", distance), ("distance_max", distance), ("distance_sum", distance),
+                              ("battery_min", battery), ("battery_max", battery), ("battery_sum", battery)):
+            getattr(self, column).insert(i, value)
+
+    def _evict(self):
+        # Trim in steps so the arrays are not shifted on every new bucket
+        excess = len(self.ts) - self.capacity
+        if excess > self.capacity // 8:
+            for column, _ in _COLUMNS:
+                del getattr(self, column)[:excess]
+
+    @property
+    def oldest_ts(self):
+        return self.ts[0] if self.ts else None
+
+    def index_at(self, ts):
+        """Index of the first bucket that contains or starts after ts."""
+        return bisect_right(self.ts, ts - self.period)
+
+    def entries(self, start, stop, group=1):
+        """Buckets [start, stop) as history-like dicts (means in avg_distance and batteryPercentage).
+
+        With group > 1, every group consecutive buckets are merged into one
+        entry, which is exact for min, max, mean and count.
+        """
+        entries = []
+        stop = min(stop, len(self.ts))
+        for first in range(max(start, 0), stop, group):
+            last = min(first + group, stop)
+            count = sum(self.count[first:last])
+            moment = datetime.fromtimestamp(self.ts[first])
+            entries.append({
+                "ts": self.ts[first],
+                "date": moment.strftime("%Y-%m-%d"),
+                "time": moment.strftime("%H:%M:%S"),
+                "tier": self.name,
+                "count": count,
+                "avg_distance": sum(self.distance_sum[first:last]) / count,
+                "min_distance": min(self.distance_min[first:last]),
+                "max_distance": max(self.distance_max[first:last]),
+                "batteryPercentage": sum(self.battery_sum[first:last]) / count,
+                "min_battery": min(self.battery_min[first:last]),
+                "max_battery": max(self.battery_max[first:last])
+            })
+        return entries
+
+    def copy(self):
+        tier = RollupTier(self.name, self.period, self.capacity)
+        for column, _ in _COLUMNS:
+            setattr(tier, column, getattr(self, column)[:])
+        return tier
+
+    def to_dict(self):
+        return {column: getattr(self, column).tolist() for column, _ in _COLUMNS}
+
+    def load_dict(self, columns):
+        lengths = {len(columns.get(column, ())) for column, _ in _COLUMNS}
+        if len(lengths) != 1:
+            raise ValueError(f"Rollup tier '{self.name}' has columns of different length")
+        for column, typecode in _COLUMNS:
+            setattr(self, column, array(typecode, columns.get(column, ())))
+
+
+class Rollups:
+    """All rollup tiers of one device.
+
+    last_seq is the sequence number of the newest history entry folded in.
+    It keeps the tiers from counting a reading twice when the history log is
+    replayed on top of a saved rollup snapshot.
+    """
+
+    def __init__(self, retention):
+        self.tiers = [RollupTier(name, period, retention[name]) for name, period in ROLLUP_TIERS]
+        self.last_seq = 0
+
+    def __len__(self):
+        return len(self.tiers[0])
+
+    def tier(self, name):
+        for tier in self.tiers:
+            if tier.name == name:
+                return tier
+        return None
+
+    def add(self, seq, ts, distance, battery):
+        """Fold one history entry into every tier (ignored if seq was already folded in)."""
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        for tier in self.tiers:
+            tier.add(ts, distance, battery)
+
+    def clear(self):
+        # last_seq is kept, like the sequence numbers of the history buffer
+        for tier in self.tiers:
+            tier.clear()
+
+    def copy(self):
+        """Copy of all tiers, for readers in other threads (O(buckets), a few arrays each)."""
+        rollups = Rollups({tier.name: tier.capacity for tier in self.tiers})
+        rollups.tiers = [tier.copy() for tier in self.tiers]
+        rollups.last_seq = self.last_seq
+        return rollups
+
+    def coarsest(self, resolution):
+        """Coarsest tier whose buckets are not longer than resolution seconds (None if even minutes are too coarse)."""
+        chosen = None
+        for tier in self.tiers:
+            if tier.period <= resolution:
+                chosen = tier
+        return chosen
+
+    def covering(self, since_ts, raw_oldest_ts=None):
+        """Finest tier that reaches back to since_ts with readings older than raw_oldest_ts (None if none does).
+
+        A tier whose oldest bucket still contains raw_oldest_ts was started by
+        the same readings as the raw samples, so it has nothing older (a new or
+        recently cleared device).
+        """
+        for tier in self.tiers:
+            oldest = tier.oldest_ts
+            if oldest is None or oldest > since_ts:
+                continue
+            if raw_oldest_ts is not None and oldest + tier.period > raw_oldest_ts:
+                continue
+            return tier
+        return None
+
+    def complete(self):
+        """Finest tier that still has all readings folded in (as far as the day buckets tell)."""
+        day = self.tiers[-1]
+        for tier in self.tiers:
+            if tier.oldest_ts is not None and tier.oldest_ts < day.oldest_ts + day.period:
+                return tier
+        return day
+
+    def to_dict(self):
+        tiers = {tier.name: tier.to_dict() for tier in self.tiers}
+        return {"lastSeq": self.last_seq, "tiers": tiers}
+
+    def load_dict(self, saved):
+        for tier in self.tiers:
+            if tier.name in saved.get("tiers", {}):
+                tier.load_dict(saved["tiers"][tier.name])
+        self.last_seq = int(saved.get("lastSeq", 0))
@@ -0,0 +1,149 @@
+# Production launcher: one ingest process plus several HTTP worker processes.
+#
+# Usage:
+#   sudo python serve.py --workers 4 --port 80
+#
+# The ingest process owns the MQTT client, the history log and the data files.
+# The workers load the history once and then follow the ingest process over a
+# Unix socket (see replication.py), so /api/* requests use all cores of the Pi
+# without a second MQTT client. The workers share one listening socket and
+# each serve requests in threads. Crashed processes are restarted.
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from replication import request_ingest
+
+logger = logging.getLogger("letterbox_serve")
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(script_dir, "raspberry_pi_mqtt_server_v2.py")
+DEFAULT_SOCKET = os.path.join(script_dir, "letterbox_ingest.sock")
+RESTART_DELAY = 2.0  # Seconds before a crashed process is started again
+
+
+# Exit through the atexit handlers on the first SIGTERM and ignore repeated ones
+def exit_on_signal(signum, frame):
+    signal.signal(signum, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def run_worker(fd, host, port):
+    """Serve the API on an inherited listening socket (in a worker process)."""
+    from werkzeug.serving import make_server
+    import raspberry_pi_mqtt_server_v2 as server
+
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    make_server(host, port, server.app, threaded=True, fd=fd).serve_forever()
+
+
+# Wait until the ingest process has loaded its state and answers on the socket
+def wait_for_ingest(process, path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            request_ingest(path, "ping", timeout=1.0)
+            return True
+        except (OSError, RuntimeError):
+            time.sleep(0.5)
+    return False
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.env = dict(os.environ, LETTERBOX_SOCKET=args.socket)
+        self.listener = None
+        self.ingest = None
+        self.workers = []
+        self.stopping = False
+
+    def start_ingest(self):
+        self.ingest = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=script_dir,
+                                       env=dict(self.env, LETTERBOX_ROLE="ingest"))
+        logger.info(f"Started ingest process {self.ingest.pid}")
+
+    def start_worker(self):
+        fd = self.listener.fileno()
+        command = [sys.executable, os.path.abspath(__file__), "--worker-fd", str(fd),
+                   "--host", self.args.host, "--port", str(self.args.port)]
+        worker = subprocess.Popen(command, cwd=script_dir, pass_fds=(fd,),
+                                  env=dict(self.env, LETTERBOX_ROLE="replica"))
+        logger.info(f"Started HTTP worker {worker.pid}")
+        return worker
+
+    def run(self):
+        self.start_ingest()
+        if not wait_for_ingest(self.ingest, self.args.socket, self.args.startup_timeout):
+            logger.error("The ingest process did not come up")
+            self.stop()
+            return 1
+        self.listener = socket.create_server((self.args.host, self.args.port), backlog=128)
+        self.workers = [self.start_worker() for _ in range(self.args.workers)]
+        logger.info(f"Serving on {self.args.host}:{self.args.port} with {self.args.workers} workers")
+
+        while not self.stopping:
+            time.sleep(1.0)
+            if self.stopping:
+                break
+            if self.ingest.poll() is not None:
+                logger.error(f"Ingest process exited with code {self.ingest.returncode}, restarting")
+                time.sleep(RESTART_DELAY)
+                self.start_ingest()
+            for i, worker in enumerate(self.workers):
+                if worker.poll() is not None:
+                    logger.error(f"HTTP worker {worker.pid} exited with code {worker.returncode}, restarting")
+                    time.sleep(RESTART_DELAY)
+                    self.workers[i] = self.start_worker()
+        return 0
+
+    def stop(self, *_):
+        if not self.stopping:
+            logger.info("Stopping")
+        self.stopping = True
+        # Workers first, then the ingest process, which flushes its files on exit
+        for process in self.workers + [self.ingest]:
+            if process is None or process.poll() is not None:
+                continue
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the letterbox server with one ingest process and several HTTP workers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="HTTP worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket between ingest and workers")
+    parser.add_argument("--startup-timeout", type=float, default=300.0,
+                        help="Seconds to wait for the ingest process to load the history")
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_fd is not None:
+        run_worker(args.worker_fd, args.host, args.port)
+        return 0
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    supervisor = Supervisor(args)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    try:
+        return supervisor.run()
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger("letterbox_server.snapshot_writer")
+
+
+# Write JSON to a temp file next to path and rename it into place, so readers
+# (and a reboot) only ever see the old or the new file, never a partial one
+def atomic_write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter:
+    """Background worker that keeps the latest state and writes it out lazily.
+
+    update() only stores the newest state. The worker writes it once no
+    update has come in for debounce seconds, but not more often than every
+    flush_interval seconds; a state is never left unsaved for longer than
+    max_staleness seconds, even while updates keep coming in. stop() writes
+    any pending state.
+
+    With state_fn, update() only marks the state as changed and state_fn()
+    builds the state on the writer thread when it is written. observer, if
+    given, is called with the duration of every write in seconds.
+
+    run_async() can replace the thread on an asyncio event loop; the writes
+    then run in the loop's default executor.
+    """
+
+    def __init__(self, path, flush_interval=30.0, max_staleness=60.0, debounce=5.0, state_fn=None, observer=None):
+        self.path = path
+        self.state_fn = state_fn
+        self.observer = observer
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.debounce = debounce
+
+        self._condition = threading.Condition()
+        self._state = None
+        self._dirty_since = None
+        self._last_change = 0.0
+        self._last_flush = 0.0
+        self._stopping = False
+        self._thread = None
+        self.flush_count = 0
+
+    def update(self, state=None):
+        """Record the newest state; copies the top-level dict so later in-place updates don't leak in."""
+        with self._condition:
+            if state is not None:
+                self._state = dict(state)
+            self._last_change = time.monotonic()
+            if self._dirty_since is None:
+                self._dirty_since = self._last_change
+                self._condition.notify()
+
+    # Time at which the pending state is written: after the debounce and the flush
+    # interval, but no later than max_staleness after the first unsaved update
+    def _deadline(self):
+        settled = max(self._last_change + self.debounce, self._last_flush + self.flush_interval)
+        return min(settled, self._dirty_since + self.max_staleness)
+
+    def flush(self):
+        """Write the pending state now, if there is any."""
+        with self._condition:
+            state = self._state
+            if self._dirty_since is None:
+                return
+            self._dirty_since = None
+            self._last_flush = time.monotonic()
+        try:
+            started = time.perf_counter()
+            if self.state_fn is not None:
+                state = self.state_fn()
+            atomic_write_json(self.path, state)
+            self.flush_count += 1
+            if self.observer is not None:
+                self.observer(time.perf_counter() - started)
+            logger.debug(f"Snapshot written to {self.path}")
+        except Exception as e:
+            logger.error(f"Error writing snapshot to {self.path}: {e}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if self._dirty_since is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._deadline() - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    async def run_async(self, poll_interval=1.0):
+        """Write the pending state when it is due, as a task on the running event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                remaining = None if self._dirty_since is None else self._deadline() - time.monotonic()
+            if remaining is None or remaining > 0:
+                await asyncio.sleep(poll_interval if remaining is None else min(remaining, poll_interval))
+                continue
+            await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the worker and write whatever is still pending."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
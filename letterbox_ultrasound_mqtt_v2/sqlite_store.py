@@ -0,0 +1,227 @@
+import pathlib
+import sqlite3
+import threading
+import time
+import logging
+
+from devices import DEFAULT_DEVICE_ID
+from history_buffer import entry_timestamp
+
+logger = logging.getLogger("letterbox_server.sqlite_store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    ts REAL NOT NULL,
+    d0 INTEGER NOT NULL DEFAULT 0,
+    d1 INTEGER NOT NULL DEFAULT 0,
+    d2 INTEGER NOT NULL DEFAULT 0,
+    avg_distance REAL NOT NULL DEFAULT 0,
+    battery REAL NOT NULL DEFAULT 0,
+    used_capacity REAL NOT NULL DEFAULT 0,
+    cleared INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS history_device_ts ON history (device, ts);
+"""
+
+_COLUMNS = "device, seq, ts, d0, d1, d2, avg_distance, battery, used_capacity, cleared"
+_INSERT = f"INSERT INTO history ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_SELECT = f"SELECT {_COLUMNS} FROM history"
+
+
+# Table row of a history record (as appended by the server)
+def _row(record):
+    durations = list(record.get("durations") or [])[:3]
+    durations += [0] * (3 - len(durations))
+    return (
+        record.get("device", DEFAULT_DEVICE_ID),
+        int(record.get("seq", 0) or 0),
+        entry_timestamp(record),
+        int(durations[0]), int(durations[1]), int(durations[2]),
+        float(record.get("avg_distance", record.get("distance", 0)) or 0),
+        float(record.get("batteryPercentage", 0) or 0),
+        float(record.get("estimatedUsedCapacity", 0) or 0),
+        1 if record.get("cleared") else 0
+    )
+
+
+# History record of a table row, in the format HistoryBuffer.append() takes
+def _record(row):
+    device, seq, ts, d0, d1, d2, avg_distance, battery, used_capacity, cleared = row
+    if cleared:
+        return {"device": device, "cleared": True, "seq": seq, "ts": ts}
+    return {
+        "device": device,
+        "seq": seq,
+        "ts": ts,
+        "durations": [d0, d1, d2],
+        "avg_distance": avg_distance,
+        "batteryPercentage": battery,
+        "estimatedUsedCapacity": used_capacity
+    }
+
+
+def read_records(path):
+    """Yield all records of a history database, opened read-only (for offline tools)."""
+    connection = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+    try:
+        for row in connection.execute(f"{_SELECT} ORDER BY id"):
+            yield _record(row)
+    finally:
+        connection.close()
+
+
+class SqliteHistoryStore:
+    """History log in an SQLite database, with the same interface as HistoryStore.
+
+    The database runs in WAL mode, so API requests can read while the ingest
+    workers write. Batches are inserted in one transaction, and range queries
+    use the (device, ts) index instead of memory, so the server only needs to
+    keep the recent history of each device in RAM.
+    """
+
+    # Older history can be read back with oldest_ts() and query_range()
+    supports_queries = True
+
+    def __init__(self, path, retention_records=1000, compact_interval=60.0, sync_observer=None,
+                 on_expire=None, expire_batch=10000):
+        self.path = path
+        self.sync_observer = sync_observer  # Called with the duration of every insert transaction in seconds
+        self.on_expire = on_expire  # Called with the expired records before compaction deletes them
+        self.expire_batch = expire_batch
+        self.retention_records = retention_records
+        self.compact_interval = compact_interval
+
+        self._lock = threading.Lock()  # One writer at a time
+        self._local = threading.local()  # Reader connection per thread
+        self._stop_event = threading.Event()
+        self._compactor = None
+
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a commit only waits for the log write; a power cut can lose
+        # the last transactions but never corrupts the database
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    def _reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def load(self):
+        """Yield the retained records, oldest first."""
+        with self._lock:
+            (last_id,) = self._writer.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()
+        count = 0
+        cursor = self._reader().execute(f"{_SELECT} WHERE id > ? ORDER BY id", (last_id - self.retention_records,))
+        for row in cursor:
+            count += 1
+            yield _record(row)
+        logger.info(f"Replayed {count} history records from {self.path}")
+
+    def load_lazily(self, folded_seqs):
+        """Same interface as HistoryStore.load_lazily(). WAL recovery already makes the
+        database consistent and range queries read it directly, so everything is recent."""
+        return list(self.load()), iter(()), {}
+
+    def has_records(self):
+        return self._reader().execute("SELECT 1 FROM history LIMIT 1").fetchone() is not None
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Insert records in a single transaction. A clear marker deletes the older rows of its device."""
+        rows = [_row(record) for record in records]
+        with self._lock:
+            started = time.perf_counter()
+            with self._writer:
+                start = 0
+                for i, row in enumerate(rows):
+                    if row[-1]:
+                        self._writer.executemany(_INSERT, rows[start:i])
+                        self._writer.execute("DELETE FROM history WHERE device = ?", (row[0],))
+                        start = i
+                self._writer.executemany(_INSERT, rows[start:])
+            if self.sync_observer is not None:
+                self.sync_observer(time.perf_counter() - started)
+
+    def flush(self):
+        """Commits are already durable; merge the write-ahead log into the database."""
+        with self._lock:
+            self._writer.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def clear(self):
+        with self._lock, self._writer:
+            self._writer.execute("DELETE FROM history")
+
+    def compact(self):
+        """Delete the rows that fell out of the retention window."""
+        with self._lock:
+            (last_id,) = self._writer.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()
+        cutoff = last_id - self.retention_records
+        deleted = 0
+        while True:
+            if self.on_expire is None:
+                batch_end = cutoff
+            else:
+                # Hand the rows over in batches; if on_expire fails they stay for the next compaction
+                rows = self._reader().execute(f"SELECT id, {_COLUMNS} FROM history WHERE id <= ? ORDER BY id LIMIT ?",
+                                              (cutoff, self.expire_batch)).fetchall()
+                if not rows:
+                    break
+                self.on_expire([_record(row[1:]) for row in rows])
+                batch_end = rows[-1][0]
+            with self._lock, self._writer:
+                deleted += self._writer.execute("DELETE FROM history WHERE id <= ?", (batch_end,)).rowcount
+            if batch_end == cutoff:
+                break
+        if deleted > 0:
+            logger.info(f"Compaction removed {deleted} expired history rows")
+
+    def oldest_ts(self, device_id):
+        """Timestamp of the oldest stored entry of a device (None if there is none)."""
+        (ts,) = self._reader().execute(
+            "SELECT MIN(ts) FROM history WHERE device = ? AND cleared = 0", (device_id,)).fetchone()
+        return ts
+
+    def query_range(self, device_id, since_ts, until_ts=None):
+        """Records of a device with since_ts <= ts (<= until_ts), oldest first."""
+        if until_ts is None:
+            until_ts = float("inf")
+        cursor = self._reader().execute(
+            f"{_SELECT} WHERE device = ? AND ts >= ? AND ts <= ? AND cleared = 0 ORDER BY ts, id",
+            (device_id, since_ts, until_ts))
+        return [_record(row) for row in cursor]
+
+    def _compaction_loop(self):
+        while not self._stop_event.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error during history compaction: {e}")
+
+    def start_compaction(self):
+        """Start the background thread that deletes expired rows."""
+        if self._compactor is not None:
+            return
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        self._stop_event.set()
+        if self._compactor is not None:
+            self._compactor.join(timeout=5)
+            self._compactor = None
+        with self._lock:
+            self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._writer.close()
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """The server module, imported on a scratch copy of the server directory (as benchmark.py does)."""
+    import benchmark
+    cwd = os.getcwd()
+    module = benchmark.load_server(tmp_path_factory.mktemp("server"))
+    os.chdir(cwd)
+    return module
+
+
+# Ingest batch item of a firmware JSON message, as queued by on_message()
+def reading(device_id, received_at, durations=(8695, 8693, 8691), payload=None):
+    topic = f"letterbox/{device_id}/data"
+    payload = payload if payload is not None else json.dumps({
+        "durations": list(durations), "batteryPercentage": 99, "batteryCapacity": 10000.0,
+        "estimatedUsedCapacity": 22.8, "powerSource": "USB Accumulator"
+    }).encode()
+    return (received_at, (device_id, topic, payload, received_at))
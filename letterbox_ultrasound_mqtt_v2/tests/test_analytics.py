@@ -0,0 +1,87 @@
+import random
+import time
+
+import pytest
+
+from history_buffer import HistoryBuffer
+
+np = pytest.importorskip("numpy")
+import analytics  # noqa: E402
+
+MONTH = 30 * 8640  # Readings at 10 s intervals
+
+
+@pytest.fixture(scope="module")
+def month():
+    rng = random.Random(1)
+    history = HistoryBuffer(MONTH)
+    ts = time.time() - MONTH * 10
+    for i in range(MONTH):
+        duration = 8700 + rng.randint(-5, 5)
+        history.append({
+            "ts": ts + i * 10,
+            "durations": [duration, duration + rng.randint(-3, 3), duration + rng.randint(-3, 3)],
+            "avg_distance": 150.0 + rng.random(),
+            "batteryPercentage": 100 - i * 50 / MONTH,
+            "estimatedUsedCapacity": i * 0.01
+        })
+    return history.snapshot()
+
+
+def test_history_stats_of_a_month_within_10_ms(month):
+    # The first call sums up every chunk; later ones only the newest and a partial one
+    analytics.history_stats(month, 0, len(month))
+    best = float("inf")
+    for _ in range(10):
+        started = time.perf_counter()
+        analytics.history_stats(month, 0, len(month))
+        best = min(best, time.perf_counter() - started)
+    assert best < 0.010
+
+
+def test_history_stats_match_numpy(month):
+    start = 1000
+    stats = analytics.history_stats(month, start, len(month), window=30, points=100)
+    distance = np.frombuffer(month.column("avg_distance", start), dtype=np.float64)
+    d0, d1, d2 = (np.frombuffer(month.column(name, start), dtype=np.int32).astype(np.float64) for name in ("d0", "d1", "d2"))
+    spread = np.std([d0, d1, d2], axis=0) * analytics.SOUND_SPEED_MM_PER_US / 2
+    assert stats["count"] == len(distance)
+    assert stats["avg_distance"]["mean"] == pytest.approx(distance.mean())
+    assert stats["avg_distance"]["std"] == pytest.approx(distance.std())
+    assert stats["noise"]["median"] == pytest.approx(np.percentile(spread, 50))
+    assert stats["noise"]["p95"] == pytest.approx(np.percentile(spread, 95))
+    assert stats["noise"]["mean"] == pytest.approx(spread.mean())
+    assert stats["battery"]["usedCapacityPerHour"] == pytest.approx(0.01 * 360)
+    assert stats["battery"]["percentageDropPerHour"] == pytest.approx(50 / MONTH * 360)
+    last = distance[-30:]
+    assert stats["rolling"]["mean"][-1] == pytest.approx(last.mean())
+    assert stats["rolling"]["std"][-1] == pytest.approx(last.std())
+
+
+def test_cached_chunk_summaries_match_a_fresh_pass():
+    rng = random.Random(2)
+    history = HistoryBuffer(500, chunk_size=16)
+
+    def add(count):
+        for _ in range(count):
+            duration = 8700 + rng.randint(-5, 5)
+            history.append({
+                "ts": 1.7e9 + history.last_seq * 10 + rng.choice((0, 10)),
+                "durations": [duration, duration + rng.randint(-3, 3), rng.choice((0, 40000, duration))],
+                "avg_distance": 150.0 + rng.random(),
+                "batteryPercentage": 100 - rng.random(),
+                "estimatedUsedCapacity": rng.random()
+            })
+
+    add(400)
+    analytics.history_stats(history.snapshot(), 5, 400)
+    add(300)  # Evicts the oldest chunks
+    view = history.snapshot()
+    cached = analytics.history_stats(view, 5, len(view), window=40, points=50)
+    analytics._chunk_summaries.clear()
+    fresh = analytics.history_stats(view, 5, len(view), window=40, points=50)
+    assert {key: cached[key] for key in ("count", "from", "to")} == {key: fresh[key] for key in ("count", "from", "to")}
+    for key in ("avg_distance", "noise", "battery"):
+        assert cached[key] == pytest.approx(fresh[key])
+    for key in ("ts", "mean", "std"):
+        assert cached["rolling"][key] == pytest.approx(fresh["rolling"][key])
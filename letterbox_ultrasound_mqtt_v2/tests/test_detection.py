@@ -0,0 +1,14 @@
+from detection import HysteresisDetector
+
+
+def test_hysteresis_ignores_noise_on_both_sides():
+    detector = HysteresisDetector(threshold=5.0, confirm=2)
+    assert [detector.update(value) for value in (100, 100, 110, 90)] == [None] * 4
+    assert detector.baseline == 100
+
+
+def test_hysteresis_reports_a_confirmed_change():
+    detector = HysteresisDetector(threshold=5.0, confirm=2)
+    events = [detector.update(value) for value in (100, 90, 110, 80, 80)]
+    assert events[:4] == [None] * 4
+    assert events[4].kind == "arrived" and events[4].current == 80.0
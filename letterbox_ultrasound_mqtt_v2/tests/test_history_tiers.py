@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+
+from conftest import reading
+from rollups import Rollups
+
+
+def test_short_history_is_served_raw(server):
+    # 3 hours of readings at 10 s intervals from a new device
+    now = time.time()
+    server.process_batch([reading("tiers-short", now - 3 * 3600 + i * 10) for i in range(1080)])
+    client = server.app.test_client()
+
+    for query in ("timeframe=6h", "timeframe=1d", "timeframe=1w", "timeframe=1m"):
+        response = client.get(f"/api/devices/tiers-short/history?{query}")
+        assert response.headers["X-History-Tier"] == "raw", query
+        assert len(response.get_json()) == 1080, query
+
+    for query in ("timeframe=all&points=1000", "timeframe=1m&points=800", "timeframe=6h&points=500&method=lttb"):
+        response = client.get(f"/api/devices/tiers-short/history?{query}")
+        assert response.headers["X-History-Tier"] == "raw", query
+        assert 100 < len(response.get_json()) <= 1000, query
+
+
+def test_rollup_tier_keeps_method(server):
+    now = time.time()
+    server.process_batch([reading("tiers-method", now - 3 * 3600 + i * 10) for i in range(1080)])
+    client = server.app.test_client()
+    for method in ("minmax", "lttb"):
+        response = client.get(f"/api/devices/tiers-method/history?timeframe=6h&points=50&tier=minute&method={method}")
+        assert response.headers["X-History-Tier"] == "minute"
+        assert len(response.get_json()) <= 50
+
+
+def test_covering_skips_tiers_started_with_the_raw_samples():
+    rollups = Rollups({"minute": 10, "hour": 1000, "day": 1000})
+    start = 1_700_000_000.0
+    for i in range(24 * 60):
+        rollups.add(i + 1, start + i * 60, 100.0, 90.0)
+    # The raw samples go back as far as the rollups: no tier has anything older
+    assert rollups.covering(start - 3600, start) is None
+    # The minute tier dropped its oldest buckets, the hour tier still has readings before the raw samples
+    assert rollups.covering(start + 3600, start + 12 * 3600).name == "hour"
+    assert rollups.complete().name == "hour"
+
+
+def test_rollup_file_state_is_consistent_while_evicting(server):
+    # One reading per minute with a battery level derived from its time, so every
+    # column of a bucket can be checked against its ts
+    start = time.time() - 30 * 86400
+    start -= start % 60
+
+    def battery(ts):
+        return (ts - start) // 60 % 97
+
+    def batch(first, count):
+        items = []
+        for i in range(first, first + count):
+            ts = start + i * 60
+            payload = json.dumps({"durations": [8700, 8700, 8700], "batteryPercentage": battery(ts),
+                                  "estimatedUsedCapacity": 1.0}).encode()
+            items.append(reading("tiers-race", ts, payload=payload))
+        return items
+
+    server.process_batch(batch(0, 1))
+    server.devices.get("tiers-race").rollups.tier("minute").capacity = 64
+    done = threading.Event()
+
+    def ingest():
+        for first in range(1, 5000, 50):
+            server.process_batch(batch(first, 50))
+        done.set()
+
+    thread = threading.Thread(target=ingest)
+    thread.start()
+    try:
+        while not done.is_set():
+            columns = server.rollup_file_state()["devices"]["tiers-race"]["tiers"]["minute"]
+            assert len({len(values) for values in columns.values()}) == 1
+            for i, ts in enumerate(columns["ts"]):
+                assert columns["count"][i] == 1
+                assert columns["battery_min"][i] == columns["battery_max"][i] == columns["battery_sum"][i] == battery(ts)
+    finally:
+        thread.join()
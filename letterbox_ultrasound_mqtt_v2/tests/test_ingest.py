@@ -0,0 +1,21 @@
+import time
+
+from conftest import reading
+
+
+def decode_errors(server):
+    return sum(cell[0] for cell in server.decode_errors._cells.collect().values())
+
+
+def test_invalid_payload_only_drops_its_own_message(server):
+    now = time.time()
+    errors = decode_errors(server)
+    batch = [reading(f"mixed-{i}", now) for i in range(3)]
+    batch += [reading("mixed-bad", now, payload=payload) for payload in (b"5", b"[1, 2]", b"\"text\"", b"{broken")]
+    batch += [reading(f"mixed-{i}", now + 1) for i in range(3)]
+    server.process_batch(batch)
+
+    for i in range(3):
+        assert len(server.devices.get(f"mixed-{i}").history) == 2
+    assert server.devices.get("mixed-bad") is None
+    assert decode_errors(server) == errors + 4
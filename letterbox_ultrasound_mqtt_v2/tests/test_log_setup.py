@@ -0,0 +1,30 @@
+import logging
+
+from log_setup import RateLimitFilter
+
+
+def record(level, message="Received message on topic letterbox/data: {}"):
+    return logging.LogRecord("letterbox_server.ingest.messages", level, __file__, 10, message, None, None)
+
+
+def test_rate_limit_suppresses_repeated_info_lines():
+    limit = RateLimitFilter(rate=0, burst=3, sample_every=0)
+    passed = [limit.filter(record(logging.INFO)) for _ in range(10)]
+    assert passed.count(True) == 3
+    assert limit.suppressed == 7
+
+
+def test_rate_limit_never_suppresses_warnings_and_errors():
+    limit = RateLimitFilter(rate=0, burst=1, sample_every=0)
+    for _ in range(5):
+        limit.filter(record(logging.INFO))
+    assert all(limit.filter(record(level, "Error decoding payload")) for level in (logging.WARNING, logging.ERROR) * 5)
+
+
+def test_only_the_per_message_logger_is_rate_limited(server):
+    def rate_limited(name):
+        return any(isinstance(f, RateLimitFilter) for f in logging.getLogger(name).filters)
+
+    assert rate_limited(server.INGEST_LOGGER)
+    # Start/stop lines and queue warnings of the ingest workers
+    assert not rate_limited("letterbox_server.ingest")
@@ -0,0 +1,26 @@
+import threading
+
+import metrics
+
+
+def test_finished_threads_are_merged_without_scraping():
+    counter = metrics.Counter("test_requests_total", "Requests", ("route",))
+    for _ in range(200):
+        thread = threading.Thread(target=counter.inc, args=("/api/data",))
+        thread.start()
+        thread.join()
+    assert len(counter._cells._threads) <= 2
+    assert counter._cells.collect()[("/api/data",)][0] == 200
+
+
+def test_counter_functions_are_exposed_as_counters():
+    registry = metrics.MetricsRegistry()
+    totals = {"hit": 3, "miss": 1}
+    registry.counter_function("test_lookups_total", "Lookups", lambda: [((result,), count) for result, count in totals.items()],
+                              ("result",))
+    assert registry.expose().splitlines() == [
+        "# HELP test_lookups_total Lookups",
+        "# TYPE test_lookups_total counter",
+        'test_lookups_total{result="hit"} 3',
+        'test_lookups_total{result="miss"} 1'
+    ]
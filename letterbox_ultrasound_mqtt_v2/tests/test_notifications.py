@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+
+import notifications
+from notifications import NotificationDispatcher
+
+
+class StuckSink:
+    """A sink whose provider hangs: send() only returns (failing) once released."""
+
+    name = "stuck"
+    blocking = True
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def send(self, notification):
+        self.release.wait()
+        raise ConnectionError("provider down")
+
+
+# Paced, so the dispatcher forwards them and they pile up in the sink queue
+def fill(dispatcher, count):
+    for i in range(count):
+        dispatcher.submit({"device": f"box-{i}", "message": "New letter"}, coalesce=False)
+        time.sleep(0.01)
+
+
+def test_stop_does_not_block_on_a_full_sink_queue():
+    sink = StuckSink()
+    dispatcher = NotificationDispatcher([sink], coalesce_window=0, max_retries=3, backoff_base=10.0, queue_size=5)
+    dispatcher.start()
+    fill(dispatcher, 20)
+    time.sleep(0.2)
+    started = time.monotonic()
+    dispatcher.stop(timeout=1.0)
+    assert time.monotonic() - started < 3.0
+    sink.release.set()
+
+
+def test_run_async_ends_with_a_full_sink_queue():
+    sink = StuckSink()
+    dispatcher = NotificationDispatcher([sink], coalesce_window=0, max_retries=3, backoff_base=10.0, queue_size=5)
+
+    async def main():
+        task = asyncio.ensure_future(dispatcher.run_async(timeout=1.0))
+        await asyncio.sleep(0.05)
+        for i in range(20):
+            dispatcher.submit({"device": f"box-{i}", "message": "New letter"}, coalesce=False)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        started = time.monotonic()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        elapsed = time.monotonic() - started
+        # asyncio.run() waits for the executor thread that is stuck in send()
+        sink.release.set()
+        return elapsed
+
+    assert asyncio.run(main()) < 3.0
+
+
+def test_stop_does_not_block_on_a_full_incoming_queue(monkeypatch):
+    dispatcher = NotificationDispatcher([], coalesce_window=0, queue_size=5)
+    accept = dispatcher._accept
+    release = threading.Event()
+
+    # The dispatcher thread hangs on the first notification while the queue fills up
+    def stuck_accept(item):
+        release.wait()
+        accept(item)
+
+    monkeypatch.setattr(dispatcher, "_accept", stuck_accept)
+    dispatcher.start()
+    for i in range(10):
+        dispatcher.submit({"device": f"box-{i}", "message": "New letter"})
+    stopper = threading.Thread(target=dispatcher.stop, kwargs={"timeout": 0.5}, daemon=True)
+    stopper.start()
+    stopper.join(3.0)
+    stopped = not stopper.is_alive()
+    release.set()
+    assert stopped
+
+
+def test_pending_is_counted_without_iterating():
+    dispatcher = NotificationDispatcher([], coalesce_window=60.0)
+    dispatcher.start()
+    for device in ("box-1", "box-1", "box-2"):
+        dispatcher.submit({"device": device, "message": "New letter"})
+    time.sleep(0.2)
+    assert dispatcher.stats()["pending"] == 3
+    dispatcher.stop(timeout=2.0)
+    assert dispatcher.stats()["pending"] == 0
+    assert dispatcher.coalesced == 1
+
+
+class FailingSink:
+    name = "failing"
+    blocking = False
+
+    def __init__(self):
+        self.attempts = 0
+
+    def send(self, notification):
+        self.attempts += 1
+        raise ConnectionError("provider down")
+
+
+def test_run_async_cuts_the_backoff_short(monkeypatch):
+    monkeypatch.setattr(notifications.random, "uniform", lambda low, high: high)
+    sink = FailingSink()
+    dispatcher = NotificationDispatcher([sink], coalesce_window=0, max_retries=5, backoff_base=60.0, backoff_max=60.0)
+
+    async def main():
+        task = asyncio.ensure_future(dispatcher.run_async(timeout=10.0))
+        await asyncio.sleep(0.05)
+        dispatcher.submit({"device": "box-1", "message": "New letter"})
+        await asyncio.sleep(0.2)
+        started = time.monotonic()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 2.0
+    # One attempt, then one last attempt without waiting once stopped
+    assert sink.attempts == 2
+    assert dispatcher.stats()["sinks"]["failing"]["failed"] == 1
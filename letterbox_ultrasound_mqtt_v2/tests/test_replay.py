@@ -0,0 +1,21 @@
+from argparse import Namespace
+
+import replay
+
+
+def args(**options):
+    defaults = {"detector": None, "median_window": None, "option": [], "threshold": None}
+    return Namespace(**dict(defaults, **options))
+
+
+def test_defaults_follow_the_server_detector(server):
+    assert replay.detector_configs(args()) == [server.LETTER_DETECTOR]
+
+
+def test_options_override_the_server_detector(server):
+    config, = replay.detector_configs(args(median_window=5))
+    assert config == dict(server.LETTER_DETECTOR, median_window=5)
+    config, = replay.detector_configs(args(detector="cusum"))
+    assert config == {"type": "cusum", "median_window": server.LETTER_DETECTOR.get("median_window", 1)}
+    # Overrides work on copies
+    assert replay.detector_configs(args()) == [server.LETTER_DETECTOR]
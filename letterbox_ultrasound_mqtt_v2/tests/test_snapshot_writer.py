@@ -0,0 +1,47 @@
+import json
+import time
+
+from snapshot_writer import SnapshotWriter
+
+
+def write_times(path, **settings):
+    writes = []
+    writer = SnapshotWriter(str(path), observer=lambda seconds: writes.append(time.monotonic()), **settings)
+    writer.start()
+    return writer, writes
+
+
+def test_writes_after_debounce(tmp_path):
+    writer, writes = write_times(tmp_path / "state.json", flush_interval=0.0, max_staleness=10.0, debounce=0.2)
+    started = time.monotonic()
+    writer.update({"value": 1})
+    time.sleep(0.5)
+    writer.stop()
+    assert len(writes) == 1
+    assert 0.15 <= writes[0] - started <= 0.4
+    assert json.loads((tmp_path / "state.json").read_text()) == {"value": 1}
+
+
+def test_max_staleness_caps_the_delay(tmp_path):
+    # Updates keep coming in and the flush interval is long: only the cap triggers a write
+    writer, writes = write_times(tmp_path / "state.json", flush_interval=10.0, max_staleness=0.3, debounce=0.2)
+    started = time.monotonic()
+    while time.monotonic() - started < 0.6:
+        writer.update({"value": time.monotonic()})
+        time.sleep(0.02)
+    assert writes, "no write within twice max_staleness"
+    assert writes[0] - started <= 0.45
+    writer.stop()
+
+
+def test_flush_interval_limits_writes(tmp_path):
+    writer, writes = write_times(tmp_path / "state.json", flush_interval=0.4, max_staleness=10.0, debounce=0.0)
+    started = time.monotonic()
+    while time.monotonic() - started < 1.0:
+        writer.update({"value": 1})
+        time.sleep(0.02)
+    writer.stop()
+    # The first write comes at once, then at most one per flush interval (plus the one of stop())
+    assert 2 <= len(writes) <= 5
+    gaps = [b - a for a, b in zip(writes, writes[1:-1])]
+    assert all(gap >= 0.35 for gap in gaps)